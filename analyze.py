@@ -1,100 +1,38 @@
 import math
-from enum import Enum
-from compare import find_closest_node, dist_complicated
-from import_osm import import_osm
-from import_geojson import import_geojson, export_geojson, import_geojson_netwerken, export_geojson_edges, import_geojson_combined
-from compare import find_matching_point, dist_complicated, find_closest_node, find_matching_nodes, create_tree, find_closest_node_using_tree, find_matching_nodes_using_tree
+from change_type import ChangeType
+from compare import find_closest_node, dist_complicated, edge_metrics, EdgeRefIndex, edge_endpoints, convert_to_m_array
+from import_osm import read_osm
+from import_pbf import read_pbf
+from import_geojson import export_geojson, export_geojson_edges, load_geojson, select_geojson
+from compare import find_matching_point, dist_complicated, find_closest_node, find_matching_nodes, create_tree, find_closest_nodes_using_tree, find_matching_nodes_using_tree, set_closest_matches, RefIndex
 from osm_knooppunten.helper import is_small_rename
 from _version import __version__
 import os
 from scipy.spatial import KDTree
 import numpy as np
-import copy
-
-class ChangeType(Enum):
-    # No significant change
-    NO = 1
-
-    # Exists in OSM dataset, but does not exist in import dataset and is not renamed
-    REMOVED = 2
-
-    # Does not exist in OSM dataset, but does exist in import dataset and is not renamed
-    ADDED = 3
-
-    # Close to node in other dataset with a different name. The other node
-    # doesn't have a matching node either. Minor renames are classified as RENAMED_MINOR
-    RENAMED = 4
-
-    # Same as renamed, but used for minor renames. This is used when the
-    # difference is just a couple of letters. When it's a different number,
-    # it's classified as a normal rename.
-    RENAMED_MINOR = 5
-
-    # Matches with a node in the other dataset with distance 1-20m
-    MOVED_SHORT = 6
-
-    # Matches with a node in the other dataset with distance 20-100m
-    MOVED_MEDIUM = 7
-
-    # Matches with a node in the other dataset with distance 100-1000m
-    MOVED_LONG = 8
-
-    # Matches with a node in the other dataset with distance < 60 however another node also matches with smaller distance
-    ADDED_DOUBLE = 9
-
-    # Matches with a node in the other dataset with distance > 60 and < 500 however another node also matches with smaller distance
-    ADDED_DOUBLE_LONG = 10
-
-    # Matches with a node in the other dataset with distance < 60 however that node does not match with it
-    REMOVED_DOUBLE = 11
-
-    # Matches with a node in the other dataset with distance > 60 and < 500 however that node does not match with it
-    REMOVED_DOUBLE_LONG = 12
-
-    # None of the others
-    OTHER = 13
-
-    def __str__(self):
-        if self == ChangeType.NO:
-            return "No change"
-
-        if self == ChangeType.REMOVED:
-            return "Removed"
-
-        if self == ChangeType.ADDED:
-            return "Added"
-
-        if self == ChangeType.RENAMED:
-            return "Renamed"
-
-        if self == ChangeType.RENAMED_MINOR:
-            return "Minor rename"
-
-        if self == ChangeType.MOVED_SHORT:
-            return "Moved short distance"
-
-        if self == ChangeType.MOVED_MEDIUM:
-            return "Moved medium distance"
-
-        if self == ChangeType.MOVED_LONG:
-            return "Moved long distance"
-
-        if self == ChangeType.ADDED_DOUBLE:
-            return "Added double"
-
-        if self == ChangeType.REMOVED_DOUBLE:
-            return "Removed double"
-
-        if self == ChangeType.ADDED_DOUBLE_LONG:
-            return "Added double long distance"
-
-        if self == ChangeType.REMOVED_DOUBLE_LONG:
-            return "Removed double long distance"
-
-        if self == ChangeType.OTHER:
-            return "Other"
-
-        return "Unknown enum value: {}".format(self.value)
+from node import NodeTable, RefPool
+from edge import EdgeTable, pack_edges
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from itertools import repeat
+from incremental import save_node_state, load_node_state, previous_rows, match_edges_incremental
+
+# Size (in m) of the tiles the analysis is split in to run it in parallel
+tile_size = 20000
+
+# Margin (in m) around a tile in the parallel node analysis. The
+# classification looks at nodes up to 1000 m away. The margin is twice that,
+# because the KD trees use projected coordinates, in which distances differ
+# from the real ones.
+node_halo = 2000
+
+# Number of closest nodes that are considered for renames
+closest_node_count = 2
+
+# Margin (in m) around the import nodes of a region or province. The OSM
+# data is limited to this distance of their extent (see select_datasets),
+# well beyond the 1000 m the classification looks at.
+area_margin = 3000
 
 def get_node_change_type_ext(node_ext, nodes_osm, nodes_ext):
     closest_match = node_ext.closest_match_node
@@ -104,26 +42,24 @@ def get_node_change_type_ext(node_ext, nodes_osm, nodes_ext):
     else:
         closest_match_dist = math.inf
     
-    # TODO: Should find next closest node if closest node has a match
     if closest_match_dist > 1000:
-        #print("closest_match_dist: "+str(closest_match_dist))
-        # closest_node = find_closest_node(node_ext, nodes_osm)
-        closest_node = node_ext.closest_node
-
-        if closest_node:
-            #closest_node_dist = dist_complicated(closest_node.lat, closest_node.lon, node_ext.lat, node_ext.lon)
-            closest_node_dist = node_ext.closest_dist
-
-            closest_match_of_closest_node = closest_node
-            if closest_match_of_closest_node:
-                 closest_match_dist_of_closest_node = closest_match_of_closest_node.closest_match_dist
-                 if closest_match_dist_of_closest_node == None:
-                     closest_match_dist_of_closest_node = math.inf
-            else:
-                 closest_match_dist_of_closest_node = math.inf 
-        else:
-            closest_node_dist = math.inf
-            closest_match_dist_of_closest_node = math.inf
+        # Use the closest node that has no match itself. The next closest
+        # nodes are only considered if the closer ones have a match.
+        closest_node = None
+        closest_node_dist = math.inf
+        closest_match_dist_of_closest_node = math.inf
+
+        for candidate, candidate_dist in node_ext.closest_nodes:
+            candidate_match_dist = candidate.closest_match_dist
+            if candidate_match_dist == None:
+                candidate_match_dist = math.inf
+
+            closest_node = candidate
+            closest_node_dist = candidate_dist
+            closest_match_dist_of_closest_node = candidate_match_dist
+
+            if candidate_dist >= 40 or candidate_match_dist > 1000:
+                break
 
         #print(closest_node_dist)
         if closest_node_dist < 40 and closest_match_dist_of_closest_node > 1000:
@@ -186,50 +122,304 @@ def is_node_removed_osm(node_osm, nodes_osm, nodes_ext):
     if not all_matching_nodes or len(all_matching_nodes) == 0 or closest_match_dist > 1000:
         return True
 
-def do_analysis_internal(nodes_osm, nodes_ext, nodes_osm_invalid, nodes_ext_invalid, progress):
-
+def analyze_nodes(nodes_osm, nodes_ext):
+    # Find the closest nodes and matches of two linked node tables and
+    # return the change type and matched node of every ext node
     use_kd_tree = True
     #use_kd_tree = False
 
     if use_kd_tree:
         tree_osm = create_tree(nodes_osm)
-        tree_ext = create_tree(nodes_ext)
-
-        for node_ext in nodes_ext:
-            #closest_node = find_closest_node(node_ext, nodes_osm)
-            closest_node = find_closest_node_using_tree(node_ext, nodes_osm, tree_osm)
-            node_ext.closest_node = closest_node
-            node_ext.closest_dist = dist_complicated(closest_node.lat, closest_node.lon, node_ext.lat, node_ext.lon)
-
-            if 0 and closest_node != closest_node_tree:
-                 print("different")
-                 print(closest_node.lat)
-                 print(closest_node_tree.lat)
-                 print(closest_node.lon)
-                 print(closest_node_tree.lon)
-                 print(dist_complicated(closest_node.lat, closest_node.lon, node_ext.lat, node_ext.lon))
-                 print(dist_complicated(closest_node_tree.lat, closest_node_tree.lon, node_ext.lat, node_ext.lon))
+
+        closest_dist, closest_index = find_closest_nodes_using_tree(nodes_ext, nodes_osm, tree_osm, closest_node_count)
+        nodes_ext.set_closest(closest_dist, closest_index)
 
     print("start match");
     if use_kd_tree:
-        find_matching_nodes_using_tree(nodes_osm, nodes_ext, tree_osm, tree_ext)
+        find_matching_nodes_using_tree(nodes_osm, nodes_ext)
     else:
         find_matching_nodes(nodes_osm, nodes_ext)
 
-    #nodes_osm_copy = copy.deepcopy(nodes_osm)
-    #nodes_ext_copy = copy.deepcopy(nodes_ext)
-
     print("eind match");
 
-    node_changes_dict = dict()
-    for key in ChangeType:
-        node_changes_dict[key] = []
+    return [get_node_change_type_ext(node, nodes_osm, nodes_ext) for node in nodes_ext]
+
+def cell_rows(cells):
+    # Rows of every cell of an (n, 2) array of cells, as a dict from cell to
+    # ascending row indices
+    keys, inverse = np.unique(cells, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+    return dict(zip(map(tuple, keys.tolist()), np.split(order, bounds)))
+
+def rows_near_cell(rows_by_cell, xy, key, margin):
+    # Ascending rows of the points within margin of a cell
+    reach = int(margin // tile_size) + 1
+    rows = [rows_by_cell.get((i, j), np.zeros(0, dtype=np.int64))
+            for i in range(key[0] - reach, key[0] + reach + 1) for j in range(key[1] - reach, key[1] + reach + 1)]
+    rows = np.sort(np.concatenate(rows))
+
+    low = np.array(key) * tile_size - margin
+    high = (np.array(key) + 1) * tile_size + margin
+    return rows[np.all((xy[rows] >= low) & (xy[rows] <= high), axis=1)]
+
+def node_tiles(nodes_osm, nodes_ext):
+    # Split both node sets in square tiles of tile_size m. Every tile also
+    # gets the OSM nodes within node_halo of the tile and the ext nodes within
+    # twice that, which are all nodes the classification of its own nodes
+    # looks at. Yields the rows of the OSM and ext nodes of every tile (in
+    # ascending order) and masks of the ones in the tile itself.
+    xy_osm = nodes_osm.xy
+    xy_ext = nodes_ext.xy
+    cell_osm = np.floor(xy_osm / tile_size).astype(np.int64)
+    cell_ext = np.floor(xy_ext / tile_size).astype(np.int64)
+    rows_by_cell_osm = cell_rows(cell_osm)
+    rows_by_cell_ext = cell_rows(cell_ext)
+
+    for key in sorted(rows_by_cell_osm.keys() | rows_by_cell_ext.keys()):
+        rows_osm = rows_near_cell(rows_by_cell_osm, xy_osm, key, node_halo)
+        rows_ext = rows_near_cell(rows_by_cell_ext, xy_ext, key, 2 * node_halo)
+        yield rows_osm, np.all(cell_osm[rows_osm] == key, axis=1), rows_ext, np.all(cell_ext[rows_ext] == key, axis=1)
+
+def beyond_halo(nodes, other_nodes, index):
+    # Whether the rows index of other_nodes (an (n,) or (n, k) array) are
+    # missing or further than node_halo from the nodes, in the projected
+    # coordinates. Such results of a tile may differ from the full analysis.
+    found = index >= 0
+    if len(other_nodes) == 0:
+        return ~found
+
+    delta = other_nodes.xy[np.where(found, index, 0)] - nodes.xy.reshape((len(nodes),) + (1,) * (index.ndim - 1) + (2,))
+    return ~found | (np.hypot(delta[..., 0], delta[..., 1]) > node_halo)
+
+def analyze_node_tile_tables(nodes_osm, core_osm, nodes_ext, core_ext):
+    # analyze_nodes for the nodes of a tile (see node_tiles). Returns the
+    # results of the nodes in the tile itself, with row indices into the
+    # tile. Closest nodes and matches beyond node_halo may differ from the
+    # full analysis (see find_far_nodes).
+    nodes_osm.link(nodes_ext)
+    nodes_ext.link(nodes_osm)
+
+    closest_dist, closest_index = find_closest_nodes_using_tree(nodes_ext, nodes_osm, create_tree(nodes_osm), closest_node_count)
+    nodes_ext.set_closest(closest_dist, closest_index)
+    find_matching_nodes_using_tree(nodes_osm, nodes_ext)
+
+    rows_ext = np.flatnonzero(core_ext)
+    change_type = np.zeros(len(rows_ext), dtype=np.int8)
+    matched = np.full(len(rows_ext), -1, dtype=np.int64)
+    for i, row in enumerate(rows_ext):
+        node_change_type, matched_node = get_node_change_type_ext(nodes_ext[row], nodes_osm, nodes_ext)
+        change_type[i] = node_change_type.value
+        if matched_node:
+            matched[i] = matched_node.index
+
+    results_ext = (change_type, matched, nodes_ext.renamed_from[rows_ext], nodes_ext.closest_k[rows_ext], nodes_ext.closest_k_dist[rows_ext],
+                   nodes_ext.match[rows_ext], nodes_ext.match_dist[rows_ext])
+    results_osm = (nodes_osm.match[core_osm], nodes_osm.match_dist[core_osm])
+    return results_ext, results_osm
+
+def set_tile_results(nodes_osm, nodes_ext, tile, results, change_type, matched):
+    # Store the results of analyze_node_tile_tables in the full tables, and
+    # the change type and matched OSM node of the ext nodes in change_type
+    # and matched
+    rows_osm, core_osm, rows_ext, core_ext = tile
+    results_ext, results_osm = results
+
+    tile_change_type, tile_matched, renamed_from, closest_k, closest_k_dist, match, match_dist = results_ext
+    rows = rows_ext[core_ext]
+    change_type[rows] = tile_change_type
+    matched[rows] = tile_to_table(rows_osm, tile_matched)
+    nodes_ext.renamed_from[rows] = renamed_from
+    nodes_ext.closest_k[rows] = tile_to_table(rows_osm, closest_k)
+    nodes_ext.closest_k_dist[rows] = closest_k_dist
+    nodes_ext.match[rows] = tile_to_table(rows_osm, match)
+    nodes_ext.match_dist[rows] = match_dist
+
+    match, match_dist = results_osm
+    rows = rows_osm[core_osm]
+    nodes_osm.match[rows] = tile_to_table(rows_ext, match)
+    nodes_osm.match_dist[rows] = match_dist
+
+def find_far_nodes(nodes_osm, nodes_ext):
+    # Look up the closest nodes and matches that are further away than
+    # node_halo again in the full tables. They are too far away to change
+    # the classification, but their distances are exported.
+    rows = np.flatnonzero(beyond_halo(nodes_ext, nodes_osm, nodes_ext.closest_k).any(axis=1))
+    if len(rows) > 0:
+        closest_dist, closest_index = find_closest_nodes_using_tree(nodes_ext.take(rows), nodes_osm, create_tree(nodes_osm), closest_node_count)
+        nodes_ext.closest_k_dist[rows] = closest_dist
+        nodes_ext.closest_k[rows] = closest_index
+
+    for nodes, other_nodes in ((nodes_ext, nodes_osm), (nodes_osm, nodes_ext)):
+        rows = np.flatnonzero(beyond_halo(nodes, other_nodes, nodes.match))
+        if len(rows) > 0:
+            far_nodes = nodes.take(rows)
+            set_closest_matches(far_nodes, other_nodes, RefIndex(other_nodes))
+            nodes.match[rows] = far_nodes.match
+            nodes.match_dist[rows] = far_nodes.match_dist
+
+def share_arrays(arrays):
+    # Copy arrays to shared memory. Returns the blocks (to close and unlink
+    # when done) and the (name, shape, dtype) to open them in another process.
+    blocks = []
+    specs = []
+    for array in arrays:
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs.append((block.name, array.shape, array.dtype.str))
+
+    return blocks, specs
+
+# Shared memory blocks, node columns and ref pool of a node analysis worker
+node_worker_state = None
+
+def init_node_worker(specs, ref_strings):
+    global node_worker_state
+    blocks = [shared_memory.SharedMemory(name=name) for name, shape, dtype in specs]
+    columns = [np.ndarray(shape, dtype=dtype, buffer=block.buf) for block, (name, shape, dtype) in zip(blocks, specs)]
+
+    # Same strings in the same order, so the ids are the same
+    refs = RefPool()
+    for ref in ref_strings:
+        refs.intern(ref)
+
+    node_worker_state = (blocks, columns, refs)
+
+def analyze_node_tile(rows_osm, core_osm, rows_ext, core_ext):
+    # analyze_node_tile_tables, on the node columns in shared memory
+    blocks, columns, refs = node_worker_state
+    nodes_osm = NodeTable(*[column[rows_osm] for column in columns[:4]], refs)
+    nodes_ext = NodeTable(*[column[rows_ext] for column in columns[4:]], refs)
+    return analyze_node_tile_tables(nodes_osm, core_osm, nodes_ext, core_ext)
+
+def tile_to_table(rows, index):
+    # Row indices into a tile to row indices into the full table, -1 stays -1
+    return np.append(rows, -1)[index]
+
+def analyze_nodes_parallel(nodes_osm, nodes_ext, workers):
+    # analyze_nodes, with the tiles in a process pool. The node columns are
+    # put in shared memory, the workers only get the rows of their tile.
+    # The results are the same as analyze_nodes.
+    tiles = list(node_tiles(nodes_osm, nodes_ext))
+    print("analyze nodes in {} tiles".format(len(tiles)))
+
+    n = len(nodes_ext)
+    change_type = np.zeros(n, dtype=np.int8)
+    matched = np.full(n, -1, dtype=np.int64)
+    nodes_ext.set_closest(np.full((n, closest_node_count), np.nan), np.full((n, closest_node_count), -1, dtype=np.int64))
+
+    columns = [nodes_osm.lat, nodes_osm.lon, nodes_osm.rwn_ref, nodes_osm.rcn_ref,
+               nodes_ext.lat, nodes_ext.lon, nodes_ext.rwn_ref, nodes_ext.rcn_ref]
+    blocks, specs = share_arrays(columns)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_node_worker, initargs=(specs, nodes_ext.refs.strings)) as executor:
+            results = executor.map(analyze_node_tile, *[[tile[i] for tile in tiles] for i in range(4)])
+            for tile, tile_results in zip(tiles, results):
+                set_tile_results(nodes_osm, nodes_ext, tile, tile_results, change_type, matched)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    find_far_nodes(nodes_osm, nodes_ext)
+
+    return [(ChangeType(change_type[i]), nodes_osm[matched[i]] if matched[i] >= 0 else None) for i in range(n)]
+
+def within(xy, points, distance):
+    # Whether the points xy are within distance (plus 1 m for rounding) of
+    # any of the points
+    if len(points) == 0:
+        return np.zeros(len(xy), dtype=bool)
+
+    dist, _ = KDTree(points).query(xy, distance_upper_bound=distance + 1)
+    return np.isfinite(dist)
+
+def analyze_nodes_incremental(nodes_osm, nodes_ext, state):
+    # analyze_nodes, with the results of the previous run (see
+    # load_node_state) for the nodes of which no node within the distance
+    # that the classification looks at has changed. The other nodes are
+    # analyzed as one tile (see node_tiles). The results are the same as
+    # analyze_nodes.
+
+    # Rows of the previous run and the other way around. Changed nodes (and
+    # nodes in another order, see previous_rows) are removed and added again.
+    previous_osm = previous_rows(nodes_osm, state, "osm")
+    previous_ext = previous_rows(nodes_ext, state, "ext")
+
+    current_osm = np.full(len(state["osm_lat"]), -1, dtype=np.int64)
+    current_osm[previous_osm[previous_osm >= 0]] = np.flatnonzero(previous_osm >= 0)
+    current_ext = np.full(len(state["ext_lat"]), -1, dtype=np.int64)
+    current_ext[previous_ext[previous_ext >= 0]] = np.flatnonzero(previous_ext >= 0)
+
+    n = len(nodes_ext)
+    change_type = np.zeros(n, dtype=np.int8)
+    matched = np.full(n, -1, dtype=np.int64)
+    nodes_ext.set_closest(np.full((n, closest_node_count), np.nan), np.full((n, closest_node_count), -1, dtype=np.int64))
+
+    def changed(nodes, previous, current, name):
+        removed = current < 0
+        removed_xy = convert_to_m_array(np.column_stack((state[name + "_lon"][removed], state[name + "_lat"][removed])))
+        return np.concatenate((nodes.xy[previous < 0], removed_xy))
+
+    changed_osm = changed(nodes_osm, previous_osm, current_osm, "osm")
+    changed_ext = changed(nodes_ext, previous_ext, current_ext, "ext")
+    print("incremental: {} OSM and {} ext nodes added or removed".format(len(changed_osm), len(changed_ext)))
+
+    # The same distances as in node_tiles
+    xy_osm = nodes_osm.xy
+    xy_ext = nodes_ext.xy
+    dirty_ext = (previous_ext < 0) | within(xy_ext, changed_osm, node_halo) | within(xy_ext, changed_ext, 2 * node_halo)
+    dirty_osm = (previous_osm < 0) | within(xy_osm, changed_ext, node_halo)
+
+    rows_osm = np.flatnonzero(dirty_osm | within(xy_osm, xy_ext[dirty_ext], node_halo))
+    rows_ext = np.flatnonzero(dirty_ext | within(xy_ext, xy_ext[dirty_ext], 2 * node_halo) | within(xy_ext, xy_osm[dirty_osm], node_halo))
+    print("incremental: analyze {} OSM and {} ext nodes".format(np.count_nonzero(dirty_osm), np.count_nonzero(dirty_ext)))
+
+    tile = (rows_osm, dirty_osm[rows_osm], rows_ext, dirty_ext[rows_ext])
+    results = analyze_node_tile_tables(nodes_osm.take(rows_osm), tile[1], nodes_ext.take(rows_ext), tile[3])
+    set_tile_results(nodes_osm, nodes_ext, tile, results, change_type, matched)
+
+    rows = np.flatnonzero(~dirty_ext)
+    previous = previous_ext[rows]
+    change_type[rows] = state["ext_change_type"][previous]
+    matched[rows] = tile_to_table(current_osm, state["ext_matched"][previous])
+    nodes_ext.renamed_from[rows] = state["ext_renamed_from"][previous]
+    nodes_ext.closest_k[rows] = tile_to_table(current_osm, state["ext_closest_k"][previous])
+    nodes_ext.closest_k_dist[rows] = state["ext_closest_k_dist"][previous]
+    nodes_ext.match[rows] = tile_to_table(current_osm, state["ext_match"][previous])
+    nodes_ext.match_dist[rows] = state["ext_match_dist"][previous]
+
+    rows = np.flatnonzero(~dirty_osm)
+    previous = previous_osm[rows]
+    nodes_osm.match[rows] = tile_to_table(current_ext, state["osm_match"][previous])
+    nodes_osm.match_dist[rows] = state["osm_match_dist"][previous]
+
+    # Matches of removed nodes are beyond the halo as well
+    find_far_nodes(nodes_osm, nodes_ext)
+
+    return [(ChangeType(change_type[i]), nodes_osm[matched[i]] if matched[i] >= 0 else None) for i in range(n)]
+
+def classify_nodes(nodes_osm, nodes_ext, statedir=None, workers=1):
+    # Compare two NodeTables, sets the change type and matched node of the
+    # nodes of both. With statedir, the results of the previous run stored
+    # there are reused (see analyze_nodes_incremental) and the new results
+    # are stored. With more than one worker the nodes are analyzed in
+    # parallel (see analyze_nodes_parallel).
+    nodes_osm.link(nodes_ext)
+    nodes_ext.link(nodes_osm)
+
+    settings = dict(node_halo=node_halo, closest_node_count=closest_node_count)
+    state = load_node_state(statedir, nodes_ext.refs, settings) if statedir else None
+    if state is not None:
+        changes = analyze_nodes_incremental(nodes_osm, nodes_ext, state)
+    elif workers > 1:
+        changes = analyze_nodes_parallel(nodes_osm, nodes_ext, workers)
+    else:
+        changes = analyze_nodes(nodes_osm, nodes_ext)
 
-    i = 0;
-    for node in nodes_ext:
-        #print("Node", i)
-        #print("Node_ext: "+node.rwn_ref)
-        change_type, matched_node = get_node_change_type_ext(node, nodes_osm, nodes_ext)
+    for node, (change_type, matched_node) in zip(nodes_ext, changes):
         if matched_node and matched_node.matched_node:
         
             # The matched node was already matched to some other node
@@ -246,85 +436,58 @@ def do_analysis_internal(nodes_osm, nodes_ext, nodes_osm_invalid, nodes_ext_inva
             matched_node.change_type = change_type
             node.matched_node = matched_node
 
-        node_changes_dict[change_type].append(node)
-        i += 1
-        #progress.emit("Analyzing nodes {}/{}".format(i, len(nodes_ext)))
+    unmatched_osm = nodes_osm.matched < 0
+    removed_dist = np.nan_to_num(nodes_osm.match_dist, nan=0)
+    nodes_osm.change_type[unmatched_osm] = ChangeType.REMOVED.value
+    nodes_osm.change_type[unmatched_osm & (removed_dist != 0) & (removed_dist < 500)] = ChangeType.REMOVED_DOUBLE_LONG.value
+    nodes_osm.change_type[unmatched_osm & (removed_dist != 0) & (removed_dist < 60)] = ChangeType.REMOVED_DOUBLE.value
 
-    for node in nodes_osm:
-        if not node.matched_node:
-            if node.closest_match_dist:
-                if node.closest_match_dist < 60:
-                    node.change_type = ChangeType.REMOVED_DOUBLE
-                    node_changes_dict[ChangeType.REMOVED_DOUBLE].append(node)
-                else:
-                    if node.closest_match_dist < 500:
-                        node.change_type = ChangeType.REMOVED_DOUBLE_LONG
-                        node_changes_dict[ChangeType.REMOVED_DOUBLE_LONG].append(node)
-                    else:
-                        node.change_type = ChangeType.REMOVED
-                        node_changes_dict[ChangeType.REMOVED].append(node)
-            else:
-                node.change_type = ChangeType.REMOVED
-                node_changes_dict[ChangeType.REMOVED].append(node)
+    if statedir:
+        try:
+            os.makedirs(statedir)
+        except FileExistsError:
+            pass # The directory already exists, move on
+        save_node_state(nodes_osm, nodes_ext, statedir, settings)
+
+def do_analysis_internal(nodes_osm, nodes_ext, nodes_osm_invalid, nodes_ext_invalid, progress, resultsdir="results", workers=1, incremental=False):
+    nodes_osm = NodeTable.from_nodes(nodes_osm)
+    nodes_ext = NodeTable.from_nodes(nodes_ext)
+    nodes_osm_invalid = NodeTable.from_nodes(nodes_osm_invalid)
+    nodes_ext_invalid = NodeTable.from_nodes(nodes_ext_invalid)
+
+    classify_nodes(nodes_osm, nodes_ext, resultsdir if incremental else None, workers)
+
+    # The removed nodes are from the OSM dataset, all others from the external dataset
+    node_changes_dict = dict()
+    for key in ChangeType:
+        if key in (ChangeType.REMOVED, ChangeType.REMOVED_DOUBLE, ChangeType.REMOVED_DOUBLE_LONG):
+            node_changes_dict[key] = (nodes_osm, np.flatnonzero(nodes_osm.change_type == key.value))
+        else:
+            node_changes_dict[key] = (nodes_ext, np.flatnonzero(nodes_ext.change_type == key.value))
 
     print('')
     print('*** Nodes ***')
     for key in node_changes_dict:
-        print("{}: {}".format(key, len(node_changes_dict[key])))
+        print("{}: {}".format(key, len(node_changes_dict[key][1])))
 
     #progress.emit("Exporting results")
     exported_files = []
-    export_file = export_geojson(nodes_osm_invalid, "Invalid_osm.geojson")
+    export_file = export_geojson(nodes_osm_invalid, "Invalid_osm.geojson", resultsdir=resultsdir)
     exported_files.append(export_file)
-    export_file = export_geojson(nodes_ext_invalid, "Invalid_ext.geojson")
+    export_file = export_geojson(nodes_ext_invalid, "Invalid_ext.geojson", resultsdir=resultsdir)
     exported_files.append(export_file)
 
     for key in ChangeType:
+        nodes, indices = node_changes_dict[key]
         if key == ChangeType.REMOVED or key == ChangeType.REMOVED_DOUBLE:
-            export_file = export_geojson(node_changes_dict[key], "{}_osm.geojson".format(key))
+            export_file = export_geojson(nodes, "{}_osm.geojson".format(key), indices, resultsdir=resultsdir)
         else:
-            export_file = export_geojson(node_changes_dict[key], "{}_ext.geojson".format(key))
+            export_file = export_geojson(nodes, "{}_ext.geojson".format(key), indices, resultsdir=resultsdir)
         exported_files.append(export_file)
     #progress.emit("Done")
     return exported_files
 
-def create_tree_start_edge(edges):
-        n = len(edges)
-        #print(n)
-        xy_points=np.zeros((n,2))
-        i=0
-        for edge in edges:
-            i=i+1
-            xy_points[i-1][0]=edge.coords_in_m[0][0]
-            xy_points[i-1][1]=edge.coords_in_m[0][1]
-        tree = KDTree(xy_points)
-        return tree
-
-def create_tree_end_edge(edges):
-        n = len(edges)
-        #print(n)
-        xy_points=np.zeros((n,2))
-        i=0
-        for edge in edges:
-            i=i+1
-            xy_points[i-1][0]=edge.coords_in_m[-1][0]
-            xy_points[i-1][1]=edge.coords_in_m[-1][1]
-        tree = KDTree(xy_points)
-        return tree
-
-def find_neighbors_in_tree(x, y, tree, k, max_distance):
-
-    n = tree.n
-
-    dd, ii = tree.query([[x, y]], k = k, distance_upper_bound=max_distance)
-        
-    ii_tmp = ii[0]
-    ii_ind = np.where(ii_tmp < n)[0]
-    ii_short = ii_tmp[ii_ind]
-
-    return ii_short
-
-def get_stepped_coords(coords, step_distance, coords_org):
+def get_stepped_coords(coords, step_distance):
     n = len(coords)
 
     stepped_coords = []
@@ -333,14 +496,6 @@ def get_stepped_coords(coords, step_distance, coords_org):
 
     for i in range(1,n):
 
-        x_1 = coords_org[i-1][0]
-        y_1 = coords_org[i-1][1]
-    
-        x_2 = coords_org[i][0]
-        y_2 = coords_org[i][1]
-
-        d_12_org = dist_complicated(y_1, x_1, y_2, x_2)
-
         x_1 = coords[i-1][0]
         y_1 = coords[i-1][1]
     
@@ -349,8 +504,6 @@ def get_stepped_coords(coords, step_distance, coords_org):
 
         d_12 = math.sqrt((x_2-x_1)**2 + (y_2-y_1)**2)
 
-        #print("d12_org: "+str(d_12_org)+" d12: "+str(d_12))
-
         total_dist = total_dist + d_12
 
         nr_steps = 1 + int(d_12/step_distance)
@@ -375,8 +528,8 @@ def calculate_edge_to_edge_distance(edge_a, edge_b):
     
     step_distance_in_m = 10    
 
-    stepped_coords_a = get_stepped_coords(edge_a.coords_in_m, step_distance_in_m, edge_a.coords)
-    stepped_coords_b = get_stepped_coords(edge_b.coords_in_m, step_distance_in_m, edge_b.coords)
+    stepped_coords_a = get_stepped_coords(edge_a.coords_in_m, step_distance_in_m)
+    stepped_coords_b = get_stepped_coords(edge_b.coords_in_m, step_distance_in_m)
 
     stepped_coord_array_a = np.array(stepped_coords_a)
     stepped_coord_array_b = np.array(stepped_coords_b)
@@ -422,111 +575,101 @@ def calculate_edge_to_edge_distance(edge_a, edge_b):
 
     return max(max_dist_a, max_dist_b)
 
-def do_analysis_edges(edges_osm, edges_ext, edges_osm_invalid, edges_ext_invalid, invalid_edges_osm, invalid_edges_ext, progress):
-
-    print("match ext")
-
-    tree_osm_start=create_tree_start_edge(edges_osm)
-    tree_osm_end=create_tree_end_edge(edges_osm)
+def find_closest_pairs(rows, columns, dists, n_rows):
+    # For every row of a sparse table of pairs, the column of the pair with
+    # the smallest distance (with equal distances the lowest column) and its
+    # distance. Rows without pairs get -1 and nan.
+    closest = np.full(n_rows, -1, dtype=np.int64)
+    closest_dist = np.full(n_rows, np.nan)
+
+    order = np.lexsort((columns, dists, rows))
+    first = order[np.diff(rows[order], prepend=-1) != 0]
+    closest[rows[first]] = columns[first]
+    closest_dist[rows[first]] = dists[first]
+
+    return closest, closest_dist
+
+def set_closest_match_edges(edges, candidates, closest, closest_dist):
+    for i in np.flatnonzero(closest >= 0):
+        edges[i].closest_match_edge = candidates[closest[i]]
+        edges[i].closest_match_dist = closest_dist[i]
+
+def match_edges(edges_ext, edges_osm, metric, max_distance):
+    # Table of candidate pairs (index in edges_ext, index in edges_osm) and
+    # their distances. Candidates are the edges between the same knooppunten,
+    # with both endpoints within max_distance of the endpoints of the edge
+    # (in either direction). The distance is symmetric, so it is calculated
+    # once for both sides.
+    pairs = EdgeRefIndex(edges_osm).find_pairs(edges_ext, max_distance)
+    dists = edge_metrics[metric]().distances([(edges_ext[i], edges_osm[j]) for i, j in pairs])
+    return pairs, dists
+
+def match_edge_tile(ext, osm, metric, max_distance):
+    # match_edges for a tile, on copies of the edges (see pack_edges)
+    return match_edges(list(EdgeTable(*ext)), list(EdgeTable(*osm)), metric, max_distance)
+
+def edge_tiles(edges_ext, edges_osm, max_distance):
+    # Split the ext edges in square tiles of tile_size m, on their start.
+    # Every tile also gets the OSM edges with an endpoint within max_distance
+    # of the tile, which includes all candidates of its ext edges. Yields the
+    # indices of the ext and OSM edges of every tile.
+    start = edge_endpoints(edges_ext)[:, :2]
+    keys, tile = np.unique(np.floor(start / tile_size).astype(np.int64), axis=0, return_inverse=True)
+    tile = tile.reshape(-1)
+
+    endpoints_osm = edge_endpoints(edges_osm).reshape(-1, 2, 2)
+    for i, key in enumerate(keys):
+        low = key * tile_size - max_distance
+        high = (key + 1) * tile_size + max_distance
+        inside = np.all((endpoints_osm >= low) & (endpoints_osm <= high), axis=2)
+        rows_osm = np.flatnonzero(inside.any(axis=1))
+        if len(rows_osm) > 0:
+            yield np.flatnonzero(tile == i), rows_osm
+
+def match_edges_parallel(edges_ext, edges_osm, metric, max_distance, workers):
+    # match_edges, with the tiles in a process pool. The pairs are sorted as
+    # in match_edges, so the result does not depend on the tiles.
+    tiles = list(edge_tiles(edges_ext, edges_osm, max_distance))
+
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    dists = [np.zeros(0)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(match_edge_tile,
+                               [pack_edges([edges_ext[i] for i in rows_ext]) for rows_ext, rows_osm in tiles],
+                               [pack_edges([edges_osm[i] for i in rows_osm]) for rows_ext, rows_osm in tiles],
+                               repeat(metric), repeat(max_distance))
+
+        for (rows_ext, rows_osm), (tile_pairs, tile_dists) in zip(tiles, results):
+            pairs.append(np.column_stack((rows_ext[tile_pairs[:, 0]], rows_osm[tile_pairs[:, 1]])))
+            dists.append(tile_dists)
+
+    pairs = np.concatenate(pairs)
+    dists = np.concatenate(dists)
+    order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+    return pairs[order], dists[order]
+
+def do_analysis_edges(edges_osm, edges_ext, edges_osm_invalid, edges_ext_invalid, invalid_edges_osm, invalid_edges_ext, progress, resultsdir="results",
+                      edge_metric="sampled", workers=1, incremental=False):
+
+    print("match edges")
 
     max_distance = 1000
 
-    k = 10
+    if incremental:
+        pairs, pair_dist = match_edges_incremental(edges_ext, edges_osm, edge_metric, max_distance, resultsdir)
+    elif workers > 1:
+        pairs, pair_dist = match_edges_parallel(edges_ext, edges_osm, edge_metric, max_distance, workers)
+    else:
+        pairs, pair_dist = match_edges(edges_ext, edges_osm, edge_metric, max_distance)
 
-    for edge_ext in edges_ext:
+    pair_ext = pairs[:, 0]
+    pair_osm = pairs[:, 1]
+
+    closest_osm, closest_osm_dist = find_closest_pairs(pair_ext, pair_osm, pair_dist, len(edges_ext))
+    set_closest_match_edges(edges_ext, edges_osm, closest_osm, closest_osm_dist)
 
-        x_start = edge_ext.coords_in_m[0][0]
-        y_start = edge_ext.coords_in_m[0][1]
-
-        x_end = edge_ext.coords_in_m[-1][0]
-        y_end = edge_ext.coords_in_m[-1][1]
-
-        ii_start_start = find_neighbors_in_tree(x_start, y_start, tree_osm_start, k, max_distance)
-        ii_end_end = find_neighbors_in_tree(x_end, y_end, tree_osm_end, k, max_distance)
-
-        ii_start_end = find_neighbors_in_tree(x_start, y_start, tree_osm_end, k, max_distance)
-        ii_end_start = find_neighbors_in_tree(x_end, y_end, tree_osm_start, k, max_distance)
-
-        match_ind_1 = np.intersect1d(ii_start_start, ii_end_end)
-        match_ind_2 = np.intersect1d(ii_start_end, ii_end_start)
-
-        match_ind = np.union1d(match_ind_1, match_ind_2)
-
-        nr_matches_edge = 0
-        for ii in match_ind:
-             edge_osm = edges_osm[ii]
-             if (edge_ext.ref_start == edge_osm.ref_start and edge_ext.ref_end == edge_osm.ref_end) or (edge_ext.ref_start == edge_osm.ref_end and edge_ext.ref_end == edge_osm.ref_start):
-                 #print(edge_ext.ref_start)
-                 #print(edge_ext.ref_end)
-                 dist = calculate_edge_to_edge_distance(edge_ext, edge_osm)
-                 if edge_ext.closest_match_dist != None:
-                     if dist < edge_ext.closest_match_dist:
-                         edge_ext.closest_match_edge = edge_osm
-                         edge_ext.closest_match_dist = dist
-                         nr_matches_edge = nr_matches_edge + 1
-                 else:
-                     edge_ext.closest_match_edge = edge_osm
-                     edge_ext.closest_match_dist = dist
-                     nr_matches_edge = nr_matches_edge + 1
-                 
-        #print("nr_matches_edge: "+str(nr_matches_edge))
-        #if nr_matches_edge > 1:
-        #    print("nr_matches_edge: "+str(nr_matches_edge))
-        #    print(edge_ext.ref_start)
-        #    print(edge_ext.ref_end)
-
-        #if match_ind.size == 1:
-        #    #print("alt:")
-        #    #print(match_ind)
-        #    edge_ext.closest_match_edge = edges_osm[match_ind[0]]
-
-    print("match osm")
-
-    tree_ext_start=create_tree_start_edge(edges_ext)
-    tree_ext_end=create_tree_end_edge(edges_ext)
-
-    for edge_osm in edges_osm:
-
-        x_start = edge_osm.coords_in_m[0][0]
-        y_start = edge_osm.coords_in_m[0][1]
-
-        x_end = edge_osm.coords_in_m[-1][0]
-        y_end = edge_osm.coords_in_m[-1][1]
-
-        ii_start_start = find_neighbors_in_tree(x_start, y_start, tree_ext_start, k, max_distance)
-        ii_end_end = find_neighbors_in_tree(x_end, y_end, tree_ext_end, k, max_distance)
-
-        ii_start_end = find_neighbors_in_tree(x_start, y_start, tree_ext_end, k, max_distance)
-        ii_end_start = find_neighbors_in_tree(x_end, y_end, tree_ext_start, k, max_distance)
-
-        match_ind_1 = np.intersect1d(ii_start_start, ii_end_end)
-        match_ind_2 = np.intersect1d(ii_start_end, ii_end_start)
-
-        match_ind = np.union1d(match_ind_1, match_ind_2)
-
-        nr_matches_edge = 0
-        for ii in match_ind:
-             edge_ext = edges_ext[ii]
-             if (edge_ext.ref_start == edge_osm.ref_start and edge_ext.ref_end == edge_osm.ref_end) or (edge_ext.ref_start == edge_osm.ref_end and edge_ext.ref_end == edge_osm.ref_start):
-
-                 dist = calculate_edge_to_edge_distance(edge_osm, edge_ext)
-                 if edge_osm.closest_match_dist != None:
-                     if dist < edge_osm.closest_match_dist:
-                         edge_osm.closest_match_edge = edge_ext
-                         edge_osm.closest_match_dist = dist
-                         nr_matches_edge = nr_matches_edge + 1
-                 else:
-                     edge_osm.closest_match_edge = edge_ext
-                     edge_osm.closest_match_dist = dist
-                     nr_matches_edge = nr_matches_edge + 1
-
-        #if nr_matches_edge > 1:
-        #    print("nr_matches_edge: "+str(nr_matches_edge))
-
-        #if match_ind.size == 1:
-        #    #print("alt:")
-        #    #print(match_ind)
-        #    edge_osm.closest_match_edge = edges_ext[match_ind[0]]
+    closest_ext, closest_ext_dist = find_closest_pairs(pair_osm, pair_ext, pair_dist, len(edges_osm))
+    set_closest_match_edges(edges_osm, edges_ext, closest_ext, closest_ext_dist)
         
     edge_changes_dict = dict()
     for key in ChangeType:
@@ -594,81 +737,67 @@ def do_analysis_edges(edges_osm, edges_ext, edges_osm_invalid, edges_ext_invalid
         print("{}: {}".format(key, len(edge_changes_dict[key])))
 
     exported_files = []
-    export_file = export_geojson_edges(edges_osm_invalid, "Invalid_osm.geojson")
+    export_file = export_geojson_edges(edges_osm_invalid, "Invalid_osm.geojson", resultsdir=resultsdir)
     exported_files.append(export_file)
-    export_file = export_geojson_edges(edges_ext_invalid, "Invalid_ext.geojson")
+    export_file = export_geojson_edges(edges_ext_invalid, "Invalid_ext.geojson", resultsdir=resultsdir)
     exported_files.append(export_file)
 
-    export_file = export_geojson_edges(invalid_edges_osm, "Unmatched_to_nodes_osm.geojson")
+    export_file = export_geojson_edges(invalid_edges_osm, "Unmatched_to_nodes_osm.geojson", resultsdir=resultsdir)
     exported_files.append(export_file)
-    export_file = export_geojson_edges(invalid_edges_ext, "Unmatched_to_nodes_ext.geojson")
+    export_file = export_geojson_edges(invalid_edges_ext, "Unmatched_to_nodes_ext.geojson", resultsdir=resultsdir)
     exported_files.append(export_file)
 
     for key in ChangeType:
         if key == ChangeType.REMOVED or key == ChangeType.REMOVED_DOUBLE:
-            export_file = export_geojson_edges(edge_changes_dict[key], "{}_osm.geojson".format(key))
+            export_file = export_geojson_edges(edge_changes_dict[key], "{}_osm.geojson".format(key), resultsdir=resultsdir)
         else:
-            export_file = export_geojson_edges(edge_changes_dict[key], "{}_ext.geojson".format(key))
+            export_file = export_geojson_edges(edge_changes_dict[key], "{}_ext.geojson".format(key), resultsdir=resultsdir)
         exported_files.append(export_file)
 
     return exported_files       
 
-def add_nodes_to_edges (nodes, edges):
-    tree_nodes = create_tree(nodes)
-    
-    max_distance = 20
+def add_nodes_to_edges(nodes, edges):
+    # Fill in the missing ref_start and ref_end of the edges with the ref of
+    # the closest node within max_distance (its rcn_ref if it has one).
+    # Returns the indices of the edges that have both refs, of the edges that
+    # do not, and the number of ambiguous endpoints: endpoints with a second
+    # node within max_distance that has a different ref.
+    nodes = NodeTable.from_nodes(nodes)
 
-    k = 2
+    max_distance = 20
 
-    for edge in edges:
-        if edge.ref_start == None:
-            x_start = edge.coords_in_m[0][0]
-            y_start = edge.coords_in_m[0][1]
-
-            ii = find_neighbors_in_tree(x_start, y_start, tree_nodes, k, max_distance)
-          
-            if (ii.size == 1) or (ii.size > 1 and nodes[ii[0]].rwn_ref == nodes[ii[0]].rwn_ref):                
-                node = nodes[ii[0]]
-                if node.rwn_ref:
-                    edge.ref_start = node.rwn_ref
-                if node.rcn_ref:
-                    edge.ref_start = node.rcn_ref
-            #else:
-            #    if ii.size > 1 and nodes[ii[0]].rwn_ref != nodes[ii[0]].rwn_ref:
-            #        edge.ref_start="abc"
-            #        print("add nodes to edges:")
-            #        #   print(edge.coords)
-            #        for i in ii:
-            #            print("rwn: "+nodes[i].rwn_ref)                  
-
-        if edge.ref_end == None:
-            x_end = edge.coords_in_m[-1][0]
-            y_end = edge.coords_in_m[-1][1]
-
-            ii = find_neighbors_in_tree(x_end, y_end, tree_nodes, k, max_distance)
-          
-            if (ii.size == 1) or (ii.size > 1 and nodes[ii[0]].rwn_ref == nodes[ii[0]].rwn_ref):
-                node = nodes[ii[0]]
-                if node.rwn_ref:
-                    edge.ref_end = node.rwn_ref
-                if node.rcn_ref:
-                    edge.ref_end = node.rcn_ref
-
-    #for edge in edges:
-        #if edge.ref_start == None and edge.ref_end != None:
-            #print("only ref_end: "+edge.ref_end)
-        #if edge.ref_start != None and edge.ref_end == None:
-            #print("only ref_start: "+edge.ref_start)
-
-    valid_edges = []
-    invalid_edges = []
-    for edge in edges:
-         if edge.ref_start and edge.ref_end:
-             valid_edges.append(edge)
-         else:
-             invalid_edges.append(edge)
+    # Ref of every node, -1 for nodes without a ref (None or ""). The extra
+    # row is for points without a node within max_distance.
+    empty = nodes.refs.ids.get("", -1)
+    has_rwn = (nodes.rwn_ref >= 0) & (nodes.rwn_ref != empty)
+    has_rcn = (nodes.rcn_ref >= 0) & (nodes.rcn_ref != empty)
+    node_refs = np.append(np.where(has_rcn, nodes.rcn_ref, np.where(has_rwn, nodes.rwn_ref, -1)), -1)
+
+    refs = [[edge.ref_start, edge.ref_end] for edge in edges]
+    missing = np.array([[ref_start == None, ref_end == None] for ref_start, ref_end in refs], dtype=bool).reshape(-1, 2)
+    edge_index, end = np.nonzero(missing)
+
+    n_ambiguous = 0
+    if len(edge_index) > 0 and len(nodes) > 0:
+        # All endpoints without a ref in one query, column end is 0 for the
+        # start and 1 for the end of the edge
+        xy = edge_endpoints(edges).reshape(-1, 2, 2)[edge_index, end]
+        dd, ii = create_tree(nodes).query(xy, k=2, distance_upper_bound=max_distance)
+
+        closest_ref = node_refs[ii[:, 0]]
+        second_ref = node_refs[ii[:, 1]]
+        n_ambiguous = int(np.count_nonzero((ii[:, 1] < len(nodes)) & (second_ref != closest_ref)))
+
+        for i in np.flatnonzero(closest_ref >= 0):
+            ref = nodes.refs.lookup(closest_ref[i])
+            refs[edge_index[i]][end[i]] = ref
+            if end[i] == 0:
+                edges[edge_index[i]].ref_start = ref
+            else:
+                edges[edge_index[i]].ref_end = ref
 
-    return valid_edges, invalid_edges
+    valid = np.array([bool(ref_start) and bool(ref_end) for ref_start, ref_end in refs], dtype=bool)
+    return np.flatnonzero(valid), np.flatnonzero(~valid), n_ambiguous
 
 def modify(l):
     output_list = []
@@ -712,43 +841,132 @@ def check_single_lines(edges):
     #print(single_lines)
     return single_lines
 
-def do_analysis(osmfilename, importfilename_nodes, osmfile_network, importfilename_network, filter_region, filter_province, progress):
-    #progress.emit("Importing data")
+def read_datasets(osmfilename, importfilename_nodes, osmfile_network, importfilename_network, workers=1):
+    # Read the input files, or load them from the cache. The GeoJSON files are
+    # kept as parsed arrays, from which select_datasets takes the nodes and
+    # edges of an area. OSM and PBF files are read as a whole, they are not
+    # filtered by area. PBF files are decoded with workers processes.
+    datasets = dict()
 
+    file_name_osm, file_extension_osm = os.path.splitext(osmfilename)
+
+    #print("file_extension", file_extension_osm);
+
+    if file_extension_osm == '.osm':
+        datasets["osm"] = read_osm(osmfilename) + (None, None)
+    elif file_extension_osm == '.pbf':
+        datasets["osm"] = read_pbf(osmfilename, read_edges=not osmfile_network, workers=workers)
+    else:
+        # The edges of the OSM file are not needed if there is a separate network file
+        datasets["osm"] = load_geojson(osmfilename, rwn_name="knooppuntnummer", rcn_name="knooppuntnr")
+
+    if osmfile_network and osmfile_network.endswith('.pbf'):
+        datasets["osm_network"] = read_pbf(osmfile_network, read_nodes=False, workers=workers)[2:]
+    elif osmfile_network:
+        datasets["osm_network"] = load_geojson(osmfile_network, rwn_name="knooppuntnummer", rcn_name="knooppuntnr")
+
+    datasets["ext"] = load_geojson(importfilename_nodes, rwn_name="knooppuntnummer", rcn_name="knooppuntnr")
+
+    if importfilename_network:
+        datasets["ext_network"] = load_geojson(importfilename_network, rwn_name="knooppuntnummer", rcn_name="knooppuntnr")
+
+    return datasets
+
+def area_extent(nodes):
+    # Lower and upper corner (in m) of the extent of the node tables, plus
+    # area_margin. None if there are no nodes.
+    xy = np.concatenate([table.xy for table in nodes])
+    if len(xy) == 0:
+        return None
+
+    return xy.min(axis=0) - area_margin, xy.max(axis=0) + area_margin
+
+def nodes_in_extent(nodes, extent):
+    # New table with the nodes within the extent (see area_extent)
+    if extent is None:
+        return nodes.take(np.zeros(0, dtype=np.int64))
+
+    low, high = extent
+    return nodes.take(np.flatnonzero(np.all((nodes.xy >= low) & (nodes.xy <= high), axis=1)))
+
+def edges_in_extent(edges, extent):
+    # The edges of which the bounding box overlaps the extent
+    if extent is None or not edges:
+        return []
+
+    # Bounding box of every edge, per table
+    boxes = dict()
+    for table in set(edge.table for edge in edges):
+        starts = table.offsets[:-1]
+        boxes[table] = (np.minimum.reduceat(table.vertices_in_m, starts), np.maximum.reduceat(table.vertices_in_m, starts))
+
+    low, high = extent
+    return [edge for edge in edges if np.all(boxes[edge.table][0][edge.index] <= high) and np.all(boxes[edge.table][1][edge.index] >= low)]
+
+def select_datasets(datasets, filter_region, filter_province):
+    # Nodes and edges of the datasets (see read_datasets) in the region and
+    # province. OSM data often has no region or province (OSM and PBF files
+    # never), with a filter the OSM nodes and edges are limited to the extent
+    # of the import nodes instead (see area_extent).
     nodes_osm = None
     nodes_ext = None
 
     edges_osm = None
     edges_ext = None
+    edges_osm_invalid = None
+    edges_ext_invalid = None
 
-    file_name_osm, file_extension_osm = os.path.splitext(osmfilename)
-
-    #print("file_extension", file_extension_osm);
+    osm_network = datasets.get("osm_network")
+    if isinstance(datasets["osm"], tuple):
+        nodes_osm, nodes_osm_invalid, edges_osm, edges_osm_invalid = datasets["osm"]
+    else:
+        nodes_osm, nodes_osm_invalid, edges_osm, edges_osm_invalid = select_geojson(datasets["osm"], filter_region, filter_province, read_edges=osm_network is None)
 
-    if osmfilename:
-       if file_extension_osm == '.osm':
-           nodes_osm = import_osm(osmfilename)
-       else:
-           #nodes_osm, nodes_osm_invalid = import_geojson(osmfilename, rwn_name="knooppuntnummer", rcn_name="knooppuntnr", filter_regio=filter_region, filter_province=filter_province)
-           nodes_osm, nodes_osm_invalid, edges_osm, edges_osm_invalid = import_geojson_combined(osmfilename, rwn_name="knooppuntnummer", rcn_name="knooppuntnr", filter_regio=filter_region, filter_province=filter_province)           
+    if isinstance(osm_network, tuple):
+        edges_osm, edges_osm_invalid = osm_network
+    elif osm_network is not None:
+        _, _, edges_osm, edges_osm_invalid = select_geojson(osm_network, filter_region, filter_province, read_nodes=False)
 
-    if osmfile_network:
-        edges_osm, edges_osm_invalid = import_geojson_netwerken(osmfile_network, rwn_name="knooppuntnummer", rcn_name="knooppuntnr", filter_regio=filter_region, filter_province=filter_province)
+    if edges_osm is not None:
+        print("Import OSM done: nodes "+str(len(nodes_osm))+" edges "+str(len(edges_osm))+ " invalid nodes "+str(len(nodes_osm_invalid))+" invalid edges "+str(len(edges_osm_invalid)))
+    else:
+        print("Import OSM done: nodes "+str(len(nodes_osm))+" edges "+str(0)+ " invalid nodes "+str(len(nodes_osm_invalid)))
 
-    print("Import OSM done: nodes "+str(len(nodes_osm))+" edges "+str(len(edges_osm))+ " invalid nodes "+str(len(nodes_osm_invalid))+" invalid edges "+str(len(edges_osm_invalid)))
+    nodes_ext, nodes_ext_invalid, _, _ = select_geojson(datasets["ext"], filter_region, filter_province, read_edges=False, skip_unnumbered=False)
 
-    nodes_ext, nodes_ext_invalid = import_geojson(importfilename_nodes, rwn_name="knooppuntnummer", rcn_name="knooppuntnr", filter_regio=filter_region, filter_province=filter_province)
+    if filter_region or filter_province:
+        extent = area_extent([nodes_ext, nodes_ext_invalid])
+        nodes_osm = nodes_in_extent(nodes_osm, extent)
+        nodes_osm_invalid = nodes_in_extent(nodes_osm_invalid, extent)
+        if edges_osm is not None:
+            edges_osm = edges_in_extent(edges_osm, extent)
+            edges_osm_invalid = edges_in_extent(edges_osm_invalid, extent)
+        print("OSM data within {} m of the import nodes: nodes {} invalid nodes {}".format(area_margin, len(nodes_osm), len(nodes_osm_invalid)))
 
-    if importfilename_network:
-        edges_ext, edges_ext_invalid = import_geojson_netwerken(importfilename_network, rwn_name="knooppuntnummer", rcn_name="knooppuntnr", filter_regio=filter_region, filter_province=filter_province)
+    if "ext_network" in datasets:
+        _, _, edges_ext, edges_ext_invalid = select_geojson(datasets["ext_network"], filter_region, filter_province, read_nodes=False)
 
     if edges_ext:
         print("Import EXT done: nodes "+str(len(nodes_ext))+" edges "+str(len(edges_ext))+ " invalid nodes "+str(len(nodes_ext_invalid))+         " invalid edges "+str(len(edges_ext_invalid)))
     else:
         print("Import EXT done: nodes "+str(len(nodes_ext))+" edges "+str(0)+ " invalid nodes "+str(len(nodes_ext_invalid)))
 
-    if nodes_osm and nodes_ext:
-        exported_files = do_analysis_internal(nodes_osm, nodes_ext, nodes_osm_invalid, nodes_ext_invalid, progress)
+    return nodes_osm, nodes_osm_invalid, edges_osm, edges_osm_invalid, nodes_ext, nodes_ext_invalid, edges_ext, edges_ext_invalid
+
+def analyze_datasets(nodes_osm, nodes_osm_invalid, edges_osm, edges_osm_invalid, nodes_ext, nodes_ext_invalid, edges_ext, edges_ext_invalid, progress, resultsdir="results",
+                     edge_metric="sampled", workers=1, incremental=False):
+    # Compare the nodes and edges and export the results to resultsdir.
+    # edge_metric is a key of compare.edge_metrics, workers the number of
+    # processes (with 1 it runs in this process). With incremental, the
+    # results of the previous incremental run in resultsdir are reused for
+    # the nodes and edges that did not change. Returns the exported files of
+    # the nodes and of the edges.
+    exported_files = []
+    exported_edge_files = []
+
+    # Without OSM nodes (near the area), all import nodes are added
+    if nodes_osm is not None and nodes_ext:
+        exported_files = do_analysis_internal(nodes_osm, nodes_ext, nodes_osm_invalid, nodes_ext_invalid, progress, resultsdir, workers, incremental)
 
     #if edges_osm:
     #    check_single_lines(edges_osm)
@@ -757,17 +975,34 @@ def do_analysis(osmfilename, importfilename_nodes, osmfile_network, importfilena
     #    check_single_lines(edges_ext)
 
     if nodes_osm and edges_osm:
-        valid_edges_osm, invalid_edges_osm = add_nodes_to_edges(nodes_osm, edges_osm)
-        print("Add OSM nodes to edges: invalid edges "+str(len(invalid_edges_osm )))
+        valid, invalid, n_ambiguous = add_nodes_to_edges(nodes_osm, edges_osm)
+        valid_edges_osm = [edges_osm[i] for i in valid]
+        invalid_edges_osm = [edges_osm[i] for i in invalid]
+        print("Add OSM nodes to edges: invalid edges "+str(len(invalid_edges_osm ))+" ambiguous endpoints "+str(n_ambiguous))
 
     if nodes_ext and edges_ext:
-        valid_edges_ext, invalid_edges_ext = add_nodes_to_edges(nodes_ext, edges_ext)
-        print("Add EXT nodes to edges: invalid edges "+str(len(invalid_edges_ext )))
+        valid, invalid, n_ambiguous = add_nodes_to_edges(nodes_ext, edges_ext)
+        valid_edges_ext = [edges_ext[i] for i in valid]
+        invalid_edges_ext = [edges_ext[i] for i in invalid]
+        print("Add EXT nodes to edges: invalid edges "+str(len(invalid_edges_ext ))+" ambiguous endpoints "+str(n_ambiguous))
 
     #export_geojson_edges(invalid_edges_ext, "invalid_edges_ext.geojson")
 
     if edges_osm and edges_ext:
-        do_analysis_edges(valid_edges_osm, valid_edges_ext, edges_osm_invalid, edges_ext_invalid, invalid_edges_osm, invalid_edges_ext, progress)
+        exported_edge_files = do_analysis_edges(valid_edges_osm, valid_edges_ext, edges_osm_invalid, edges_ext_invalid, invalid_edges_osm, invalid_edges_ext, progress, resultsdir,
+                                                edge_metric, workers, incremental)
+
+    return exported_files, exported_edge_files
+
+def do_analysis(osmfilename, importfilename_nodes, osmfile_network, importfilename_network, filter_region, filter_province, progress, resultsdir="results",
+                edge_metric="sampled", workers=1, incremental=False):
+    # Settings as in analyze_datasets
+    #progress.emit("Importing data")
+    datasets = read_datasets(osmfilename, importfilename_nodes, osmfile_network, importfilename_network, workers)
+    nodes_osm, nodes_osm_invalid, edges_osm, edges_osm_invalid, nodes_ext, nodes_ext_invalid, edges_ext, edges_ext_invalid = select_datasets(datasets, filter_region, filter_province)
+
+    exported_files, _ = analyze_datasets(nodes_osm, nodes_osm_invalid, edges_osm, edges_osm_invalid, nodes_ext, nodes_ext_invalid, edges_ext, edges_ext_invalid, progress, resultsdir,
+                                         edge_metric, workers, incremental)
 
     if nodes_osm:
        print("OSM dataset:", osmfilename, "({} nodes)".format(len(nodes_osm)))
@@ -779,3 +1014,7 @@ def do_analysis(osmfilename, importfilename_nodes, osmfile_network, importfilena
     print()
 
     return exported_files
+
+def area_directory(area):
+    # Name of the results folder of an area
+    return "".join(c if c.isalnum() or c in " -_." else "_" for c in area)
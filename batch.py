@@ -0,0 +1,83 @@
+import os
+import csv
+import numpy as np
+from analyze import read_datasets, select_datasets, analyze_datasets, area_directory
+from import_geojson import geojson_areas
+from edge import EdgeTable, pack_edges
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+
+def copy_area(datasets):
+    # Copies of the nodes and edges of an area (see select_datasets), so the
+    # analysis of one area does not change the tables of another one, and
+    # only the area is sent to another process
+    def copy_nodes(nodes):
+        return nodes.take(np.arange(len(nodes))) if nodes is not None else None
+
+    def copy_edges(edges):
+        return list(EdgeTable(*pack_edges(edges))) if edges is not None else None
+
+    nodes_osm, nodes_osm_invalid, edges_osm, edges_osm_invalid, nodes_ext, nodes_ext_invalid, edges_ext, edges_ext_invalid = datasets
+    return (copy_nodes(nodes_osm), copy_nodes(nodes_osm_invalid), copy_edges(edges_osm), copy_edges(edges_osm_invalid),
+            copy_nodes(nodes_ext), copy_nodes(nodes_ext_invalid), copy_edges(edges_ext), copy_edges(edges_ext_invalid))
+
+def analyze_area(area, resultsdir, datasets, edge_metric, incremental):
+    # analyze_datasets for an area, in one process. Returns the number of
+    # nodes or edges in every exported file, by path relative to resultsdir.
+    print("Area", area)
+    exported_files, exported_edge_files = analyze_datasets(*datasets, None, resultsdir, edge_metric, 1, incremental)
+    return dict((os.path.relpath(file.filepath, resultsdir), file.n_nodes) for file in exported_files + exported_edge_files)
+
+def do_analysis_batch(osmfilename, importfilename_nodes, osmfile_network, importfilename_network, area_type, filter_region, filter_province, progress, resultsdir="results",
+                      edge_metric="sampled", workers=1, incremental=False):
+    # Analyze every province (area_type "province") or region ("region") of
+    # the import data, with the results of each in its own folder in
+    # resultsdir. The input files are read once. With more than one worker the
+    # areas are analyzed in parallel. The number of nodes or edges in every
+    # result file per area is written to summary.csv in resultsdir. The other
+    # settings are as in analyze.analyze_datasets.
+    datasets = read_datasets(osmfilename, importfilename_nodes, osmfile_network, importfilename_network, workers)
+    areas = geojson_areas(datasets["ext"], "regio" if area_type == "region" else "province")
+    print("Analyzing {} areas: {}".format(len(areas), ", ".join(areas)))
+
+    def tasks():
+        for area in areas:
+            if area_type == "region":
+                selected = select_datasets(datasets, area, filter_province)
+            else:
+                selected = select_datasets(datasets, filter_region, area)
+            yield area, os.path.join(resultsdir, area_directory(area)), copy_area(selected), edge_metric, incremental
+
+    counts = []
+    if workers > 1:
+        # Only a few areas at a time are selected ahead, to bound the memory
+        # that is used for the copies
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = deque()
+            for task in tasks():
+                futures.append(executor.submit(analyze_area, *task))
+                if len(futures) >= workers:
+                    counts.append(futures.popleft().result())
+            counts.extend(future.result() for future in futures)
+    else:
+        counts = [analyze_area(*task) for task in tasks()]
+
+    # One column per result file, in the order they are exported
+    columns = []
+    for area_counts in counts:
+        columns.extend(name for name in area_counts if name not in columns)
+
+    try:
+        os.makedirs(resultsdir)
+    except FileExistsError:
+        pass # The directory already exists, move on
+
+    filepath = os.path.join(resultsdir, "summary.csv")
+    with open(filepath, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([area_type] + [name.replace(os.sep, "/") for name in columns])
+        for area, area_counts in zip(areas, counts):
+            writer.writerow([area] + [area_counts.get(name, 0) for name in columns])
+
+    print("Summary of {} areas written to {}".format(len(areas), filepath))
+    return filepath
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import struct
+import zipfile
+import numpy as np
+
+# Directory for the binary snapshots of parsed input files. With None, input
+# files are always parsed.
+cache_dir = None
+
+# Increase when the arrays that are stored change
+cache_version = 2
+
+# Arrays of at least this size (in bytes) are memory mapped when loaded
+mmap_size = 1 << 16
+
+def file_hash(filename):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def cache_path(filename, kind):
+    # The directory of the input file is part of the name, so files with the
+    # same name do not overwrite each others snapshot
+    directory = hashlib.blake2b(os.path.dirname(os.path.abspath(filename)).encode("utf8"), digest_size=4).hexdigest()
+    return os.path.join(cache_dir, "{}.{}.{}.npz".format(os.path.basename(filename), directory, kind))
+
+def load_npz(path):
+    # Load the arrays of an uncompressed .npz file (as written by np.savez).
+    # Large arrays are memory mapped from the file instead of read.
+    arrays = dict()
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as file:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("compressed member " + info.filename)
+
+            # Skip the local file header to get to the .npy data
+            file.seek(info.header_offset)
+            name_length, extra_length = struct.unpack("<HH", file.read(30)[26:30])
+            start = info.header_offset + 30 + name_length + extra_length
+
+            file.seek(start)
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+
+            name = info.filename[:-len(".npy")]
+            if dtype.hasobject:
+                raise ValueError("object array " + name)
+            elif len(shape) > 0 and int(np.prod(shape)) * dtype.itemsize >= max(mmap_size, 1):
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=file.tell(), shape=shape, order='F' if fortran_order else 'C')
+            else:
+                file.seek(start)
+                arrays[name] = np.lib.format.read_array(file, allow_pickle=False)
+
+    return arrays
+
+def load_snapshot(filename, kind):
+    # Arrays of the snapshot of a file, None if there is no snapshot or it
+    # belongs to an older version of the file
+    path = cache_path(filename, kind)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        arrays = load_npz(path)
+    except (OSError, ValueError, zipfile.BadZipFile) as er:
+        print("Ignoring cache file", path, er)
+        return None
+
+    # Files without these keys are not snapshots (of this program)
+    if arrays.pop("cache_version", None) != cache_version or "source_hash" not in arrays or "source_stat" not in arrays:
+        return None
+
+    # The content hash is only computed if the file has been touched
+    stat = os.stat(filename)
+    source_hash = str(arrays.pop("source_hash"))
+    source_stat = arrays.pop("source_stat").tolist()
+    if source_stat != [stat.st_size, stat.st_mtime_ns]:
+        if file_hash(filename) != source_hash:
+            return None
+        save_snapshot(filename, kind, arrays, source_hash)
+
+    return arrays
+
+def save_snapshot(filename, kind, arrays, source_hash=None):
+    try:
+        os.mkdir(cache_dir)
+    except FileExistsError:
+        pass # The directory already exists, move on
+
+    stat = os.stat(filename)
+    if source_hash is None:
+        source_hash = file_hash(filename)
+
+    path = cache_path(filename, kind)
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, 'wb') as file:
+            np.savez(file, cache_version=cache_version, source_hash=source_hash,
+                     source_stat=np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64), **arrays)
+        os.replace(temp_path, path)
+    except IOError as er:
+        print("Could not write cache file", path, er)
+
+def cached(filename, kind, parse):
+    # Arrays of a parsed file, from the snapshot in the cache directory if
+    # it is up to date. Otherwise parse(filename) is called and its arrays
+    # are stored for the next run.
+    if cache_dir is None:
+        return parse(filename)
+
+    arrays = load_snapshot(filename, kind)
+    if arrays is not None:
+        print("Loaded", filename, "from cache")
+        return arrays
+
+    arrays = parse(filename)
+    save_snapshot(filename, kind, arrays)
+    return arrays
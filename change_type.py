@@ -0,0 +1,86 @@
+from enum import Enum
+
+class ChangeType(Enum):
+    # No significant change
+    NO = 1
+
+    # Exists in OSM dataset, but does not exist in import dataset and is not renamed
+    REMOVED = 2
+
+    # Does not exist in OSM dataset, but does exist in import dataset and is not renamed
+    ADDED = 3
+
+    # Close to node in other dataset with a different name. The other node
+    # doesn't have a matching node either. Minor renames are classified as RENAMED_MINOR
+    RENAMED = 4
+
+    # Same as renamed, but used for minor renames. This is used when the
+    # difference is just a couple of letters. When it's a different number,
+    # it's classified as a normal rename.
+    RENAMED_MINOR = 5
+
+    # Matches with a node in the other dataset with distance 1-20m
+    MOVED_SHORT = 6
+
+    # Matches with a node in the other dataset with distance 20-100m
+    MOVED_MEDIUM = 7
+
+    # Matches with a node in the other dataset with distance 100-1000m
+    MOVED_LONG = 8
+
+    # Matches with a node in the other dataset with distance < 60 however another node also matches with smaller distance
+    ADDED_DOUBLE = 9
+
+    # Matches with a node in the other dataset with distance > 60 and < 500 however another node also matches with smaller distance
+    ADDED_DOUBLE_LONG = 10
+
+    # Matches with a node in the other dataset with distance < 60 however that node does not match with it
+    REMOVED_DOUBLE = 11
+
+    # Matches with a node in the other dataset with distance > 60 and < 500 however that node does not match with it
+    REMOVED_DOUBLE_LONG = 12
+
+    # None of the others
+    OTHER = 13
+
+    def __str__(self):
+        if self == ChangeType.NO:
+            return "No change"
+
+        if self == ChangeType.REMOVED:
+            return "Removed"
+
+        if self == ChangeType.ADDED:
+            return "Added"
+
+        if self == ChangeType.RENAMED:
+            return "Renamed"
+
+        if self == ChangeType.RENAMED_MINOR:
+            return "Minor rename"
+
+        if self == ChangeType.MOVED_SHORT:
+            return "Moved short distance"
+
+        if self == ChangeType.MOVED_MEDIUM:
+            return "Moved medium distance"
+
+        if self == ChangeType.MOVED_LONG:
+            return "Moved long distance"
+
+        if self == ChangeType.ADDED_DOUBLE:
+            return "Added double"
+
+        if self == ChangeType.REMOVED_DOUBLE:
+            return "Removed double"
+
+        if self == ChangeType.ADDED_DOUBLE_LONG:
+            return "Added double long distance"
+
+        if self == ChangeType.REMOVED_DOUBLE_LONG:
+            return "Removed double long distance"
+
+        if self == ChangeType.OTHER:
+            return "Other"
+
+        return "Unknown enum value: {}".format(self.value)
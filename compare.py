@@ -1,4 +1,5 @@
 import math
+from itertools import chain
 from scipy.spatial import KDTree
 import numpy as np
 from rijksdriehoek import rijksdriehoek
@@ -14,6 +15,57 @@ def convert_rd_to_wgs(coords):
     
     return coords_in_wgs
     
+# Coefficients of the RD to WGS84 approximation, the same as used by the
+# rijksdriehoek package: (p, q, coefficient) for dx**p * dy**q
+rd_x0 = 155000
+rd_y0 = 463000
+rd_phi0 = 52.15517440
+rd_lam0 = 5.38720621
+
+rd_pqk = [(0, 1, 3235.65389),
+          (2, 0, -32.58297),
+          (0, 2, -0.24750),
+          (2, 1, -0.84978),
+          (0, 3, -0.06550),
+          (2, 2, -0.01709),
+          (1, 0, -0.00738),
+          (4, 0, 0.00530),
+          (2, 3, -0.00039),
+          (4, 1, 0.00033),
+          (1, 1, -0.00012)]
+
+rd_pql = [(1, 0, 5260.52916),
+          (1, 1, 105.94684),
+          (1, 2, 2.45656),
+          (3, 0, -0.81885),
+          (1, 3, 0.05594),
+          (3, 1, -0.05607),
+          (0, 1, 0.01199),
+          (3, 2, -0.00256),
+          (1, 4, 0.00128),
+          (0, 2, 0.00022),
+          (2, 0, -0.00022),
+          (5, 0, 0.00026)]
+
+def convert_rd_to_wgs_array(coords):
+    # Convert an (n, 2) array of RD x/y to lon/lat in one pass. Gives the
+    # same results as convert_rd_to_wgs, which converts point by point.
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+
+    dx = 1E-5 * (coords[:, 0] - rd_x0)
+    dy = 1E-5 * (coords[:, 1] - rd_y0)
+
+    phi = np.full(len(coords), rd_phi0)
+    lam = np.full(len(coords), rd_lam0)
+
+    for p, q, k in rd_pqk:
+        phi += k * dx**p * dy**q / 3600
+
+    for p, q, l in rd_pql:
+        lam += l * dx**p * dy**q / 3600
+
+    return np.column_stack((lam, phi))
+
 def dist_complicated(lat1, lon1, lat2, lon2):
     lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
 
@@ -25,19 +77,38 @@ def dist_complicated(lat1, lon1, lat2, lon2):
     km = 6371* c
     return 1000 * km
 
-def convert_to_m (coords):
-    coords_in_m = []
+def dist_complicated_array(lat1, lon1, lat2, lon2):
+    # Same as dist_complicated, for NumPy arrays. The arguments are broadcast,
+    # so aligned arrays give pairwise distances and a single point against
+    # arrays gives the distances from that point to all others.
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
+    km = 6371* c
+    return 1000 * km
+
+def convert_to_m_array(lonlat):
+    # Project an (n, 2) array of lon/lat in degrees to x/y in m in one pass.
+    # This also takes the flat vertex buffer of all edges of a file.
+    lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+
+    lon_rad = np.radians(lonlat[:, 0])
+    lat_rad = np.radians(lonlat[:, 1])
+
+    coords_in_m = np.empty_like(lonlat)
+    coords_in_m[:, 0] = 1000 * 6371 * np.cos(lat_rad) * lon_rad
+    coords_in_m[:, 1] = 1000 * 6371 * lat_rad
 
-    for lonlat in coords:
-        lon_rad, lat_rad = map(math.radians, [lonlat[0], lonlat[1]])
-      
-        x_in_m = 1000 * 6371 * math.cos(lat_rad) * lon_rad
-        y_in_m = 1000 * 6371 * lat_rad
- 
-        coords_in_m.append((x_in_m, y_in_m))
-    
     return coords_in_m
 
+def convert_to_m (coords):
+    coords = [(lonlat[0], lonlat[1]) for lonlat in coords]
+
+    return [tuple(xy) for xy in convert_to_m_array(coords).tolist()]
+
 def dist_simple_sq(lat1, lon1, lat2, lon2):
     # approximate squared distance
     # exact formula in function dist_complicated
@@ -48,21 +119,31 @@ def dist_simple_sq(lat1, lon1, lat2, lon2):
     dlat = lat2 - lat1
     return 0.38*dlon**2 + dlat**2
 
+def dist_simple_sq_array(lat1, lon1, lat2, lon2):
+    # Same as dist_simple_sq, for NumPy arrays (broadcast like dist_complicated_array)
+    dlon = np.subtract(lon2, lon1)
+    dlat = np.subtract(lat2, lat1)
+    return 0.38*dlon**2 + dlat**2
+
+def node_coordinates(nodes):
+    # Latitudes and longitudes of a NodeTable or a list of nodes as arrays
+    if hasattr(nodes, "xy"):
+        return nodes.lat, nodes.lon
+
+    return np.array([node.lat for node in nodes], dtype=np.float64), np.array([node.lon for node in nodes], dtype=np.float64)
+
 def find_matching_point(node_ext, nodes_osm):
-    closest_node = None
-    best_dist_sq = math.inf
-    for node in nodes_osm:
-        if node.rwn_ref and node.rwn_ref != "-1" and node.rwn_ref == node_ext.rwn_ref or \
-            node.rcn_ref and node.rcn_ref != "-1" and node.rcn_ref == node_ext.rcn_ref:
-            dist_sq = dist_simple_sq(node.lat, node.lon, node_ext.lat, node_ext.lon)
-            if dist_sq < best_dist_sq:
-                best_dist_sq = dist_sq
-                closest_node = node
+    candidates = [i for i, node in enumerate(nodes_osm) if
+            node.rwn_ref and node.rwn_ref != "-1" and node.rwn_ref == node_ext.rwn_ref or \
+            node.rcn_ref and node.rcn_ref != "-1" and node.rcn_ref == node_ext.rcn_ref]
 
-    if closest_node:
-        actual_dist = dist_complicated(closest_node.lat, closest_node.lon, node_ext.lat, node_ext.lon)
+    if not candidates:
+        return None
 
-    return closest_node
+    lat, lon = node_coordinates(nodes_osm)
+    dist_sq = dist_simple_sq_array(lat[candidates], lon[candidates], node_ext.lat, node_ext.lon)
+
+    return nodes_osm[candidates[np.argmin(dist_sq)]]
 
 def find_matching_nodes(nodes_osm, nodes_ext):
     
@@ -74,30 +155,35 @@ def find_matching_nodes(nodes_osm, nodes_ext):
         node.closest_match_dist = None
         node.closest_match_node = None
 
+    # Only nodes with the same number can match, so group them by number
+    nodes_osm_by_ref = dict()
+    for node in nodes_osm:
+        for key in (("rwn", node.rwn_ref), ("rcn", node.rcn_ref)):
+            if key[1] and key[1] != "-1":
+                nodes_osm_by_ref.setdefault(key, []).append(node)
+
     for node_ext in nodes_ext:
-        for node in nodes_osm:
-
-            if node.rwn_ref and node.rwn_ref != "-1" and node.rwn_ref == node_ext.rwn_ref or \
-                node.rcn_ref and node.rcn_ref != "-1" and node.rcn_ref == node_ext.rcn_ref:
-                dist_sq = dist_simple_sq(node.lat, node.lon, node_ext.lat, node_ext.lon)
-                #dist=dist_complicated(node.lat, node.lon, node_ext.lat, node_ext.lon)
-                #dist_sq=dist
-
-                if node_ext.closest_match_dist != None:
-                    if dist_sq < node_ext.closest_match_dist:
-                        node_ext.closest_match_dist = dist_sq
-                        node_ext.closest_match_node = node
-                else:
+        candidates = nodes_osm_by_ref.get(("rwn", node_ext.rwn_ref), []) + nodes_osm_by_ref.get(("rcn", node_ext.rcn_ref), [])
+        for node in candidates:
+            dist_sq = dist_simple_sq(node.lat, node.lon, node_ext.lat, node_ext.lon)
+            #dist=dist_complicated(node.lat, node.lon, node_ext.lat, node_ext.lon)
+            #dist_sq=dist
+
+            if node_ext.closest_match_dist != None:
+                if dist_sq < node_ext.closest_match_dist:
                     node_ext.closest_match_dist = dist_sq
                     node_ext.closest_match_node = node
-                    
-                if node.closest_match_dist != None:
-                    if dist_sq < node.closest_match_dist:
-                        node.closest_match_dist = dist_sq
-                        node.closest_match_node = node_ext
-                else:
+            else:
+                node_ext.closest_match_dist = dist_sq
+                node_ext.closest_match_node = node
+                
+            if node.closest_match_dist != None:
+                if dist_sq < node.closest_match_dist:
                     node.closest_match_dist = dist_sq
                     node.closest_match_node = node_ext
+            else:
+                node.closest_match_dist = dist_sq
+                node.closest_match_node = node_ext
 
     for node in nodes_osm:
         if node.closest_match_node:
@@ -112,15 +198,13 @@ def find_matching_nodes(nodes_osm, nodes_ext):
 
 # Returns the closest node from the given node
 def find_closest_node(node, comparison_nodes):
-    closest_node = None
-    best_dist_sq = math.inf
-    for n in comparison_nodes:
-        dist_sq = dist_simple_sq(node.lat, node.lon, n.lat, n.lon)
-        if dist_sq < best_dist_sq:
-            best_dist_sq = dist_sq
-            closest_node = n
+    if len(comparison_nodes) == 0:
+        return None
 
-    return closest_node
+    lat, lon = node_coordinates(comparison_nodes)
+    dist_sq = dist_simple_sq_array(node.lat, node.lon, lat, lon)
+
+    return comparison_nodes[int(np.argmin(dist_sq))]
 
 def find_closest_node_using_tree(node, comparison_nodes, comparison_tree):
     dd, ii = comparison_tree.query([[node.lon_in_m, node.lat_in_m]], k=1)
@@ -129,83 +213,477 @@ def find_closest_node_using_tree(node, comparison_nodes, comparison_tree):
 
     return closest_node
 
-def create_tree(nodes):
-        n = len(nodes)
-        #print(n)
-        xy_points=np.zeros((n,2))
-        i=0
-        for node in nodes:
-            i=i+1
-            xy_points[i-1][0]=node.lon_in_m 
-            xy_points[i-1][1]=node.lat_in_m
-        tree = KDTree(xy_points)
-        return tree
+def query_in_order(tree, points, k, distance_upper_bound=math.inf):
+    # KDTree.query for the k closest points, as (n, k) arrays, where points
+    # at the same distance are ordered by index. The tree itself returns
+    # them in an order that depends on its shape, so without this the result
+    # would depend on the other points in the tree. One more point is
+    # queried to see the ties; only rows with ties are sorted again.
+    n = len(points)
+    dd, ii = tree.query(points, k=k + 1, distance_upper_bound=distance_upper_bound)
+    dd = dd.reshape(n, k + 1)
+    ii = ii.reshape(n, k + 1)
+
+    tied = np.any((dd[:, 1:] == dd[:, :-1]) & np.isfinite(dd[:, 1:]), axis=1)
+    for row in np.flatnonzero(tied):
+        # All points up to the k-th distance, with the distance calculated
+        # as the tree does
+        index = np.array(tree.query_ball_point(points[row], dd[row, k - 1] * (1 + 1e-9)), dtype=np.int64)
+        delta = tree.data[index] - points[row]
+        dist = np.sqrt((delta * delta).sum(axis=1))
+        order = np.lexsort((index, dist))[:k]
+
+        dd[row] = math.inf
+        ii[row] = tree.n
+        dd[row, :len(order)] = dist[order]
+        ii[row, :len(order)] = index[order]
+
+    return dd[:, :k], ii[:, :k]
+
+def find_closest_nodes_using_tree(nodes, comparison_nodes, comparison_tree, k=1):
+    # Find the k closest comparison nodes of all nodes in one batched query.
+    # Returns (n, k) arrays with the distances in m and the indices of the
+    # closest nodes, closest first. Missing neighbours have index -1.
+    n = len(nodes)
+    if n == 0 or len(comparison_nodes) == 0:
+        return np.full((n, k), np.nan), np.full((n, k), -1, dtype=np.int64)
+
+    dd, ii = query_in_order(comparison_tree, nodes.xy, k)
+
+    found = ii < len(comparison_nodes)
+    index = np.where(found, ii, -1)
+
+    j = np.where(found, ii, 0)
+    dist = dist_complicated_array(comparison_nodes.lat[j], comparison_nodes.lon[j], nodes.lat[:, np.newaxis], nodes.lon[:, np.newaxis])
+    dist[~found] = np.nan
+
+    return dist, index
 
-def find_matching_nodes_using_tree(nodes_osm, nodes_ext, tree_osm, tree_ext):
-        
-    for node in nodes_osm:
-        node.closest_match_dist = None
-        node.closest_match_node = None
-
-    for node in nodes_ext:
-        node.closest_match_dist = None
-        node.closest_match_node = None
-
-    max_distance = 3000
-    k_start = 10
-
-    for node_ext in nodes_ext:
-
-        k_val = k_start
-        
-        while True:
-            dd, ii = tree_osm.query([[node_ext.lon_in_m, node_ext.lat_in_m]], k = k_val, distance_upper_bound=max_distance)
-            if ii[0][-1] >=len(nodes_osm):
-                break
-            else:
-                k_val=k_val*2
-           
-        #for node_index in np.nditer(ii):
-
-        for node_index in ii[0]:
-            #print("node_index: ")
-            #print(node_index)
-
-            if node_index>=len(nodes_osm):
-                break
-
-            node = nodes_osm[node_index]
-   
-            if node.rwn_ref and node.rwn_ref != "-1" and node.rwn_ref == node_ext.rwn_ref or \
-                node.rcn_ref and node.rcn_ref != "-1" and node.rcn_ref == node_ext.rcn_ref:
-                
-                node_ext.closest_match_node = node
-                node_ext.closest_match_dist = dist_complicated(node.lat, node.lon, node_ext.lat, node_ext.lon)
+def create_tree(nodes):
+        return KDTree(nodes.xy)
+
+class RefIndex():
+    # Spatial index of a set of nodes, keyed by (network type, ref number).
+    # The nodes of a network are in one KD tree, with the ref number as a
+    # third coordinate that puts different numbers separation m apart. So a
+    # lookup only finds nodes with the same number, at any distance, and a
+    # set of nodes is searched in one query.
+
+    # Far more than any distance between two nodes
+    separation = 1e8
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.trees = dict()
+
+        xy = nodes.xy
+        for network, column in (("rwn", nodes.rwn_ref), ("rcn", nodes.rcn_ref)):
+            index = np.flatnonzero(nodes.matchable_refs(column) >= 0)
+            if len(index) > 0:
+                self.trees[network] = (KDTree(self.points(xy[index], column[index]), balanced_tree=False), index)
+
+    def points(self, xy, refs):
+        return np.column_stack((xy, refs * self.separation))
+
+    def query(self, network, refs, xy):
+        # Find for every point the closest indexed node with the same number
+        # in the given network. Returns the distances (in m) and the node
+        # indices, -1 if there is no node with that number.
+        best_dist = np.full(len(refs), math.inf)
+        best_index = np.full(len(refs), -1, dtype=np.int64)
+
+        tree_and_index = self.trees.get(network)
+
+        # Sorted on number, so points that search the same part of the tree
+        # come after each other
+        query_index = np.argsort(refs, kind='stable')
+        query_index = query_index[refs[query_index] >= 0]
+        if tree_and_index is None or len(query_index) == 0:
+            return best_dist, best_index
+
+        # The difference of the ref coordinates is 0, so the distances are
+        # the same as in two dimensions
+        tree, index = tree_and_index
+        dd, ii = query_in_order(tree, self.points(xy[query_index], refs[query_index]), 1, self.separation / 2)
+        found = ii[:, 0] < tree.n
+        best_dist[query_index[found]] = dd[found, 0]
+        best_index[query_index[found]] = index[ii[found, 0]]
+
+        return best_dist, best_index
+
+    def find_closest_match(self, nodes):
+        # Closest indexed node with the same rwn_ref or rcn_ref, for every
+        # node of the given table
+        xy = nodes.xy
+        dist_rwn, index_rwn = self.query("rwn", nodes.matchable_refs(nodes.rwn_ref), xy)
+        dist_rcn, index_rcn = self.query("rcn", nodes.matchable_refs(nodes.rcn_ref), xy)
+
+        use_rcn = dist_rcn < dist_rwn
+        return np.where(use_rcn, dist_rcn, dist_rwn), np.where(use_rcn, index_rcn, index_rwn)
+
+def edge_endpoints(edges):
+    # First and last vertex of every edge in m, as (n, 4) array
+    # (x_start, y_start, x_end, y_end)
+    endpoints = np.zeros((len(edges), 4))
+    for i, edge in enumerate(edges):
+        coords = edge.coords_in_m
+        endpoints[i, :2] = coords[0]
+        endpoints[i, 2:] = coords[-1]
+
+    return endpoints
+
+def endpoints_within(endpoints_a, endpoints_b, max_distance):
+    # For every row of two (n, 4) endpoint arrays, whether the start of a is
+    # within max_distance of one end of b and its end of the other end
+    def within(delta):
+        return (np.hypot(delta[:, 0], delta[:, 1]) <= max_distance) & (np.hypot(delta[:, 2], delta[:, 3]) <= max_distance)
+
+    return within(endpoints_a - endpoints_b) | within(endpoints_a - endpoints_b[:, [2, 3, 0, 1]])
+
+class EndpointIndex():
+    # Spatial index of a set of edges on both their endpoints. Every edge is
+    # a point (x_start, y_start, x_end, y_end) in one KD tree.
+    def __init__(self, edges):
+        self.endpoints = edge_endpoints(edges)
+        self.tree = KDTree(self.endpoints)
+
+    def find_pairs(self, edges, max_distance):
+        # All pairs (i, j) where the start of edges[i] is within max_distance
+        # of one end of indexed edge j and its end within max_distance of the
+        # other end. Returns an (n, 2) array sorted by i and j.
+        endpoints = edge_endpoints(edges)
+
+        pairs = []
+        for query in (endpoints, endpoints[:, [2, 3, 0, 1]]):
+            # With both endpoints within max_distance, the points are at most
+            # max_distance * sqrt(2) apart
+            found = KDTree(query).sparse_distance_matrix(self.tree, max_distance * math.sqrt(2), output_type='ndarray')
+            pairs.append(np.column_stack((found['i'], found['j'])).astype(np.int64))
+
+        pairs = np.unique(np.concatenate(pairs), axis=0)
+        return pairs[endpoints_within(endpoints[pairs[:, 0]], self.endpoints[pairs[:, 1]], max_distance)]
+
+def edge_ref_keys(edges, ids):
+    # Number for the unordered pair (ref_start, ref_end) of every edge. The
+    # refs are numbered in ids, which has to be shared by edges that are
+    # compared.
+    refs = np.array([(ids.setdefault(edge.ref_start, len(ids)), ids.setdefault(edge.ref_end, len(ids))) for edge in edges], dtype=np.int64).reshape(-1, 2)
+    return (refs.min(axis=1) << 32) | refs.max(axis=1)
+
+class EdgeRefIndex():
+    # Index of a set of edges on their unordered pair of ref numbers, so an
+    # edge is only compared to edges between the same two knooppunten. Most
+    # pairs of refs occur only once on both sides, then the endpoints are
+    # compared directly. Only large groups are searched with an
+    # EndpointIndex.
+
+    # Groups with more combinations than this use an EndpointIndex
+    max_combinations = 1000
+
+    def __init__(self, edges):
+        self.edges = edges
+        self.endpoints = edge_endpoints(edges)
+        self.ids = dict()
+
+        keys = edge_ref_keys(edges, self.ids)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys, self.start, self.count = np.unique(keys[self.order], return_index=True, return_counts=True)
+
+    def find_pairs(self, edges, max_distance):
+        # All pairs (i, j) where edges[i] and indexed edge j have the same
+        # refs and their endpoints are within max_distance (in either
+        # direction). Returns an (n, 2) array sorted by i and j.
+        if len(edges) == 0 or len(self.edges) == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+
+        endpoints = edge_endpoints(edges)
+
+        keys = edge_ref_keys(edges, self.ids)
+        order = np.argsort(keys, kind='stable')
+        query_keys, query_start, query_count = np.unique(keys[order], return_index=True, return_counts=True)
+
+        group = np.minimum(np.searchsorted(self.keys, query_keys), len(self.keys) - 1)
+        shared = self.keys[group] == query_keys
+        combinations = query_count * self.count[group]
+        small = shared & (combinations <= self.max_combinations)
+
+        # All combinations of the small groups
+        n = combinations[small]
+        small_group = np.repeat(np.arange(len(n)), n)
+        combination = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        count = self.count[group[small]][small_group]
+        i = order[query_start[small][small_group] + combination // count]
+        j = self.order[self.start[group[small]][small_group] + combination % count]
+        pairs = [np.column_stack((i, j))]
+
+        for g in np.flatnonzero(shared & ~small):
+            query_index = order[query_start[g]:query_start[g] + query_count[g]]
+            index = self.order[self.start[group[g]]:self.start[group[g]] + self.count[group[g]]]
+            found = EndpointIndex([self.edges[k] for k in index]).find_pairs([edges[k] for k in query_index], max_distance)
+            pairs.append(np.column_stack((query_index[found[:, 0]], index[found[:, 1]])))
+
+        pairs = np.concatenate(pairs).astype(np.int64)
+        pairs = pairs[endpoints_within(endpoints[pairs[:, 0]], self.endpoints[pairs[:, 1]], max_distance)]
+        return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+def find_matching_nodes_using_tree(nodes_osm, nodes_ext, index_osm=None, index_ext=None):
+    # Find for every node the closest node in the other dataset with the same
+    # rwn_ref or rcn_ref
+    if index_osm is None:
+        index_osm = RefIndex(nodes_osm)
+    if index_ext is None:
+        index_ext = RefIndex(nodes_ext)
+
+    set_closest_matches(nodes_ext, nodes_osm, index_osm)
+    set_closest_matches(nodes_osm, nodes_ext, index_ext)
+
+def set_closest_matches(nodes, other_nodes, other_index):
+    # Set the match columns of nodes to the closest node in other_nodes
+    # (indexed by other_index) with the same rwn_ref or rcn_ref
+    nodes.match[:] = -1
+    nodes.match_dist[:] = np.nan
+
+    dist, match_index = other_index.find_closest_match(nodes)
+
+    found = np.flatnonzero(match_index >= 0)
+    j = match_index[found]
+    nodes.match[found] = j
+    nodes.match_dist[found] = dist_complicated_array(other_nodes.lat[j], other_nodes.lon[j], nodes.lat[found], nodes.lon[found])
+
+def densify(coords_in_m, step_distance):
+    # Points along a polyline (in m), at most step_distance apart: every
+    # segment is split in 1 + int(length / step_distance) equal steps. These
+    # are the same points as get_stepped_coords in analyze.py gives.
+    coords = np.asarray(coords_in_m, dtype=np.float64)
+    if len(coords) < 2:
+        return coords.copy()
+
+    delta = coords[1:] - coords[:-1]
+    length = np.sqrt(delta[:, 0]**2 + delta[:, 1]**2)
+    steps = 1 + (length / step_distance).astype(np.int64)
+
+    segment = np.repeat(np.arange(len(steps)), steps)
+    step = np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps)
+    fraction = step / steps[segment]
+
+    points = np.empty((len(segment) + 1, 2))
+    points[:-1] = coords[segment] + fraction[:, np.newaxis] * delta[segment]
+    points[-1] = coords[-1]
+    return points
+
+class EdgeDistance():
+    # Symmetric Hausdorff distance between edges, sampled every step_distance
+    # m along the edges. Every edge is densified once, the KD tree with its
+    # samples is kept and reused for all pairs the edge is part of.
+    def __init__(self, step_distance=10):
+        self.step_distance = step_distance
+        self.trees = dict()
+
+    def tree(self, edge):
+        tree = self.trees.get(edge)
+        if tree is None:
+            tree = KDTree(densify(edge.coords_in_m, self.step_distance))
+            self.trees[edge] = tree
 
-                break
+        return tree
 
-    for node in nodes_osm:
+    def directed(self, pairs):
+        # For all pairs (a, b), the largest distance of a sample of b to the
+        # samples of a. The samples of all b of the same a are queried at once.
+        result = np.empty(len(pairs))
+
+        rows_by_edge = dict()
+        for i, (edge_a, edge_b) in enumerate(pairs):
+            rows_by_edge.setdefault(edge_a, []).append(i)
+
+        for edge_a, rows in rows_by_edge.items():
+            samples = [self.tree(pairs[i][1]).data for i in rows]
+            lengths = np.array([len(points) for points in samples])
+            dist, _ = self.tree(edge_a).query(np.concatenate(samples), k=1)
+            result[rows] = np.maximum.reduceat(dist, np.cumsum(lengths) - lengths)
+
+        return result
+
+    def distances(self, pairs):
+        # Distance between the edges of all pairs (a, b)
+        if not pairs:
+            return np.zeros(0)
+
+        return np.maximum(self.directed(pairs), self.directed([(edge_b, edge_a) for edge_a, edge_b in pairs]))
+
+    def distance(self, edge_a, edge_b):
+        return self.distances([(edge_a, edge_b)])[0]
+
+def segment_distances(points, seg_start, seg_end):
+    # Distance of every point to the segment in the same row
+    d = seg_end - seg_start
+    len_sq = d[:, 0]**2 + d[:, 1]**2
+    t = (points[:, 0] - seg_start[:, 0]) * d[:, 0] + (points[:, 1] - seg_start[:, 1]) * d[:, 1]
+    t = np.clip(np.divide(t, len_sq, out=np.zeros_like(t), where=len_sq > 0), 0, 1)
+    return np.hypot(points[:, 0] - seg_start[:, 0] - t * d[:, 0], points[:, 1] - seg_start[:, 1] - t * d[:, 1])
+
+class ExactEdgeDistance():
+    # Symmetric Hausdorff distance between edges, using the segments of the
+    # edges instead of samples. The result is exact up to tolerance m.
+    #
+    # The distance of a point to an edge is the distance to its closest
+    # segment. Along a segment of the other edge the distance to one segment
+    # is convex, so it is largest at one of the ends. Segments that cannot
+    # be further away than the current maximum are skipped, the others are
+    # split in two until their bound is within tolerance.
+
+    # Number of pairs handled at once
+    batch_size = 1000
+
+    # Offset between the edges in the KD tree, larger than any distance
+    separation = 1e8
+
+    # Number of neighbours that is searched for first
+    k = 8
+
+    def __init__(self, tolerance=0.001, segment_length=100):
+        self.tolerance = tolerance
+        self.segment_length = segment_length
+        self.segments = dict()
+
+    def edge_segments(self, edge):
+        # Vertices of an edge and half the length of its longest segment.
+        # Long segments are split, which does not change the distances but
+        # keeps the search radius small.
+        segments = self.segments.get(edge)
+        if segments is None:
+            coords = densify(edge.coords_in_m, self.segment_length)
+            if len(coords) == 1:
+                coords = np.repeat(coords, 2, axis=0)
+
+            delta = coords[1:] - coords[:-1]
+            segments = (coords, np.sqrt(delta[:, 0]**2 + delta[:, 1]**2).max() / 2)
+            self.segments[edge] = segments
+
+        return segments
+
+    def candidates(self, pairs):
+        # Lower bound of the distance for every pair, and the segments of
+        # edges b that can be further away, with for each the segments of
+        # edge a that can be closest to one of its points
+        edges_a = list(dict.fromkeys(edge_a for edge_a, edge_b in pairs))
+        number = {edge_a: i for i, edge_a in enumerate(edges_a)}
+
+        # One KD tree on the segment midpoints of all edges a. The number of
+        # the edge is the third coordinate, so only segments of the same edge
+        # are found.
+        coords_a = [self.edge_segments(edge_a)[0] for edge_a in edges_a]
+        half_length = np.array([self.edge_segments(edge_a)[1] for edge_a in edges_a])
+        a_start = np.concatenate([coords[:-1] for coords in coords_a])
+        a_end = np.concatenate([coords[1:] for coords in coords_a])
+        a_number = np.repeat(np.arange(len(edges_a)), [len(coords) - 1 for coords in coords_a])
+        tree = KDTree(np.column_stack(((a_start + a_end) / 2, a_number * self.separation)))
+
+        coords_b = [self.edge_segments(edge_b)[0] for edge_a, edge_b in pairs]
+        n_vertices = np.array([len(coords) for coords in coords_b])
+        coords = np.concatenate(coords_b)
+        vertex_number = np.repeat([number[edge_a] for edge_a, edge_b in pairs], n_vertices)
+        is_start = np.ones(len(coords), dtype=bool)
+        is_start[np.cumsum(n_vertices) - 1] = False
+        first_vertex = np.flatnonzero(is_start)
+
+        pair = np.repeat(np.arange(len(pairs)), n_vertices - 1)
+        start = coords[first_vertex]
+        end = coords[first_vertex + 1]
+        length = np.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1])
+
+        # The midpoints of edge a are on the edge, so no point of the segment
+        # is further away from it than bound. The closest segment of edge a
+        # has its midpoint within radius of the midpoint of the segment.
+        bound_vertex, _ = tree.query(np.column_stack((coords, vertex_number * self.separation)))
+        bound_start = bound_vertex[first_vertex]
+        bound_end = bound_vertex[first_vertex + 1]
+        bound = np.minimum(np.minimum(bound_start, bound_end) + length, (bound_start + bound_end + length) / 2)
+        segment_number = vertex_number[first_vertex]
+
+        # Every point of edge a is within half_length of a midpoint, so the
+        # distance of a vertex is at least its bound minus half_length.
+        # Segments that are closer than that everywhere are not needed.
+        lower = np.zeros(len(pairs))
+        np.maximum.at(lower, np.repeat(np.arange(len(pairs)), n_vertices), bound_vertex - half_length[vertex_number])
+        needed = bound > lower[pair] + self.tolerance
+        pair, start, end, length, bound, segment_number = pair[needed], start[needed], end[needed], length[needed], bound[needed], segment_number[needed]
+
+        radius = bound + length / 2 + half_length[segment_number] + self.tolerance
+
+        # Most segments have a few candidates, only for those with more than
+        # k within radius all are searched
+        centre = np.column_stack(((start + end) / 2, segment_number * self.separation))
+        dist, index = tree.query(centre, k=self.k, distance_upper_bound=self.separation / 2)
+        found = dist <= radius[:, np.newaxis]
+        more = np.flatnonzero(found[:, -1])
+        found[more] = False
+
+        neighbours = tree.query_ball_point(centre[more], radius[more])
+        n_more = np.array([len(segments) for segments in neighbours], dtype=np.int64)
+        row = np.concatenate((np.nonzero(found)[0], np.repeat(more, n_more)))
+        segments = np.concatenate((index[found], np.array(list(chain.from_iterable(neighbours)), dtype=np.int64)))
+        order = np.argsort(row, kind="stable")
+        counts = np.bincount(row, minlength=len(pair))
+
+        return lower, pair, start, end, length, counts, a_start[segments[order]], a_end[segments[order]]
+
+    def directed(self, pairs):
+        # For all pairs (a, b), the largest distance of a point of b to edge a
+        return np.concatenate([self.directed_batch(pairs[i:i + self.batch_size]) for i in range(0, len(pairs), self.batch_size)])
+
+    def directed_batch(self, pairs):
+        # Intervals (segments of b, later parts of them) and for each interval
+        # the segments of a that are compared to it
+        lower, pair, start, end, length, counts, a_start, a_end = self.candidates(pairs)
+        interval = np.repeat(np.arange(len(pair)), counts)
+        first = np.cumsum(counts) - counts
+
+        d_start = segment_distances(start[interval], a_start, a_end)
+        d_end = segment_distances(end[interval], a_start, a_end)
+        dist_start = np.minimum.reduceat(d_start, first)
+        dist_end = np.minimum.reduceat(d_end, first)
+        np.maximum.at(lower, pair, np.maximum(dist_start, dist_end))
 
-        k_val = k_start
-        
         while True:
-            dd, ii = tree_ext.query([[node.lon_in_m, node.lat_in_m]], k = k_val, distance_upper_bound=max_distance)
-            if ii[0][-1] >=len(nodes_ext):
-                break
-            else:
-                k_val=k_val*2
-
-        for node_index in ii[0]:
-            if node_index>=len(nodes_ext):
-                break
-
-            node_ext = nodes_ext[node_index]
-
-            if node.rwn_ref and node.rwn_ref != "-1" and node.rwn_ref == node_ext.rwn_ref or \
-                node.rcn_ref and node.rcn_ref != "-1" and node.rcn_ref == node_ext.rcn_ref:
-                
-                node.closest_match_node = node_ext
-                node.closest_match_dist = dist_complicated(node.lat, node.lon, node_ext.lat, node_ext.lon)
-
-                break
-
+            # Largest possible distance within each interval
+            upper = np.minimum(np.minimum.reduceat(np.maximum(d_start, d_end), first), (dist_start + dist_end + length) / 2)
+            active = upper > lower[pair] + self.tolerance
+            if not active.any():
+                return lower
+
+            # Split the intervals that are left at their midpoint
+            keep = active[interval]
+            interval = (np.cumsum(active) - 1)[interval[keep]]
+            pair, start, end, length, dist_start, dist_end = pair[active], start[active], end[active], length[active], dist_start[active], dist_end[active]
+            a_start, a_end, d_start, d_end = a_start[keep], a_end[keep], d_start[keep], d_end[keep]
+            counts = np.bincount(interval, minlength=len(pair))
+            first = np.cumsum(counts) - counts
+
+            mid = (start + end) / 2
+            d_mid = segment_distances(mid[interval], a_start, a_end)
+            dist_mid = np.minimum.reduceat(d_mid, first)
+            np.maximum.at(lower, pair, dist_mid)
+
+            n = len(pair)
+            pair = np.concatenate((pair, pair))
+            start, end = np.concatenate((start, mid)), np.concatenate((mid, end))
+            length = np.concatenate((length, length)) / 2
+            dist_start, dist_end = np.concatenate((dist_start, dist_mid)), np.concatenate((dist_mid, dist_end))
+            interval = np.concatenate((interval, interval + n))
+            first = np.concatenate((first, first + len(d_mid)))
+            a_start, a_end = np.concatenate((a_start, a_start)), np.concatenate((a_end, a_end))
+            d_start, d_end = np.concatenate((d_start, d_mid)), np.concatenate((d_mid, d_end))
+
+    def distances(self, pairs):
+        # Distance between the edges of all pairs (a, b)
+        if not pairs:
+            return np.zeros(0)
+
+        return np.maximum(self.directed(pairs), self.directed([(edge_b, edge_a) for edge_a, edge_b in pairs]))
+
+    def distance(self, edge_a, edge_b):
+        return self.distances([(edge_a, edge_b)])[0]
+
+# Metrics that can be used to compare edges
+edge_metrics = {"sampled": EdgeDistance, "exact": ExactEdgeDistance}
@@ -1,29 +1,200 @@
-from compare import convert_to_m
+import numpy as np
+from compare import convert_to_m_array, convert_rd_to_wgs_array
+from change_type import ChangeType
+from node import TableRow, ResultColumns, default_ref_pool
+from osm_knooppunten.helper import normalize_number
 
-class Edge():
-    def __init__(self, coords, ref_start, ref_end):
-        self.coords = coords
-        self.ref_start = ref_start
-        self.ref_end = ref_end
-        if (coords):
-            self.coords_in_m = convert_to_m (coords)
-        if (ref_start):
-            self.ref_start = ref_start.lstrip("0")
-        if (ref_end):
-            self.ref_end = ref_end.lstrip("0")
+class EdgeTable(ResultColumns):
+    # Ragged array with a set of edges. The vertices of all edges are kept in
+    # one (n, 2) buffer, in WGS84 (vertices) and in m (vertices_in_m); edge i
+    # has the rows offsets[i] to offsets[i+1]. The buffers can be memory
+    # mapped, they are not copied. Edge objects are only thin views on a row
+    # of this table.
+    #
+    # The match and matched columns contain row indices into the table this
+    # one is compared to (self.other), or -1 if not set.
+    result_columns = {
+        "match": (np.int64, -1, None), # Index of closest_match_edge
+        "match_dist": (np.float64, np.nan, None), # Distance to closest_match_edge
+        "matched": (np.int64, -1, None), # Index of matched_edge
+        "change_type": (np.int8, 0, None), # ChangeType value, 0 if not set
+        "renamed_from": (np.int32, -1, None), # Interned old name if renamed
+    }
 
-        self.renamed_from = None # If the node is renamed, this has the old name (that is in OSM)
-        self.change_type = None # When matched, this gives the change type
+    def __init__(self, vertices, offsets, ref_start, ref_end, vertices_in_m=None, refs=None):
+        self.refs = refs if refs is not None else default_ref_pool
 
-        self.matched_edge = None # Edge that has been matched to this edge by the analysis program
-        self.closest_match_edge = None # Closest edge that has been matched to this edge by the analysis program
-        self.closest_match_dist = None # Distance to closest_match_node
+        self.vertices = vertices
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self._vertices_in_m = vertices_in_m # Projected when first used
 
-        #self.closest_dist = None # Distance to closest_node
+        self.ref_start = np.array([self.refs.intern(normalize_number(ref)) for ref in ref_start], dtype=np.int32)
+        self.ref_end = np.array([self.refs.intern(normalize_number(ref)) for ref in ref_end], dtype=np.int32)
 
-        self.coords_in_m
+        self.other = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def vertices_in_m(self):
+        if self._vertices_in_m is None:
+            self._vertices_in_m = convert_to_m_array(self.vertices)
+        return self._vertices_in_m
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Edge.view(self, i) for i in range(len(self))[index]]
+
+        return Edge.view(self, range(len(self))[index])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Edge.view(self, i)
+
+    def start_xy(self):
+        # First vertex of every edge in m, as (n, 2) array
+        return self.vertices_in_m[self.offsets[:-1]]
+
+    def end_xy(self):
+        # Last vertex of every edge in m, as (n, 2) array
+        return self.vertices_in_m[self.offsets[1:] - 1]
+
+    def ref_string(self, column, index):
+        return self.refs.lookup(column[index])
+
+class Edge(TableRow):
+    # View on a single row of an EdgeTable. An edge created with the
+    # constructor gets a table of its own.
+    __slots__ = ()
+
+    def __init__(self, coords, ref_start, ref_end, coords_in_m=None):
+        vertices = np.array([(vertex[0], vertex[1]) for vertex in coords], dtype=np.float64).reshape(-1, 2)
+        table = EdgeTable(vertices, [0, len(vertices)], [ref_start], [ref_end], coords_in_m)
+        self._table = table
+        self._index = 0
+
+    # Vertices as list of [lon, lat]
+    @property
+    def coords(self):
+        table = self._table
+        return table.vertices[table.offsets[self._index]:table.offsets[self._index + 1]].tolist()
+
+    # Vertices as (n, 2) view on the vertex buffer
+    @property
+    def vertices(self):
+        table = self._table
+        return table.vertices[table.offsets[self._index]:table.offsets[self._index + 1]]
+
+    # Vertices in m, as (n, 2) view on the vertex buffer
+    @property
+    def coords_in_m(self):
+        table = self._table
+        return table.vertices_in_m[table.offsets[self._index]:table.offsets[self._index + 1]]
+
+    @property
+    def ref_start(self):
+        return self._table.ref_string(self._table.ref_start, self._index)
+
+    @ref_start.setter
+    def ref_start(self, ref):
+        self._table.ref_start[self._index] = self._table.refs.intern(ref)
+
+    @property
+    def ref_end(self):
+        return self._table.ref_string(self._table.ref_end, self._index)
+
+    @ref_end.setter
+    def ref_end(self, ref):
+        self._table.ref_end[self._index] = self._table.refs.intern(ref)
+
+    # If the edge is renamed, this has the old name (that is in OSM)
+    @property
+    def renamed_from(self):
+        return self._table.ref_string(self._table.renamed_from, self._index)
+
+    @renamed_from.setter
+    def renamed_from(self, ref):
+        self._table.renamed_from[self._index] = self._table.refs.intern(ref)
+
+    # When matched, this gives the change type
+    @property
+    def change_type(self):
+        value = self._table.change_type[self._index]
+        if value == 0:
+            return None
+
+        return ChangeType(value)
+
+    @change_type.setter
+    def change_type(self, change_type):
+        self._table.change_type[self._index] = change_type.value if change_type else 0
+
+    # Edge that has been matched to this edge by the analysis program
+    @property
+    def matched_edge(self):
+        return self._get_other(self._table.matched)
+
+    @matched_edge.setter
+    def matched_edge(self, edge):
+        self._set_other(self._table.matched, edge)
+
+    # Closest edge that has been matched to this edge by the analysis program
+    @property
+    def closest_match_edge(self):
+        return self._get_other(self._table.match)
+
+    @closest_match_edge.setter
+    def closest_match_edge(self, edge):
+        self._set_other(self._table.match, edge)
+
+    # Distance to closest_match_edge
+    @property
+    def closest_match_dist(self):
+        return self._get_dist(self._table.match_dist)
+
+    @closest_match_dist.setter
+    def closest_match_dist(self, dist):
+        self._table.match_dist[self._index] = np.nan if dist is None else dist
 
     @property
     def __geo_interface__(self):
-        return {"geometry": {"coordinates": (self.lat, self.lon), "type": "Point"},
-                "properties": {"rwn_ref": self.rwn_ref, "rcn_ref": self.rcn_ref}, "type": "Feature"}
+        return {"geometry": {"coordinates": self.coords, "type": "LineString"},
+                "properties": {"ref_start": self.ref_start, "ref_end": self.ref_end}, "type": "Feature"}
+
+def vertex_buffer(coords_list, rd_list=None):
+    # The vertices of all edges in one flat (n, 2) buffer, the vertices of
+    # edge i are vertices[offsets[i]:offsets[i+1]]. Edges with RD coordinates
+    # (rd_list) are converted to WGS84.
+    lengths = [len(coords) for coords in coords_list]
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    vertices = np.array([(vertex[0], vertex[1]) for coords in coords_list for vertex in coords], dtype=np.float64).reshape(-1, 2)
+
+    if rd_list is not None and any(rd_list):
+        rd_vertices = np.repeat(np.asarray(rd_list, dtype=bool), lengths)
+        vertices[rd_vertices] = convert_rd_to_wgs_array(vertices[rd_vertices])
+
+    return vertices, offsets
+
+def pack_edges(edges):
+    # Vertex buffers, offsets and refs of a list of edges, the arguments for
+    # an EdgeTable with copies of the edges (for example in another process)
+    lengths = [len(edge.coords_in_m) for edge in edges]
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    vertices = np.concatenate([edge.vertices for edge in edges]) if edges else np.zeros((0, 2))
+    vertices_in_m = np.concatenate([edge.coords_in_m for edge in edges]) if edges else np.zeros((0, 2))
+
+    return vertices, offsets, [edge.ref_start for edge in edges], [edge.ref_end for edge in edges], vertices_in_m
+
+def create_edges_from_vertices(vertices, offsets, ref_start_list, ref_end_list, vertices_in_m=None):
+    # Create the edges of a vertex buffer, as views on one EdgeTable
+    return list(EdgeTable(vertices, offsets, ref_start_list, ref_end_list, vertices_in_m))
+
+def create_edges(coords_list, ref_start_list, ref_end_list, rd_list=None):
+    # Create all edges of a file at once
+    vertices, offsets = vertex_buffer(coords_list, rd_list)
+    return create_edges_from_vertices(vertices, offsets, ref_start_list, ref_end_list)
@@ -0,0 +1,108 @@
+import json
+
+# Number of characters read from the file at a time
+chunk_size = 1 << 20
+
+whitespace = " \t\n\r"
+
+class StreamBuffer():
+    # Text buffer on top of a file, that is refilled when the parser needs
+    # more characters. Characters that have been parsed are dropped.
+    def __init__(self, file):
+        self.file = file
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def read_more(self):
+        if self.eof:
+            return False
+
+        if self.pos > 0:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+
+        # Read at least as much as is buffered, so long values are not
+        # re-parsed over and over
+        data = self.file.read(max(chunk_size, len(self.text)))
+        if not data:
+            self.eof = True
+            return False
+
+        self.text += data
+        return True
+
+    def peek(self):
+        # Next character that is not whitespace, None at the end of the file
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in whitespace:
+                self.pos += 1
+
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+
+            if not self.read_more():
+                return None
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Invalid GeoJSON: expected '{}' at position {}".format(char, self.pos))
+
+        self.pos += 1
+
+    def decode(self):
+        # Decode the JSON value at the current position
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.pos)
+                # A number at the end of the buffer may continue in the file
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            self.read_more()
+
+def iter_array(buffer):
+    buffer.expect('[')
+    if buffer.peek() == ']':
+        buffer.pos += 1
+        return
+
+    while True:
+        yield buffer.decode()
+
+        if buffer.peek() == ',':
+            buffer.pos += 1
+        else:
+            buffer.expect(']')
+            return
+
+def iter_features(file):
+    # Yield the features of a GeoJSON FeatureCollection one at a time,
+    # without loading the whole collection. Also accepts a plain list of
+    # features, as written by the exporters.
+    buffer = StreamBuffer(file)
+
+    if buffer.peek() == '[':
+        yield from iter_array(buffer)
+        return
+
+    buffer.expect('{')
+    while buffer.peek() != '}':
+        key = buffer.decode()
+        buffer.expect(':')
+
+        if key == "features":
+            # Whatever comes after the features is not needed
+            yield from iter_array(buffer)
+            return
+
+        buffer.decode()
+
+        if buffer.peek() == ',':
+            buffer.pos += 1
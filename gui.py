@@ -214,8 +214,8 @@ class MainWindow(QtWidgets.QWidget):
     def selectOSM(self):
         self.osmFile, selectedFilter = QtWidgets.QFileDialog.getOpenFileName(self,
                 "Select OSM file",
-                filter="All Files (*);;OSM Files (*.osm)",
-                selectedFilter="OSM Files (*.osm)")
+                filter="All Files (*);;OSM Files (*.osm *.pbf)",
+                selectedFilter="OSM Files (*.osm *.pbf)")
 
         self.text1.setText(self.osmFile)
 
@@ -232,8 +232,8 @@ class MainWindow(QtWidgets.QWidget):
     def selectDataset1(self):
         self.osmFile, selectedFilter = QtWidgets.QFileDialog.getOpenFileName(self,
                 "Select dataset 1",
-                filter="All Files (*);;GeoJSON or OSM Files (*.geojson *.json *.osm)",
-                selectedFilter="GeoJSON or OSM Files (*.geojson *.json *.osm)")
+                filter="All Files (*);;GeoJSON or OSM Files (*.geojson *.json *.osm *.pbf)",
+                selectedFilter="GeoJSON or OSM Files (*.geojson *.json *.osm *.pbf)")
 
         self.text1.setText(self.osmFile)
 
@@ -250,8 +250,8 @@ class MainWindow(QtWidgets.QWidget):
     def selectDataset3(self):
         self.osmFile_network, selectedFilter = QtWidgets.QFileDialog.getOpenFileName(self,
                 "Select dataset 1 (network)",
-                filter="All Files (*);;GeoJSON Files (*.geojson *.json)",
-                selectedFilter="GeoJSON Files (*.geojson *.json)")
+                filter="All Files (*);;GeoJSON or PBF Files (*.geojson *.json *.pbf)",
+                selectedFilter="GeoJSON or PBF Files (*.geojson *.json *.pbf)")
 
         self.text3.setText(self.osmFile_network)
 
@@ -0,0 +1,115 @@
+import os
+import numpy as np
+from change_type import ChangeType
+from compare import dist_complicated_array
+from import_osm import read_osm
+from import_pbf import read_pbf
+from import_geojson import export_geojson_points, load_geojson, select_geojson
+from analyze import classify_nodes, analyze_datasets, area_directory
+
+def read_snapshot(filename, workers=1):
+    # Nodes of a snapshot: the node tables of an OSM or PBF file, or the
+    # arrays of a GeoJSON file (see read_datasets)
+    _, extension = os.path.splitext(filename)
+    if extension == '.osm':
+        return read_osm(filename)
+    elif extension == '.pbf':
+        return read_pbf(filename, read_edges=False, workers=workers)[:2]
+
+    return load_geojson(filename, rwn_name="knooppuntnummer", rcn_name="knooppuntnr")
+
+def select_snapshot(data, filter_region, filter_province, skip_unnumbered=True):
+    # Nodes and invalid nodes of a snapshot (see read_snapshot) in the region
+    # and province. New tables, so they can be compared more than once.
+    if isinstance(data, tuple):
+        nodes, invalid_nodes = data
+    else:
+        nodes, invalid_nodes, _, _ = select_geojson(data, filter_region, filter_province, read_edges=False, skip_unnumbered=skip_unnumbered)
+
+    return nodes.take(np.arange(len(nodes))), invalid_nodes
+
+def node_history(snapshots, workers=1):
+    # Change history of every knooppunt over the snapshots, a list of (label,
+    # NodeTable) with the oldest first. Every snapshot is only compared to the
+    # previous one, with classify_nodes, so every step has the same results
+    # as a comparison of the two snapshots on their own. A node that is
+    # matched keeps the id of the node it is matched to, other nodes get a
+    # new id. Returns the points of the time series (see
+    # export_geojson_points), by id and snapshot.
+    points = []
+
+    def add_point(node_id, label, nodes, row, change_type, distance=None):
+        properties = {"id": node_id, "snapshot": label, "change": str(change_type) if change_type else None,
+                      "rwn_ref": nodes.ref_string(nodes.rwn_ref, row), "rcn_ref": nodes.ref_string(nodes.rcn_ref, row),
+                      "distance": distance if distance is not None else -1}
+        renamed_from = nodes.ref_string(nodes.renamed_from, row)
+        if renamed_from:
+            properties["old_name"] = renamed_from
+
+        points.append((node_id, (float(nodes.lon[row]), float(nodes.lat[row]), properties)))
+
+    label, nodes = snapshots[0]
+    ids = np.arange(len(nodes))
+    next_id = len(nodes)
+    for row in range(len(nodes)):
+        add_point(int(ids[row]), label, nodes, row, None)
+
+    for (_, old_nodes), (label, new_nodes) in zip(snapshots, snapshots[1:]):
+        # Copies, the results of the previous comparison are not used
+        old_nodes = old_nodes.take(np.arange(len(old_nodes)))
+        new_nodes = new_nodes.take(np.arange(len(new_nodes)))
+        if len(old_nodes) > 0 and len(new_nodes) > 0:
+            classify_nodes(old_nodes, new_nodes, workers=workers)
+        else:
+            old_nodes.change_type[:] = ChangeType.REMOVED.value
+            new_nodes.change_type[:] = ChangeType.ADDED.value
+
+        print("{}: {} nodes".format(label, len(new_nodes)))
+        # The distance moved, as the distances of the Moved results
+        matched = np.maximum(new_nodes.matched, 0)
+        distance = dist_complicated_array(old_nodes.lat[matched], old_nodes.lon[matched], new_nodes.lat, new_nodes.lon)
+
+        new_ids = np.full(len(new_nodes), -1, dtype=np.int64)
+        for row in range(len(new_nodes)):
+            change_type = ChangeType(new_nodes.change_type[row])
+            matched = new_nodes.matched[row]
+            if matched >= 0 and old_nodes.matched[matched] == row:
+                new_ids[row] = ids[matched]
+                add_point(int(new_ids[row]), label, new_nodes, row, change_type, float(distance[row]))
+            else:
+                new_ids[row] = next_id
+                next_id += 1
+                add_point(int(new_ids[row]), label, new_nodes, row, change_type)
+
+        for row in np.flatnonzero(old_nodes.matched < 0).tolist():
+            add_point(int(ids[row]), label, old_nodes, row, ChangeType(old_nodes.change_type[row]))
+
+        ids = new_ids
+
+    # The points are added by snapshot, the sort keeps that order per id
+    points.sort(key=lambda point: point[0])
+    return [point for _, point in points]
+
+def do_analysis_history(snapshots, filter_region, filter_province, pairs, progress, resultsdir="results", workers=1):
+    # Change history of the knooppunten over the snapshots, a list of (label,
+    # filename) with the oldest first, written to history.geojson in
+    # resultsdir. Every file is read once. For every (old label, new label) in
+    # pairs the nodes of the two snapshots are compared as in do_analysis,
+    # with the results in their own folder in resultsdir. workers as in
+    # analyze.analyze_datasets.
+    labels = [label for label, _ in snapshots]
+    datasets = [read_snapshot(filename, workers) for _, filename in snapshots]
+
+    tables = [select_snapshot(data, filter_region, filter_province)[0] for data in datasets]
+    print("Comparing {} snapshots: {}".format(len(snapshots), ", ".join(labels)))
+    points = node_history(list(zip(labels, tables)), workers)
+    exported_file = export_geojson_points(points, "history.geojson", resultsdir)
+
+    for old_label, new_label in pairs:
+        print("Compare", old_label, "to", new_label)
+        nodes_old, nodes_old_invalid = select_snapshot(datasets[labels.index(old_label)], filter_region, filter_province)
+        nodes_new, nodes_new_invalid = select_snapshot(datasets[labels.index(new_label)], filter_region, filter_province, skip_unnumbered=False)
+        analyze_datasets(nodes_old, nodes_old_invalid, None, None, nodes_new, nodes_new_invalid, None, None, progress,
+                         os.path.join(resultsdir, area_directory("{}_vs_{}".format(old_label, new_label))), workers=workers)
+
+    return exported_file
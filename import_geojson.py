@@ -2,69 +2,29 @@ import geojson
 import os
 import math
 import sys
-from node import Node
-from compare import dist_complicated, convert_rd_to_wgs
+import numpy as np
+import cache
+from node import NodeTableBuilder, NodeTable, RefPool
+from compare import dist_complicated, convert_to_m_array
 from osm_knooppunten import helper
 from export import ExportFile
-from edge import Edge
+from edge import EdgeTable, vertex_buffer
+from geojson_stream import iter_features
 
-def import_geojson_netwerken(filename, rwn_name = None, rcn_name = None, filter_regio = None, filter_province = None):
+def read_features(filename):
+    # Stream the features of a GeoJSON file, one feature at a time
     try:
         with open(filename, 'r', encoding="utf8") as file:
-            data = geojson.load(file)
+            yield from iter_features(file)
     except IOError as er:
         print(er)
         sys.exit(1)
 
+def split_valid_edges(all_edges):
     edges = []
     invalid_edges = []
 
-    for edge_data in data['features']:
-        #print(edge_data['properties'])
-
-        rwn_ref_id = None
-
-        regio = edge_data['properties'].get("regio")
-        if filter_regio and regio and regio != filter_regio:
-            continue
-
-        province = edge_data['properties'].get("provincie")
-        if filter_province and province and province != filter_province:
-            continue
-
-        if edge_data['geometry']['type'] != "LineString":
-            continue
-
-        #if rwn_name:
-        #    if rwn_name in edge_data['properties']:
-        #        rwn_ref_id = edge_data['properties'][rwn_name]
-
-        #rcn_ref_id = None
-        #if rcn_name:
-        #    if rcn_name in edge_data['properties']:
-        #        rcn_ref_id = edge_data['properties'][rcn_name]
-        
-        ref = edge_data['properties'].get("ref")
-
-        ref_start = None
-        ref_end = None
-
-        if ref:
-            ind = ref.find('-')
-            ref_start = ref[0:ind]
-            ref_end = ref[ind+1:]
-
-        if edge_data['geometry']:
-            coords = edge_data['geometry']['coordinates']
-            coord_lon = coords[0]
-            coord_lat = coords[1]
-        else:
-            coord_lon = None
-            coord_lat = None
-
-        rwn_ref_id=''
-        rcn_ref_id=''
-        edge = Edge(coords=coords, ref_start=ref_start, ref_end = ref_end)
+    for edge in all_edges:
         if (edge.ref_start and not helper.is_number_valid(edge.ref_start)) or (edge.ref_end and not helper.is_number_valid(edge.ref_end)):
             invalid_edges.append(edge)
         else:
@@ -72,215 +32,235 @@ def import_geojson_netwerken(filename, rwn_name = None, rcn_name = None, filter_
 
     return edges, invalid_edges
 
-def import_geojson_combined(filename, rwn_name = None, rcn_name = None, filter_regio = None, filter_province = None):
-    try:
-        with open(filename, 'r', encoding="utf8") as file:
-            data = geojson.load(file)
-    except IOError as er:
-        print(er)
-        sys.exit(1)
-
-    nodes = []
-    invalid_nodes = []
-
-    edges = []
-    invalid_edges = []
-
-    for node_edge_data in data['features']:
-        #print(edge_data['properties'])
-
-        file_id = node_edge_data['id']
-        rd_coords = False
-        if file_id.startswith('fietsknooppunten_vrij'):
-            rd_coords = True
-
-        rwn_ref_id = None
-
-        regio = node_edge_data['properties'].get("regio")
-        if filter_regio and regio and regio != filter_regio:
-            continue
-
-        province = node_edge_data['properties'].get("provincie")
-        if filter_province and province and province != filter_province:
-            continue
-
-        if node_edge_data['geometry']['type'] == "Point":
-
-            id_found = False
-
-            rwn_ref_id = None
-            if rwn_name:
-                if rwn_name in node_edge_data['properties']:
-                    rwn_ref_id = node_edge_data['properties'][rwn_name]
-                    id_found = True
-                    #if rwn_ref_id != "11":
-                    #    continue
-
-            rcn_ref_id = None
-            if rcn_name:
-                if rcn_name in node_edge_data['properties']:
-                    rcn_ref_id = node_edge_data['properties'][rcn_name]
-                    id_found = True
-
-            if 'rwn_ref' in node_edge_data['properties']:
-                rwn_ref_id = node_edge_data['properties']['rwn_ref']
-                id_found = True
-
-            if 'rcn_ref' in node_edge_data['properties']:
-                rcn_ref_id = node_edge_data['properties']['rcn_ref']
-                id_found = True
-
-            if not id_found:
-                 continue
-
-            if node_edge_data['geometry']:
-                coords = node_edge_data['geometry']['coordinates']
-
-                if rd_coords:
-                    coords = convert_rd_to_wgs([coords])[0]
-
-                coord_lon = coords[0]
-                coord_lat = coords[1]
-            else:
-                coord_lon = None
-                coord_lat = None
-
-            node = Node(lon=coord_lon, lat=coord_lat, rwn_ref=rwn_ref_id, rcn_ref=rcn_ref_id)
-            if not helper.is_number_valid(node.rwn_ref) and not helper.is_number_valid(node.rcn_ref):
-                invalid_nodes.append(node)
+def get_node_refs(properties, rwn_name, rcn_name):
+    # Ref numbers of a node, and whether the feature has any ref at all. The
+    # OSM names (rwn_ref, rcn_ref) win over the names of the external data.
+    id_found = False
+
+    rwn_ref_id = None
+    if rwn_name and rwn_name in properties:
+        rwn_ref_id = properties[rwn_name]
+        id_found = True
+
+    rcn_ref_id = None
+    if rcn_name and rcn_name in properties:
+        rcn_ref_id = properties[rcn_name]
+        id_found = True
+
+    if 'rwn_ref' in properties:
+        rwn_ref_id = properties['rwn_ref']
+        id_found = True
+
+    if 'rcn_ref' in properties:
+        rcn_ref_id = properties['rcn_ref']
+        id_found = True
+
+    return helper.normalize_number(rwn_ref_id), helper.normalize_number(rcn_ref_id), id_found
+
+def get_edge_refs(properties):
+    ref = properties.get("ref")
+
+    ref_start = None
+    ref_end = None
+
+    if ref:
+        ind = ref.find('-')
+        ref_start = ref[0:ind]
+        ref_end = ref[ind+1:]
+
+    return ref_start, ref_end
+
+def parse_geojson(filename, rwn_name = None, rcn_name = None):
+    # Parse all features of a GeoJSON file in a single pass into arrays, that
+    # can be stored in the cache. Points become nodes and LineStrings become
+    # edges, RD coordinates are converted to WGS84 and the edge vertices are
+    # also projected to m. Ref numbers, regions and
+    # provinces are stored as index into the strings array (-1 if not set).
+    strings = RefPool()
+
+    nodes = NodeTableBuilder()
+    node_regio = []
+    node_province = []
+    node_numbered = []
+
+    edge_coords = []
+    edge_refs_start = []
+    edge_refs_end = []
+    edge_regio = []
+    edge_province = []
+    edge_rd = []
+
+    for feature in read_features(filename):
+        properties = feature['properties']
+        geometry = feature['geometry']
+        geometry_type = geometry['type'] if geometry else None
+
+        rd_coords = (feature.get('id') or '').startswith('fietsknooppunten_vrij')
+
+        if geometry_type == "Point":
+            rwn_ref_id, rcn_ref_id, id_found = get_node_refs(properties, rwn_name, rcn_name)
+
+            coords = geometry['coordinates']
+            nodes.append(lon=coords[0], lat=coords[1], rwn_ref=strings.intern(rwn_ref_id), rcn_ref=strings.intern(rcn_ref_id), rd=rd_coords)
+            node_regio.append(strings.intern(properties.get("regio")))
+            node_province.append(strings.intern(properties.get("provincie")))
+            node_numbered.append(id_found)
+
+        elif geometry_type == "LineString":
+            ref_start, ref_end = get_edge_refs(properties)
+
+            edge_coords.append(geometry['coordinates'])
+            edge_refs_start.append(strings.intern(ref_start))
+            edge_refs_end.append(strings.intern(ref_end))
+            edge_regio.append(strings.intern(properties.get("regio")))
+            edge_province.append(strings.intern(properties.get("provincie")))
+            edge_rd.append(rd_coords)
+
+    node_lat, node_lon = nodes.coordinates()
+    edge_vertices, edge_offsets = vertex_buffer(edge_coords, edge_rd)
+
+    return {"strings": np.array(strings.strings, dtype=str),
+            "node_lat": node_lat, "node_lon": node_lon,
+            "node_rwn_ref": np.array(nodes.rwn_ref, dtype=np.int32),
+            "node_rcn_ref": np.array(nodes.rcn_ref, dtype=np.int32),
+            "node_regio": np.array(node_regio, dtype=np.int32),
+            "node_province": np.array(node_province, dtype=np.int32),
+            "node_numbered": np.array(node_numbered, dtype=bool),
+            "edge_vertices": edge_vertices, "edge_vertices_in_m": convert_to_m_array(edge_vertices), "edge_offsets": edge_offsets,
+            "edge_ref_start": np.array(edge_refs_start, dtype=np.int32),
+            "edge_ref_end": np.array(edge_refs_end, dtype=np.int32),
+            "edge_regio": np.array(edge_regio, dtype=np.int32),
+            "edge_province": np.array(edge_province, dtype=np.int32)}
+
+def area_mask(strings, regio, province, filter_regio, filter_province):
+    # Rows that are in the region and province, rows without a region or
+    # province are always kept
+    keep = np.ones(len(regio), dtype=bool)
+    for column, value in ((regio, filter_regio), (province, filter_province)):
+        if value:
+            keep &= (column < 0) | (strings[np.maximum(column, 0)] == "") | (strings[np.maximum(column, 0)] == value)
+
+    return keep
+
+def select_geojson(data, filter_regio = None, filter_province = None, read_nodes = True, read_edges = True, skip_unnumbered = True):
+    # Build the nodes and edges of a parsed GeoJSON file (see parse_geojson)
+    # that are in the region and province. Points without any ref number are
+    # skipped, unless skip_unnumbered is off, then they are added to the
+    # invalid nodes.
+    strings = data["strings"]
+    string_list = strings.tolist()
+    if len(strings) == 0:
+        strings = np.array([""])
+
+    def lookup(column):
+        return [string_list[i] if i >= 0 else None for i in column.tolist()]
+
+    nodes = NodeTableBuilder()
+    invalid_nodes = NodeTableBuilder()
+    if read_nodes:
+        rows = area_mask(strings, data["node_regio"], data["node_province"], filter_regio, filter_province)
+        if skip_unnumbered:
+            rows &= data["node_numbered"]
+        rows = np.flatnonzero(rows)
+
+        lat = data["node_lat"][rows].tolist()
+        lon = data["node_lon"][rows].tolist()
+        for i, rwn_ref_id, rcn_ref_id in zip(range(len(rows)), lookup(data["node_rwn_ref"][rows]), lookup(data["node_rcn_ref"][rows])):
+            if not helper.is_number_valid(rwn_ref_id) and not helper.is_number_valid(rcn_ref_id):
+                invalid_nodes.append(lon=lon[i], lat=lat[i], rwn_ref=rwn_ref_id, rcn_ref=rcn_ref_id)
             else:
-                nodes.append(node)
-
-
-        if node_edge_data['geometry']['type'] == "LineString":
-
-            ref = node_edge_data['properties'].get("ref")
+                nodes.append(lon=lon[i], lat=lat[i], rwn_ref=rwn_ref_id, rcn_ref=rcn_ref_id)
+
+    if read_edges:
+        # The table has all edges of the file, so the vertex buffers are
+        # used as they are (memory mapped, if loaded from the cache)
+        table = EdgeTable(data["edge_vertices"], data["edge_offsets"], lookup(data["edge_ref_start"]), lookup(data["edge_ref_end"]),
+                          data["edge_vertices_in_m"])
+
+        rows = np.flatnonzero(area_mask(strings, data["edge_regio"], data["edge_province"], filter_regio, filter_province))
+        edges, invalid_edges = split_valid_edges([table[i] for i in rows.tolist()])
+    else:
+        edges, invalid_edges = None, None
+
+    return nodes.build(), invalid_nodes.build(), edges, invalid_edges
+
+def load_geojson(filename, rwn_name = None, rcn_name = None):
+    # Arrays of a GeoJSON file (see parse_geojson). The file is parsed in a
+    # single pass, or loaded from the cache if it has been parsed before.
+    return cache.cached(filename, "geojson-{}-{}".format(rwn_name, rcn_name),
+                        lambda filename: parse_geojson(filename, rwn_name, rcn_name))
+
+def geojson_areas(data, column):
+    # Sorted names of the regions (column "regio") or provinces ("province")
+    # of the nodes of a parsed GeoJSON file
+    strings = data["strings"].tolist()
+    return sorted(set(strings[i] for i in np.unique(data["node_" + column]).tolist() if i >= 0 and strings[i]))
+
+def read_geojson(filename, rwn_name = None, rcn_name = None, filter_regio = None, filter_province = None,
+                 read_nodes = True, read_edges = True, skip_unnumbered = True):
+    # Read the nodes and edges of a GeoJSON file in the region and province.
+    # The filters are applied to the parsed arrays.
+    data = load_geojson(filename, rwn_name, rcn_name)
+    return select_geojson(data, filter_regio, filter_province, read_nodes, read_edges, skip_unnumbered)
 
-            ref_start = None
-            ref_end = None
-
-            if ref:
-                ind = ref.find('-')
-                ref_start = ref[0:ind]
-                ref_end = ref[ind+1:]
-
-            if node_edge_data['geometry']:
-                coords = node_edge_data['geometry']['coordinates']
-
-                if rd_coords:
-                    coords = convert_rd_to_wgs(coords)
-
-            else:
-                coords = None
-
-            edge = Edge(coords=coords, ref_start=ref_start, ref_end = ref_end)
-            if (edge.ref_start and not helper.is_number_valid(edge.ref_start)) or (edge.ref_end and not helper.is_number_valid(edge.ref_end)):
-                invalid_edges.append(edge)
-            else:
-                edges.append(edge)
-
-    return nodes, invalid_nodes, edges, invalid_edges
+def import_geojson_netwerken(filename, rwn_name = None, rcn_name = None, filter_regio = None, filter_province = None):
+    _, _, edges, invalid_edges = read_geojson(filename, rwn_name, rcn_name, filter_regio, filter_province, read_nodes=False)
+    return edges, invalid_edges
 
+def import_geojson_combined(filename, rwn_name = None, rcn_name = None, filter_regio = None, filter_province = None):
+    return read_geojson(filename, rwn_name, rcn_name, filter_regio, filter_province)
 
 def import_geojson(filename, rwn_name = None, rcn_name = None, filter_regio = None, filter_province = None):
-    try:
-        with open(filename, 'r', encoding="utf8") as file:
-            data = geojson.load(file)
-    except IOError as er:
-        print(er)
-        sys.exit(1)
-
-    nodes = []
-    invalid_nodes = []
-
-    for node_data in data['features']:
-        
-        file_id = node_data['id']
-        rd_coords = False
-        if file_id.startswith('fietsknooppunten_vrij'):
-            rd_coords = True
-
-        rwn_ref_id = None
-
-        regio = node_data['properties'].get("regio")
-        if filter_regio and regio and node_data['properties']["regio"] != filter_regio:
-            continue
-
-        province = node_data['properties'].get("provincie")
-        if filter_province and province and node_data['properties']["provincie"] != filter_province:
-            continue
-
-        rwn_ref_id = None
-        if rwn_name:
-            if rwn_name in node_data['properties']:
-                rwn_ref_id = node_data['properties'][rwn_name]
-                #if rwn_ref_id != "11":
-                #    continue
-
-
-        rcn_ref_id = None
-        if rcn_name:
-            if rcn_name in node_data['properties']:
-                rcn_ref_id = node_data['properties'][rcn_name]
-
-        if 'rwn_ref' in node_data['properties']:
-             rwn_ref_id = node_data['properties']['rwn_ref']
-
-        if 'rcn_ref' in node_data['properties']:
-             rcn_ref_id = node_data['properties']['rcn_ref']
-
-        if node_data['geometry']:
-            coords = node_data['geometry']['coordinates']
-
-            if rd_coords:
-                 coords = convert_rd_to_wgs([coords])[0]
-            coord_lon = coords[0]
-            coord_lat = coords[1]
-        else:
-            coord_lon = None
-            coord_lat = None
-
-        node = Node(lon=coord_lon, lat=coord_lat, rwn_ref=rwn_ref_id, rcn_ref=rcn_ref_id)
-        if not helper.is_number_valid(node.rwn_ref) and not helper.is_number_valid(node.rcn_ref):
-            invalid_nodes.append(node)
-        else:
-            nodes.append(node)
-
+    nodes, invalid_nodes, _, _ = read_geojson(filename, rwn_name, rcn_name, filter_regio, filter_province, read_edges=False, skip_unnumbered=False)
     return nodes, invalid_nodes
 
-def export_geojson(nodes, filename):
+def export_geojson(nodes, filename, indices=None, resultsdir="results"):
+    # Export the rows of a NodeTable, or only the rows given by indices, to a
+    # file in resultsdir
     print("Exporting to", filename)
+    nodes = NodeTable.from_nodes(nodes)
+    if indices is None:
+        indices = range(len(nodes))
+
+    lon = nodes.lon.tolist()
+    lat = nodes.lat.tolist()
+    match_dist = nodes.match_dist.tolist()
+    matched = nodes.matched.tolist()
+    other = nodes.other
+
     features = []
-    for node in nodes:
-        if node.closest_match_dist:
-            closest_distance = node.closest_match_dist
+    for i in indices:
+        rwn_ref = nodes.ref_string(nodes.rwn_ref, i)
+        rcn_ref = nodes.ref_string(nodes.rcn_ref, i)
+        renamed_from = nodes.ref_string(nodes.renamed_from, i)
+
+        # NaN (no match) and 0 are both exported as -1
+        if match_dist[i] == match_dist[i] and match_dist[i]:
+            closest_distance = match_dist[i]
         else:
             closest_distance = -1
 
-        point = geojson.Point((node.lon, node.lat))
+        point = geojson.Point((lon[i], lat[i]))
 
-        if node.renamed_from:
-            properties_dict = {"rwn_ref": node.rwn_ref, "rcn_ref": node.rcn_ref, "distance closest node": closest_distance, "old_name": node.renamed_from}
+        if renamed_from:
+            properties_dict = {"rwn_ref": rwn_ref, "rcn_ref": rcn_ref, "distance closest node": closest_distance, "old_name": renamed_from}
         else:
-            properties_dict = {"rwn_ref": node.rwn_ref, "rcn_ref": node.rcn_ref, "distance closest node": closest_distance}
+            properties_dict = {"rwn_ref": rwn_ref, "rcn_ref": rcn_ref, "distance closest node": closest_distance}
 
         feature = geojson.Feature(geometry=point, properties=properties_dict)
         features.append(feature)
 
-        matched_node = node.matched_node
-        if matched_node and not node.renamed_from:
-           #route_line = geojson.LineString(matched_edge.coords)
-           point = geojson.Point((matched_node.lon, matched_node.lat))
-           #properties_dict = {"ref_start": matched_edge.ref_start, "ref_end": matched_edge.ref_end, "distance closest node": closest_distance, "osm":True}
-           properties_dict = {"rwn_ref": node.rwn_ref, "rcn_ref": node.rcn_ref, "distance closest node": closest_distance, "osm":True}
+        if matched[i] >= 0 and not renamed_from:
+           j = matched[i]
+           point = geojson.Point((float(other.lon[j]), float(other.lat[j])))
+           properties_dict = {"rwn_ref": rwn_ref, "rcn_ref": rcn_ref, "distance closest node": closest_distance, "osm":True}
            feature = geojson.Feature(geometry=point, properties=properties_dict)
-           features.append(feature)           
+           features.append(feature)
 
     dump = geojson.dumps(features)
 
-    resultsdir = "results"
     try:
-        os.mkdir(resultsdir)
+        os.makedirs(resultsdir)
     except FileExistsError:
         pass # The directory already exists, move on
 
@@ -289,13 +269,14 @@ def export_geojson(nodes, filename):
     try:
         with open(filepath, 'w') as f:
             f.write(dump)
-        return ExportFile(filename=filename, filepath=filepath, n_nodes=len(nodes))
+        return ExportFile(filename=filename, filepath=filepath, n_nodes=len(indices))
     except IOError as er:
         print(er)
         sys.exit(1)
 
 
-def export_geojson_edges(edges, filename):
+def export_geojson_edges(edges, filename, resultsdir="results"):
+    # Export edges to a file in the netwerk folder of resultsdir
     print("Exporting to", filename)
     features = []
     for edge in edges:
@@ -327,9 +308,9 @@ def export_geojson_edges(edges, filename):
     dump = geojson.dumps(features)
 
     #resultsdir = "results"
-    resultsdir = os.path.join('results','netwerk')
+    resultsdir = os.path.join(resultsdir,'netwerk')
     try:
-        os.mkdir(resultsdir)
+        os.makedirs(resultsdir)
     except FileExistsError:
         pass # The directory already exists, move on
 
@@ -343,3 +324,24 @@ def export_geojson_edges(edges, filename):
         print(er)
         sys.exit(1)
 
+
+def export_geojson_points(points, filename, resultsdir="results"):
+    # Export (lon, lat, properties) tuples as points to a file in resultsdir
+    print("Exporting to", filename)
+    features = [geojson.Feature(geometry=geojson.Point((lon, lat)), properties=properties) for lon, lat, properties in points]
+    dump = geojson.dumps(features)
+
+    try:
+        os.makedirs(resultsdir)
+    except FileExistsError:
+        pass # The directory already exists, move on
+
+    filepath = os.path.join(resultsdir, filename)
+
+    try:
+        with open(filepath, 'w') as f:
+            f.write(dump)
+        return ExportFile(filename=filename, filepath=filepath, n_nodes=len(points))
+    except IOError as er:
+        print(er)
+        sys.exit(1)
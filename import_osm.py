@@ -1,39 +1,124 @@
-import xml.sax
-from xml import sax
-from node import Node
-
-class OSMContentHandler(xml.sax.ContentHandler):
-    def __init__(self, nodes):
-        xml.sax.ContentHandler.__init__(self)
-        self.rwn_ref = None
-        self.rcn_ref = None
-        self.lat = None
-        self.lon = None
-        self.nodes = nodes
-
-    def startElement(self, name, attrs):
-        if name == "node":
-            # reset ref numbers
-            self.rwn_ref = None
-            self.rcn_ref = None
-
-            # pares latitude and longtitude
-            self.lat = attrs["lat"]
-            self.lon = attrs["lon"]
-
-        if name == "tag":
-            key = attrs["k"]
-            value = attrs["v"]
-            if key == "rwn_ref":
-                self.rwn_ref = value
-            if key == "rcn_ref":
-                self.rcn_ref = value
-
-    def endElement(self, name):
-        if name == "node":
-            self.nodes.append(Node(lat=self.lat, lon=self.lon, rwn_ref=self.rwn_ref, rcn_ref=self.rcn_ref))
+import html
+import re
+import time
+from node import NodeTableBuilder
+from osm_knooppunten import helper
+
+# Number of bytes read from the file at a time
+chunk_size = 1 << 20
+
+# A complete <node> element, either self-closing or with its tags
+node_pattern = re.compile(rb"<node\b([^>]*?)(?:/>|>(.*?)</node>)", re.S)
+tag_pattern = re.compile(rb"<tag\b([^>]*?)/?>")
+attribute_pattern = re.compile(rb"""([\w:]+)\s*=\s*(?:'([^']*)'|"([^"]*)")""")
+ref_pattern = re.compile(rb"""k\s*=\s*['"]r[wc]n_ref['"]""")
+
+def parse_attributes(text):
+    attributes = dict()
+    for match in attribute_pattern.finditer(text):
+        value = match.group(2) if match.group(2) is not None else match.group(3)
+        attributes[match.group(1)] = html.unescape(value.decode("utf8"))
+
+    return attributes
+
+def parse_node(match):
+    # Coordinates and ref numbers of a matched <node> element
+    attributes = parse_attributes(match.group(1))
+
+    rwn_ref = None
+    rcn_ref = None
+    for tag in tag_pattern.finditer(match.group(2)):
+        tag_attributes = parse_attributes(tag.group(1))
+        key = tag_attributes.get(b"k")
+        if key == "rwn_ref":
+            rwn_ref = tag_attributes.get(b"v")
+        elif key == "rcn_ref":
+            rcn_ref = tag_attributes.get(b"v")
+
+    return attributes[b"lat"], attributes[b"lon"], rwn_ref, rcn_ref
+
+def scan_nodes(buffer, end):
+    # Yield the <node> elements before end that have a rwn_ref or rcn_ref
+    # tag. Only the places where such a tag occurs are looked at, all other
+    # elements are skipped without being parsed.
+    node_end = 0
+    for ref in ref_pattern.finditer(buffer, 0, end):
+        if ref.start() < node_end:
+            continue # Node already handled
+
+        node_start = buffer.rfind(b"<node", 0, ref.start())
+        if node_start < 0:
+            continue
+
+        match = node_pattern.match(buffer, node_start)
+        if not match or match.end() < ref.end():
+            continue # The tag is not part of a node
+
+        node_end = match.end()
+        yield match
+
+def read_stream(stream, nodes, invalid_nodes):
+    # Returns the number of nodes in the stream
+    n_scanned = 0
+    tail = b""
+
+    while True:
+        data = stream.read(chunk_size)
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        buffer = tail + data
+
+        # Only complete nodes are handled, the rest is kept for the next read
+        if not data:
+            end = len(buffer)
+        else:
+            last_node = buffer.rfind(b"<node")
+            match = node_pattern.match(buffer, last_node) if last_node >= 0 else None
+            if match:
+                end = match.end()
+            elif last_node >= 0:
+                end = last_node
+            else:
+                end = max(len(buffer) - len(b"<node"), 0)
+
+        n_scanned += buffer.count(b"<node", 0, end)
+
+        for match in scan_nodes(buffer, end):
+            lat, lon, rwn_ref, rcn_ref = parse_node(match)
+            rwn_ref = helper.normalize_number(rwn_ref)
+            rcn_ref = helper.normalize_number(rcn_ref)
+            if not helper.is_number_valid(rwn_ref) and not helper.is_number_valid(rcn_ref):
+                invalid_nodes.append(lat=lat, lon=lon, rwn_ref=rwn_ref, rcn_ref=rcn_ref)
+            else:
+                nodes.append(lat=lat, lon=lon, rwn_ref=rwn_ref, rcn_ref=rcn_ref)
+
+        if not data:
+            return n_scanned
+
+        tail = buffer[end:]
+
+def read_osm(filename_or_stream):
+    # Read the knooppunten (nodes with a rwn_ref or rcn_ref tag) of an OSM XML
+    # file. The file is read in chunks, so memory stays flat for large
+    # extracts, and only the knooppunten are parsed.
+    nodes = NodeTableBuilder()
+    invalid_nodes = NodeTableBuilder()
+
+    start_time = time.perf_counter()
+
+    if hasattr(filename_or_stream, "read"):
+        n_scanned = read_stream(filename_or_stream, nodes, invalid_nodes)
+    else:
+        with open(filename_or_stream, "rb") as stream:
+            n_scanned = read_stream(stream, nodes, invalid_nodes)
+
+    elapsed = time.perf_counter() - start_time
+    print("Import OSM: scanned {} nodes in {:.2f} s ({:.0f} nodes/s)".format(n_scanned, elapsed, n_scanned / elapsed if elapsed > 0 else 0))
+
+    return nodes.build(), invalid_nodes.build()
 
 def import_osm(filename_or_stream):
-    nodes = []
-    xml.sax.parse(filename_or_stream, OSMContentHandler(nodes))
+    # Only the knooppunten with a valid ref number. Nodes without a rwn_ref
+    # or rcn_ref tag are not read, and invalid ones are in read_osm only.
+    nodes, invalid_nodes = read_osm(filename_or_stream)
     return nodes
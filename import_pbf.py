@@ -0,0 +1,472 @@
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+from node import NodeTableBuilder
+from edge import create_edges
+from import_geojson import get_edge_refs, split_valid_edges
+from osm_knooppunten import helper
+
+# Reader for OpenStreetMap PBF files (.osm.pbf). The protobuf messages are
+# decoded by hand, see https://wiki.openstreetmap.org/wiki/PBF_Format for the
+# layout. The data blobs are decoded in a process pool.
+
+# Features of the header block that this reader can handle
+supported_features = {"OsmSchema-V0.6", "DenseNodes"}
+
+# Member type of a way in a relation
+member_way = 1
+
+# Networks of which the routes are read, only walking networks are compared
+route_networks = {"rwn"}
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def zigzag(value):
+    # sint64 value of a varint
+    return (value >> 1) ^ -(value & 1)
+
+def int64(value):
+    # int64 value of a varint, negative values are stored as two's complement
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def iter_fields(data):
+    # Yield the (field number, value) pairs of a protobuf message. Varints
+    # are returned as int, length delimited fields as memoryview.
+    data = memoryview(data)
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value = data[pos:pos+length]
+            pos += length
+        elif wire_type == 1:
+            value = data[pos:pos+8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos+4]
+            pos += 4
+        else:
+            raise ValueError("Invalid PBF: unsupported wire type {}".format(wire_type))
+
+        yield key >> 3, value
+
+def decode_packed(data):
+    # Values of a packed repeated varint field, decoded at once
+    data = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    value_of_byte = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shift = ((np.arange(ends[-1] + 1) - starts[value_of_byte]) * 7).astype(np.uint64)
+    parts = (data[:ends[-1] + 1] & 0x7f).astype(np.uint64) << shift
+    return np.bitwise_or.reduceat(parts, starts)
+
+def decode_packed_signed(data):
+    values = decode_packed(data)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+def decode_packed_delta(data):
+    # Delta coded sint64 values, as used for ids and coordinates
+    return np.cumsum(decode_packed_signed(data))
+
+def read_blob(filename, offset, size):
+    with open(filename, "rb") as file:
+        file.seek(offset)
+        blob = file.read(size)
+
+    for field, value in iter_fields(blob):
+        if field == 1:
+            return bytes(value)
+        if field == 3:
+            return zlib.decompress(value)
+        if field in (4, 5, 6, 7):
+            raise ValueError("Invalid PBF: only zlib compressed blobs are supported")
+
+    return b""
+
+def read_blob_index(filename):
+    # Offset and size of all data blobs in the file
+    blobs = []
+    with open(filename, "rb") as file:
+        while True:
+            header_size = file.read(4)
+            if not header_size:
+                return blobs
+
+            if len(header_size) < 4:
+                raise ValueError("Invalid PBF: truncated file")
+
+            blob_type = None
+            blob_size = 0
+            for field, value in iter_fields(file.read(struct.unpack(">i", header_size)[0])):
+                if field == 1:
+                    blob_type = bytes(value)
+                elif field == 3:
+                    blob_size = value
+
+            offset = file.tell()
+            if blob_type == b"OSMHeader":
+                check_header(read_blob(filename, offset, blob_size))
+            elif blob_type == b"OSMData":
+                blobs.append((offset, blob_size))
+
+            file.seek(offset + blob_size)
+
+def check_header(data):
+    for field, value in iter_fields(data):
+        if field == 4:
+            feature = bytes(value).decode("utf8")
+            if feature not in supported_features:
+                raise ValueError("PBF feature not supported: {}".format(feature))
+
+class PrimitiveBlock():
+    # A decoded data blob: the string table, coordinate encoding and the
+    # (still encoded) primitive groups
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+
+        for field, value in iter_fields(data):
+            if field == 1:
+                self.strings = [bytes(string) for _, string in iter_fields(value)]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 19:
+                self.lat_offset = int64(value)
+            elif field == 20:
+                self.lon_offset = int64(value)
+
+        self.string_ids = {string: i for i, string in enumerate(self.strings)}
+
+    def string(self, index):
+        return self.strings[index].decode("utf8")
+
+    def string_id(self, string):
+        return self.string_ids.get(string, -1)
+
+    def lat(self, lat):
+        return (self.lat_offset + self.granularity * lat) / 1e9
+
+    def lon(self, lon):
+        return (self.lon_offset + self.granularity * lon) / 1e9
+
+    def elements(self, kind):
+        # The encoded elements of one kind (1 node, 2 dense nodes, 3 way,
+        # 4 relation) in all groups
+        for group in self.groups:
+            for field, value in iter_fields(group):
+                if field == kind:
+                    yield value
+
+    def tags(self, keys, vals):
+        return {self.string(key): self.string(val) for key, val in zip(decode_packed(keys).tolist(), decode_packed(vals).tolist())}
+
+def read_dense_knooppunten(block, dense, rwn_key, rcn_key):
+    # Knooppunten in a DenseNodes message as (lat, lon, rwn_ref, rcn_ref)
+    lat = lon = keys_vals = None
+    for field, value in iter_fields(dense):
+        if field == 8:
+            lat = value
+        elif field == 9:
+            lon = value
+        elif field == 10:
+            keys_vals = value
+
+    if keys_vals is None:
+        return []
+
+    # The keys and values of all nodes, each node ends with a 0
+    keys_vals = decode_packed(keys_vals).astype(np.int64)
+    separator = keys_vals == 0
+    node_of = np.cumsum(separator) - separator
+    node_start = np.concatenate(([0], np.flatnonzero(separator) + 1))
+    is_key = ((np.arange(len(keys_vals)) - node_start[node_of]) % 2 == 0) & ~separator
+
+    refs = dict()
+    for key, column in ((rwn_key, 0), (rcn_key, 1)):
+        if key < 0:
+            continue
+        for i in np.flatnonzero(is_key & (keys_vals == key)).tolist():
+            refs.setdefault(int(node_of[i]), [None, None])[column] = block.string(int(keys_vals[i + 1]))
+
+    if not refs:
+        return []
+
+    lat = decode_packed_delta(lat)
+    lon = decode_packed_delta(lon)
+    return [(block.lat(int(lat[i])), block.lon(int(lon[i])), rwn_ref, rcn_ref) for i, (rwn_ref, rcn_ref) in sorted(refs.items())]
+
+def read_node(block, node):
+    # Id, coordinates and tags of a Node message
+    node_id = 0
+    keys = vals = b""
+    lat = lon = 0
+    for field, value in iter_fields(node):
+        if field == 1:
+            node_id = zigzag(value)
+        elif field == 2:
+            keys = value
+        elif field == 3:
+            vals = value
+        elif field == 8:
+            lat = zigzag(value)
+        elif field == 9:
+            lon = zigzag(value)
+
+    return node_id, block.lat(lat), block.lon(lon), block.tags(keys, vals)
+
+def read_relation(block, relation):
+    # Ref and member way ids of a route in a walking node network, None for
+    # other relations
+    keys = vals = memids = types = b""
+    for field, value in iter_fields(relation):
+        if field == 2:
+            keys = value
+        elif field == 3:
+            vals = value
+        elif field == 9:
+            memids = value
+        elif field == 10:
+            types = value
+
+    tags = block.tags(keys, vals)
+    if tags.get("network:type") != "node_network" or tags.get("network") not in route_networks:
+        return None
+
+    way_ids = decode_packed_delta(memids)[decode_packed(types) == member_way]
+    return tags.get("ref") or tags.get("note"), way_ids.tolist()
+
+def scan_blob(filename, offset, size, read_nodes, read_edges):
+    # First pass over a blob: the knooppunten and node network routes in it,
+    # and whether it contains nodes and ways at all. The string table tells
+    # if any of the wanted tags occur in the blob, if not the elements are
+    # skipped without being decoded.
+    block = PrimitiveBlock(read_blob(filename, offset, size))
+
+    knooppunten = []
+    routes = []
+    kinds = set(field for group in block.groups for field, _ in iter_fields(group))
+
+    rwn_key = block.string_id(b"rwn_ref")
+    rcn_key = block.string_id(b"rcn_ref")
+    if read_nodes and (rwn_key >= 0 or rcn_key >= 0):
+        for dense in block.elements(2):
+            knooppunten.extend(read_dense_knooppunten(block, dense, rwn_key, rcn_key))
+
+        for node in block.elements(1):
+            _, lat, lon, tags = read_node(block, node)
+            if "rwn_ref" in tags or "rcn_ref" in tags:
+                knooppunten.append((lat, lon, tags.get("rwn_ref"), tags.get("rcn_ref")))
+
+    if read_edges and block.string_id(b"node_network") >= 0:
+        for relation in block.elements(4):
+            route = read_relation(block, relation)
+            if route:
+                routes.append(route)
+
+    has_nodes = 1 in kinds or 2 in kinds
+    has_ways = 3 in kinds
+    return knooppunten, routes, has_nodes, has_ways
+
+# Ids that the workers look for in the second and third pass, set by the pool
+# initializer
+wanted_ids = None
+
+def set_wanted_ids(ids):
+    global wanted_ids
+    wanted_ids = ids
+
+def is_wanted(ids):
+    # Whether each of the ids is one of wanted_ids, which is sorted
+    if len(wanted_ids) == 0:
+        return np.zeros(len(ids), dtype=bool)
+    position = np.minimum(np.searchsorted(wanted_ids, ids), len(wanted_ids) - 1)
+    return wanted_ids[position] == ids
+
+def read_way_nodes(filename, offset, size):
+    # Node ids of the wanted ways in a blob
+    block = PrimitiveBlock(read_blob(filename, offset, size))
+
+    ways = dict()
+    for way in block.elements(3):
+        way_id = None
+        refs = b""
+        for field, value in iter_fields(way):
+            if field == 1:
+                way_id = value
+                if way_id not in wanted_ids:
+                    break
+            elif field == 8:
+                refs = value
+
+        if way_id in wanted_ids:
+            ways[way_id] = decode_packed_delta(refs)
+
+    return ways
+
+def read_node_coordinates(filename, offset, size):
+    # Ids and coordinates of the wanted nodes in a blob
+    block = PrimitiveBlock(read_blob(filename, offset, size))
+
+    ids = []
+    lat = []
+    lon = []
+    for dense in block.elements(2):
+        fields = dict(iter_fields(dense))
+        dense_ids = decode_packed_delta(fields.get(1, b""))
+        found = is_wanted(dense_ids)
+        if found.any():
+            ids.append(dense_ids[found])
+            lat.append(block.lat(decode_packed_delta(fields[8])[found]))
+            lon.append(block.lon(decode_packed_delta(fields[9])[found]))
+
+    # The plain nodes are looked up at once
+    nodes = [read_node(block, node)[:3] for node in block.elements(1)]
+    if nodes:
+        node_ids = np.array([node[0] for node in nodes], dtype=np.int64)
+        node_lat = np.array([node[1] for node in nodes])
+        node_lon = np.array([node[2] for node in nodes])
+        found = is_wanted(node_ids)
+        if found.any():
+            ids.append(node_ids[found])
+            lat.append(node_lat[found])
+            lon.append(node_lon[found])
+
+    if not ids:
+        return None
+
+    return np.concatenate(ids), np.concatenate(lat), np.concatenate(lon)
+
+def map_blobs(function, filename, blobs, workers, ids=None, *args):
+    # Apply function to all blobs, in a process pool if there is more than
+    # one blob. The results are in the order of the blobs.
+    offsets = [offset for offset, _ in blobs]
+    sizes = [size for _, size in blobs]
+    extra = [repeat(arg) for arg in args]
+
+    if workers == 1 or len(blobs) <= 1:
+        set_wanted_ids(ids)
+        return list(map(function, repeat(filename), offsets, sizes, *extra))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_wanted_ids, initargs=(ids,)) as executor:
+        chunksize = max(1, len(blobs) // (4 * (workers or os.cpu_count() or 1)))
+        return list(executor.map(function, repeat(filename), offsets, sizes, *extra, chunksize=chunksize))
+
+def chain_ways(ways):
+    # Join the node ids of the ways of a route to a single line. Ways are
+    # turned around where needed, ways that do not connect are appended.
+    line = []
+    for way in ways:
+        if not line:
+            line = list(way)
+        elif line[-1] == way[0]:
+            line.extend(way[1:])
+        elif line[-1] == way[-1]:
+            line.extend(way[-2::-1])
+        elif line[0] == way[-1] and len(line) == len(ways[0]):
+            line = list(way) + line[1:]
+        elif line[0] == way[0] and len(line) == len(ways[0]):
+            line = list(way[::-1]) + line[1:]
+        else:
+            line.extend(way)
+
+    return line
+
+def read_routes(filename, blobs, routes, scans, workers):
+    # Geometry of the routes, from the member ways and their nodes
+    if not routes:
+        return [], []
+
+    way_ids = set(way_id for _, route_ways in routes for way_id in route_ways)
+
+    way_blobs = [blob for blob, (_, _, _, has_ways) in zip(blobs, scans) if has_ways]
+    ways = dict()
+    for result in map_blobs(read_way_nodes, filename, way_blobs, workers, way_ids):
+        ways.update(result)
+
+    node_ids = np.unique(np.concatenate([nodes for nodes in ways.values()] + [np.zeros(0, dtype=np.int64)]))
+    if len(node_ids) == 0:
+        return [], []
+
+    node_blobs = [blob for blob, (_, _, has_nodes, _) in zip(blobs, scans) if has_nodes]
+    coordinates = dict()
+    for result in map_blobs(read_node_coordinates, filename, node_blobs, workers, node_ids):
+        if result:
+            coordinates.update(zip(result[0].tolist(), zip(result[2].tolist(), result[1].tolist())))
+
+    edge_coords = []
+    edge_refs_start = []
+    edge_refs_end = []
+    for ref, route_ways in routes:
+        line = chain_ways([ways[way_id].tolist() for way_id in route_ways if way_id in ways])
+        coords = [coordinates[node_id] for node_id in line if node_id in coordinates]
+        if len(coords) < 2:
+            continue # Route is not (enough) in the file
+
+        ref_start, ref_end = get_edge_refs({"ref": ref})
+        edge_coords.append(coords)
+        edge_refs_start.append(ref_start)
+        edge_refs_end.append(ref_end)
+
+    return split_valid_edges(create_edges(edge_coords, edge_refs_start, edge_refs_end))
+
+def read_pbf(filename, read_nodes = True, read_edges = True, workers = None):
+    # Read the knooppunten and the routes between them from an OSM PBF file,
+    # in the same form as read_geojson. Routes are the relations with
+    # network:type=node_network in route_networks, their member ways are
+    # joined to one line.
+    # With workers=1 everything is decoded in this process.
+    start_time = time.perf_counter()
+
+    blobs = read_blob_index(filename)
+    scans = map_blobs(scan_blob, filename, blobs, workers, None, read_nodes, read_edges)
+
+    nodes = NodeTableBuilder()
+    invalid_nodes = NodeTableBuilder()
+    routes = []
+    for knooppunten, blob_routes, _, _ in scans:
+        routes.extend(blob_routes)
+        for lat, lon, rwn_ref, rcn_ref in knooppunten:
+            rwn_ref = helper.normalize_number(rwn_ref)
+            rcn_ref = helper.normalize_number(rcn_ref)
+            if not helper.is_number_valid(rwn_ref) and not helper.is_number_valid(rcn_ref):
+                invalid_nodes.append(lat=lat, lon=lon, rwn_ref=rwn_ref, rcn_ref=rcn_ref)
+            else:
+                nodes.append(lat=lat, lon=lon, rwn_ref=rwn_ref, rcn_ref=rcn_ref)
+
+    if read_edges:
+        edges, invalid_edges = read_routes(filename, blobs, routes, scans, workers)
+    else:
+        edges, invalid_edges = None, None
+
+    print("Import PBF: {} blobs in {:.2f} s".format(len(blobs), time.perf_counter() - start_time))
+
+    return nodes.build(), invalid_nodes.build(), edges, invalid_edges
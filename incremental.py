@@ -0,0 +1,154 @@
+import os
+import bisect
+import hashlib
+import numpy as np
+from collections import deque
+from compare import edge_metrics, EdgeRefIndex
+
+# State of the analysis that is stored in the results directory, so the next
+# run with --incremental only analyzes the nodes and edges that changed (see
+# analyze.analyze_nodes_incremental and match_edges_incremental)
+
+# Increase when the state that is stored for incremental runs changes
+state_version = 1
+
+def save_node_state(nodes_osm, nodes_ext, resultsdir, settings):
+    # Store the nodes and the results of an analysis for the next incremental
+    # run, with the settings (a dict of numbers) the results depend on. The
+    # ref numbers are stored as index into strings.
+    strings = nodes_ext.refs.strings
+    state = dict(settings, state_version=state_version, strings=np.array(strings, dtype=str))
+    for name, nodes in (("osm", nodes_osm), ("ext", nodes_ext)):
+        for column in ("lat", "lon", "rwn_ref", "rcn_ref", "match", "match_dist"):
+            state[name + "_" + column] = getattr(nodes, column)
+    for column in ("closest_k", "closest_k_dist", "matched", "change_type", "renamed_from"):
+        state["ext_" + column] = getattr(nodes_ext, column)
+
+    path = os.path.join(resultsdir, "state_nodes.npz")
+    try:
+        with open(path, 'wb') as file:
+            np.savez(file, **state)
+    except IOError as er:
+        print("Could not write state file", path, er)
+
+def load_node_state(resultsdir, refs, settings):
+    # State of the previous run (see save_node_state), with the ref numbers
+    # as ids of refs. None if there is no state, or if it was stored with
+    # other settings.
+    path = os.path.join(resultsdir, "state_nodes.npz")
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with np.load(path, allow_pickle=False) as arrays:
+            state = dict(arrays)
+    except (OSError, ValueError) as er:
+        print("Ignoring state file", path, er)
+        return None
+
+    if state["state_version"] != state_version or any(name not in state or state[name] != value for name, value in settings.items()):
+        return None
+
+    ids = np.array([refs.intern(ref) for ref in state["strings"].tolist()] + [-1], dtype=np.int32)
+    for column in ("osm_rwn_ref", "osm_rcn_ref", "ext_rwn_ref", "ext_rcn_ref", "ext_renamed_from"):
+        state[column] = ids[state[column]]
+
+    return state
+
+def in_order(values):
+    # Mask of the longest increasing subsequence of distinct values (the
+    # last one found if there are more)
+    if np.all(np.diff(values) > 0):
+        return np.ones(len(values), dtype=bool)
+
+    # Last index of the increasing subsequences of every length with the
+    # smallest last value, and the index before every index
+    tails = []
+    tail_values = []
+    before = []
+    for i, value in enumerate(values.tolist()):
+        length = bisect.bisect_left(tail_values, value)
+        before.append(tails[length - 1] if length > 0 else -1)
+        if length == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[length] = i
+            tail_values[length] = value
+
+    mask = np.zeros(len(values), dtype=bool)
+    i = tails[-1]
+    while i >= 0:
+        mask[i] = True
+        i = before[i]
+    return mask
+
+def previous_rows(nodes, state, name):
+    # Row in the previous run of every node, -1 for new nodes. Nodes are
+    # the same if they have the same coordinates and ref numbers, equal
+    # nodes are paired in order. Ties between equal distances are resolved
+    # by the order of the nodes, so nodes that are in another order than in
+    # the previous run are new as well (as few as possible).
+    rows = dict()
+    keys = zip(*[state[name + "_" + column].tolist() for column in ("lat", "lon", "rwn_ref", "rcn_ref")])
+    for i, key in enumerate(keys):
+        rows.setdefault(key, deque()).append(i)
+
+    previous = np.full(len(nodes), -1, dtype=np.int64)
+    keys = zip(nodes.lat.tolist(), nodes.lon.tolist(), nodes.rwn_ref.tolist(), nodes.rcn_ref.tolist())
+    for i, key in enumerate(keys):
+        found = rows.get(key)
+        if found:
+            previous[i] = found.popleft()
+
+    found = np.flatnonzero(previous >= 0)
+    moved = found[~in_order(previous[found])]
+    if len(moved) > 0:
+        print("incremental: {} {} nodes in another order".format(len(moved), name.upper()))
+        previous[moved] = -1
+
+    return previous
+
+def edge_keys(edges):
+    # Hash of the vertices of every edge, as (n, 16) uint8 array
+    keys = [hashlib.blake2b(edge.vertices.tobytes(), digest_size=16).digest() for edge in edges]
+    return np.frombuffer(b"".join(keys), dtype=np.uint8).reshape(-1, 16)
+
+def match_edges_incremental(edges_ext, edges_osm, metric, max_distance, resultsdir):
+    # match_edges, with the distances of the pairs of the previous run (in
+    # state_edges.npz in the results directory). Only the distances of the
+    # pairs with a new or changed edge are calculated.
+    pairs = EdgeRefIndex(edges_osm).find_pairs(edges_ext, max_distance)
+    pair_keys = np.concatenate((edge_keys(edges_ext)[pairs[:, 0]], edge_keys(edges_osm)[pairs[:, 1]]), axis=1)
+    # One 32 byte value per pair, so they can be sorted and searched
+    pair_keys = np.ascontiguousarray(pair_keys).view("V32").reshape(-1)
+
+    dists = np.full(len(pairs), np.nan)
+    path = os.path.join(resultsdir, "state_edges.npz")
+    if os.path.exists(path):
+        try:
+            with np.load(path, allow_pickle=False) as state:
+                previous_keys = np.ascontiguousarray(state["keys"]).view("V32").reshape(-1)
+                if state["state_version"] == state_version and str(state["metric"]) == metric and len(previous_keys) > 0:
+                    order = np.argsort(previous_keys)
+                    found = np.minimum(np.searchsorted(previous_keys[order], pair_keys), len(order) - 1)
+                    known = previous_keys[order[found]] == pair_keys
+                    dists[known] = state["dists"][order[found[known]]]
+        except (OSError, ValueError, KeyError) as er:
+            print("Ignoring state file", path, er)
+
+    missing = np.flatnonzero(np.isnan(dists))
+    print("incremental: reused {} and calculated {} edge distances".format(len(pairs) - len(missing), len(missing)))
+    dists[missing] = edge_metrics[metric]().distances([(edges_ext[pairs[i, 0]], edges_osm[pairs[i, 1]]) for i in missing])
+
+    try:
+        os.makedirs(resultsdir)
+    except FileExistsError:
+        pass # The directory already exists, move on
+    try:
+        with open(path, 'wb') as file:
+            np.savez(file, state_version=state_version, metric=metric, keys=pair_keys.view(np.uint8).reshape(-1, 32), dists=dists)
+    except IOError as er:
+        print("Could not write state file", path, er)
+
+    return pairs, dists
@@ -1,16 +1,30 @@
+import os
 import sys
 import argparse as arg
 from _version import __version__
+import cache
 from analyze import do_analysis
+from batch import do_analysis_batch
+from history import do_analysis_history
+from compare import edge_metrics
 
 def main():
     parser = arg.ArgumentParser()
-    parser.add_argument("--osmfile", type=str, required=True, help="File with OSM data")
+    parser.add_argument("--osmfile", type=str, help="File with OSM data")
     parser.add_argument("--osmfile_network", type=str, required=False, help="File with network OSM data")
-    parser.add_argument("--importfile_nodes", type=str, required=True, help="File with node import data")
+    parser.add_argument("--importfile_nodes", type=str, help="File with node import data")
     parser.add_argument("--importfile_network", type=str, required=False, help="File with network import data")
     parser.add_argument("--region", type=str, help="Compare the OSM data only to the import data from this region")
     parser.add_argument("--province", type=str, help="Compare the OSM data only to the import data from this province")
+    parser.add_argument("--batch", choices=["province", "region"], help="Analyze every province or region of the import data, each in its own folder in the results")
+    parser.add_argument("--snapshots", type=str, nargs="+", metavar="[LABEL=]FILE", help="Files with nodes at different dates, oldest first; writes the change history of every node to history.geojson in the results (instead of comparing --osmfile and --importfile_nodes)")
+    parser.add_argument("--snapshot_pair", type=str, nargs=2, action="append", default=[], metavar=("OLD", "NEW"), help="With --snapshots, also compare these two snapshots, with the results in their own folder in the results")
+    parser.add_argument("--resultsdir", type=str, default="results", help="Directory for the results")
+    parser.add_argument("--cache_dir", type=str, default="cache", help="Directory for the parsed input files, so they are not parsed again on the next run")
+    parser.add_argument("--no_cache", action="store_true", help="Always parse the input files")
+    parser.add_argument("--edge_metric", choices=list(edge_metrics), default="sampled", help="Compare edges using points every 10 m (sampled) or their segments (exact)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes for decoding PBF files and for the analysis (or for the areas in batch mode)")
+    parser.add_argument("--incremental", action="store_true", help="Only analyze the nodes and edges near changes since the previous run with --incremental")
     parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=__version__))
 
     try:
@@ -19,10 +33,38 @@ def main():
         print(er)
         sys.exit(1)
 
+    # Snapshots are labeled with the name of their file, unless given
+    snapshots = []
+    for snapshot in args.snapshots or []:
+        label, sep, filename = snapshot.partition("=")
+        if not sep:
+            filename = snapshot
+            label = os.path.splitext(os.path.basename(snapshot))[0]
+        snapshots.append((label, filename))
+
+    labels = [label for label, _ in snapshots]
+    if not snapshots and not (args.osmfile and args.importfile_nodes):
+        parser.error("--osmfile and --importfile_nodes are required, unless --snapshots is used")
+    if len(set(labels)) < len(labels):
+        parser.error("the labels of the snapshots are not unique")
+    for pair in args.snapshot_pair:
+        if not all(label in labels for label in pair):
+            parser.error("unknown snapshot in --snapshot_pair {} {}".format(*pair))
+
+    if not args.no_cache:
+        cache.cache_dir = args.cache_dir
+
     print("Analyzing differences between datasets")
 
     #do_analysis(args.osmfile, args.importfile, args.region, args.province, None)
-    do_analysis(args.osmfile, args.importfile_nodes, args.osmfile_network, args.importfile_network, args.region, args.province, None)
+    if snapshots:
+        do_analysis_history(snapshots, args.region, args.province, args.snapshot_pair, None, args.resultsdir, args.workers)
+    elif args.batch:
+        do_analysis_batch(args.osmfile, args.importfile_nodes, args.osmfile_network, args.importfile_network, args.batch, args.region, args.province, None, args.resultsdir,
+                          args.edge_metric, args.workers, args.incremental)
+    else:
+        do_analysis(args.osmfile, args.importfile_nodes, args.osmfile_network, args.importfile_network, args.region, args.province, None, args.resultsdir,
+                    args.edge_metric, args.workers, args.incremental)
 
 if __name__ == "__main__":
     main()
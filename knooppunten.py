@@ -3,6 +3,7 @@ import sys
 import argparse as arg
 from PySide6 import QtWidgets
 from _version import __version__
+import cache
 from gui import MainWindow
 
 def main():
@@ -12,6 +13,7 @@ def main():
     parser = arg.ArgumentParser()
     parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=__version__))
     parser.parse_args()
+    cache.cache_dir = "cache"
     app = QtWidgets.QApplication([])
 
     widget = MainWindow()
@@ -0,0 +1,97 @@
+import os
+import argparse as arg
+import tracemalloc
+import numpy as np
+from import_osm import read_osm
+from import_pbf import read_pbf
+from import_geojson import read_geojson
+from node import Node
+
+# Measures the memory that is used per node and per edge: by the columns of
+# the tables, and by the Node and Edge objects (views on a row of a table)
+# that the analysis creates.
+
+def read_nodes(filename):
+    _, extension = os.path.splitext(filename)
+    if extension == '.osm':
+        return read_osm(filename)[0]
+    elif extension == '.pbf':
+        return read_pbf(filename, read_edges=False)[0]
+
+    return read_geojson(filename, rwn_name="knooppuntnummer", rcn_name="knooppuntnr", read_edges=False)[0]
+
+def read_edges(filename):
+    _, extension = os.path.splitext(filename)
+    if extension == '.pbf':
+        return read_pbf(filename, read_nodes=False)[2]
+
+    return read_geojson(filename, rwn_name="knooppuntnummer", rcn_name="knooppuntnr", read_nodes=False)[2]
+
+def array_bytes(table):
+    # Bytes of the columns of a table. Views on another column (and arrays
+    # that are not set yet) are not counted.
+    return sum(value.nbytes for value in vars(table).values()
+               if isinstance(value, np.ndarray) and not isinstance(value.base, np.ndarray))
+
+def allocated(create):
+    # Result of create() and the number of bytes it allocated
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = create()
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+def report(name, n, sizes):
+    print("{} ({})".format(name, n))
+    for label, size in sizes:
+        print("  {:<32} {:8.1f} bytes".format(label, size / max(n, 1)))
+
+def benchmark_nodes(filename, n_standalone):
+    nodes = read_nodes(filename)
+    n = len(nodes)
+
+    table_bytes = array_bytes(nodes)
+    nodes.xy # The analysis always needs the coordinates in m
+    projected_bytes = array_bytes(nodes)
+    views, view_bytes = allocated(lambda: list(nodes))
+
+    rows = range(min(n_standalone, n))
+    lat = nodes.lat.tolist()
+    lon = nodes.lon.tolist()
+    refs = [node.rwn_ref for node in views]
+    standalone, standalone_bytes = allocated(lambda: [Node(lat[i], lon[i], refs[i], None) for i in rows])
+
+    report("Nodes " + filename, n, [("table as read", table_bytes), ("table with coordinates in m", projected_bytes),
+                                    ("Node view (and list entry)", view_bytes)])
+    report("Standalone Node objects", len(rows), [("Node with its own table", standalone_bytes)])
+
+def benchmark_edges(filename):
+    edges = read_edges(filename)
+    n = len(edges)
+
+    table = edges[0].table if edges else None
+    table_bytes = array_bytes(table) if table else 0
+    if table:
+        table.start_xy() # The analysis always needs the coordinates in m
+    projected_bytes = array_bytes(table) if table else 0
+    views, view_bytes = allocated(lambda: [table[i] for i in range(n)])
+
+    report("Edges " + filename, n, [("table as read", table_bytes), ("table with coordinates in m", projected_bytes),
+                                    ("Edge view (and list entry)", view_bytes)])
+
+def main():
+    parser = arg.ArgumentParser(description="Memory used per node and per edge")
+    parser.add_argument("--nodes", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "Noord-Brabant.osm"),
+                        help="File with nodes (OSM, PBF or GeoJSON)")
+    parser.add_argument("--network", type=str, help="File with the network (PBF or GeoJSON)")
+    parser.add_argument("--standalone", type=int, default=10000, help="Number of nodes that are created with the Node constructor")
+    args = parser.parse_args()
+
+    benchmark_nodes(args.nodes, args.standalone)
+    if args.network:
+        benchmark_edges(args.network)
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,383 @@
-from compare import convert_to_m
+import numpy as np
+from compare import convert_to_m_array, convert_rd_to_wgs_array
+from change_type import ChangeType
+from osm_knooppunten.helper import normalize_number
+
+class RefPool():
+    # Interns knooppunt numbers, so node tables can store (and compare) them
+    # as small integers. Tables that are compared to each other must share
+    # the same pool.
+    def __init__(self):
+        self.strings = []
+        self.ids = dict()
+
+    def intern(self, ref):
+        if ref is None:
+            return -1
+
+        ref_id = self.ids.get(ref)
+        if ref_id is None:
+            ref_id = len(self.strings)
+            self.strings.append(ref)
+            self.ids[ref] = ref_id
+
+        return ref_id
+
+    def lookup(self, ref_id):
+        if ref_id < 0:
+            return None
+
+        return self.strings[ref_id]
+
+# Pool shared by all node tables, unless another one is given
+default_ref_pool = RefPool()
+
+class ResultColumns():
+    # Base class of NodeTable and EdgeTable. The columns with the results of
+    # an analysis (result_columns: name -> (dtype, value if not set, number
+    # of values per row or None)) are created when they are first used.
+    result_columns = dict()
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set
+        column = type(self).result_columns.get(name)
+        if column is None:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+        dtype, value, width = column
+        array = np.full((len(self), width) if width else len(self), value, dtype=dtype)
+        setattr(self, name, array)
+        return array
+
+    def clear_results(self):
+        for name in type(self).result_columns:
+            self.__dict__.pop(name, None)
+
+class NodeTable(ResultColumns):
+    # Columnar store for a set of nodes. The coordinates, ref numbers and the
+    # results of the analysis are kept in NumPy arrays, one row per node.
+    # Node objects are only thin views on a row of this table.
+    #
+    # The match, closest and matched columns contain row indices into the
+    # table this one is compared to (self.other), or -1 if not set.
+    result_columns = {
+        "match": (np.int64, -1, None), # Index of closest_match_node
+        "match_dist": (np.float64, np.nan, None), # Distance to closest_match_node
+        "closest_k": (np.int64, -1, 1), # Index of closest_node(s)
+        "closest_k_dist": (np.float64, np.nan, 1), # Distance to closest_node(s)
+        "matched": (np.int64, -1, None), # Index of matched_node
+        "change_type": (np.int8, 0, None), # ChangeType value, 0 if not set
+        "renamed_from": (np.int32, -1, None), # Interned old name if renamed
+    }
+
+    def __init__(self, lat, lon, rwn_ref, rcn_ref, refs=None):
+        self.refs = refs if refs is not None else default_ref_pool
+
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+
+        # Coordinates in m, projected when first used (see project)
+        self._x_m = None
+        self._y_m = None
+
+        self.rwn_ref = np.asarray(rwn_ref, dtype=np.int32)
+        self.rcn_ref = np.asarray(rcn_ref, dtype=np.int32)
+
+        self.other = None
+
+    @classmethod
+    def from_columns(cls, lat, lon, rwn_ref, rcn_ref, refs=None):
+        # Create a table from lists of coordinates and (not interned) ref numbers
+        if refs is None:
+            refs = default_ref_pool
+
+        rwn_ids = [refs.intern(normalize_number(ref)) for ref in rwn_ref]
+        rcn_ids = [refs.intern(normalize_number(ref)) for ref in rcn_ref]
+
+        return cls(lat, lon, rwn_ids, rcn_ids, refs)
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        # Create a table from a list of nodes. Tables are returned as is.
+        if isinstance(nodes, NodeTable):
+            return nodes
+
+        nodes = list(nodes)
+        return cls.from_columns([node.lat for node in nodes], [node.lon for node in nodes],
+                                [node.rwn_ref for node in nodes], [node.rcn_ref for node in nodes])
+
+    def take(self, rows):
+        # New table with the coordinates and ref numbers of the given rows,
+        # without the results of an analysis
+        return NodeTable(self.lat[rows], self.lon[rows], self.rwn_ref[rows], self.rcn_ref[rows], self.refs)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Node.view(self, i) for i in range(len(self))[index]]
+
+        return Node.view(self, range(len(self))[index])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Node.view(self, i)
+
+    def project(self):
+        # Project all coordinates to m at once
+        coords_in_m = convert_to_m_array(np.column_stack((self.lon, self.lat)))
+        self._x_m = coords_in_m[:, 0].copy()
+        self._y_m = coords_in_m[:, 1].copy()
+
+    @property
+    def x_m(self):
+        if self._x_m is None:
+            self.project()
+        return self._x_m
+
+    @property
+    def y_m(self):
+        if self._y_m is None:
+            self.project()
+        return self._y_m
+
+    @property
+    def xy(self):
+        # Coordinates in m as (n, 2) array, as used by the KD trees
+        return np.column_stack((self.x_m, self.y_m))
+
+    def link(self, other):
+        # Set the table that the match, closest and matched columns refer to
+        # and clear the results of a previous analysis
+        self.other = other
+        self.clear_results()
+
+    def set_closest(self, dist, index):
+        # Store the k closest nodes, given as (n, k) arrays, closest first
+        self.closest_k_dist = dist
+        self.closest_k = index
+
+    # The closest and closest_dist columns are views on the first column of
+    # closest_k and closest_k_dist
+    @property
+    def closest(self):
+        return self.closest_k[:, 0]
+
+    @property
+    def closest_dist(self):
+        return self.closest_k_dist[:, 0]
+
+    def matchable_refs(self, column):
+        # Copy of a ref column in which the numbers that never match another
+        # node ("" and "-1") are set to -1
+        refs = column.copy()
+        for ref in ("", "-1"):
+            ref_id = self.refs.ids.get(ref)
+            if ref_id is not None:
+                refs[refs == ref_id] = -1
+
+        return refs
+
+    def ref_string(self, column, index):
+        return self.refs.lookup(column[index])
+
+class NodeTableBuilder():
+    # Collects the nodes of an import, the NodeTable is created at the end.
+    # Nodes with RD coordinates (rd=True, lon is x and lat is y) are all
+    # converted to WGS84 at once when building the table.
+    def __init__(self):
+        self.lat = []
+        self.lon = []
+        self.rwn_ref = []
+        self.rcn_ref = []
+        self.rd_rows = []
+
+    def append(self, lat, lon, rwn_ref, rcn_ref, rd=False):
+        if rd:
+            self.rd_rows.append(len(self.lat))
+        self.lat.append(float(lat))
+        self.lon.append(float(lon))
+        self.rwn_ref.append(rwn_ref)
+        self.rcn_ref.append(rcn_ref)
+
+    def coordinates(self):
+        # WGS84 latitudes and longitudes of the collected nodes
+        lat = np.array(self.lat, dtype=np.float64)
+        lon = np.array(self.lon, dtype=np.float64)
+
+        if self.rd_rows:
+            lonlat = convert_rd_to_wgs_array(np.column_stack((lon[self.rd_rows], lat[self.rd_rows])))
+            lon[self.rd_rows] = lonlat[:, 0]
+            lat[self.rd_rows] = lonlat[:, 1]
+
+        return lat, lon
+
+    def build(self):
+        lat, lon = self.coordinates()
+        return NodeTable.from_columns(lat, lon, self.rwn_ref, self.rcn_ref)
+
+class TableRow():
+    # View on a single row of a table (NodeTable or EdgeTable). Two views are
+    # equal if they refer to the same row. Views only have slots for the table
+    # and the row, all other fields are in the table.
+    __slots__ = ("_table", "_index")
+
+    @classmethod
+    def view(cls, table, index):
+        row = cls.__new__(cls)
+        row._table = table
+        row._index = index
+        return row
+
+    def __eq__(self, other):
+        return isinstance(other, TableRow) and self._table is other._table and self._index == other._index
+
+    def __hash__(self):
+        return hash((id(self._table), self._index))
+
+    @property
+    def table(self):
+        return self._table
+
+    @property
+    def index(self):
+        return self._index
+
+    def _get_other(self, column):
+        # Row of the linked table that column refers to
+        index = column[self._index]
+        if index < 0:
+            return None
+
+        return type(self).view(self._table.other, index)
+
+    def _set_other(self, column, row):
+        if row is None:
+            column[self._index] = -1
+            return
+
+        if self._table.other is None:
+            self._table.other = row._table
+        elif self._table.other is not row._table:
+            raise ValueError("Row belongs to a table that is not linked to this one")
+
+        column[self._index] = row._index
+
+    def _get_dist(self, column):
+        dist = column[self._index]
+        if np.isnan(dist):
+            return None
+
+        return float(dist)
+
+class Node(TableRow):
+    # View on a single row of a NodeTable. A node created with the constructor
+    # gets a table of its own.
+    __slots__ = ()
 
-class Node():
     def __init__(self, lat, lon, rwn_ref, rcn_ref):
-        self.lat = float(lat)
-        self.lon = float(lon)
-        self.rwn_ref = rwn_ref
-        self.rcn_ref = rcn_ref
-        if (lat):
-            coords = []
-            coords.append((self.lon, self.lat))
-            #coords[0][0] = self.lon
-            #coords[0][1] = self.lat
-            coords_in_m = convert_to_m (coords)
-            self.lon_in_m = coords_in_m[0][0]
-            self.lat_in_m = coords_in_m[0][1]
-        if (rwn_ref):
-            self.rwn_ref = rwn_ref.lstrip("0")
-        if (rcn_ref):
-            self.rcn_ref = rcn_ref.lstrip("0")
-        self.renamed_from = None # If the node is renamed, this has the old name (that is in OSM)
-        self.matched_node = None # Node that has been matched to this node by the analysis program
-        self.change_type = None # When matched, this gives the change type
-
-        self.closest_match_node = None # Closest node that has been matched to this node by the analysis program
-        self.closest_match_dist = None # Distance to closest_match_node
-
-        self.closest_node = None # Closest node to this node
-        self.closest_dist = None # Distance to closest_node
-
-        self.lat_scaled = None
-        self.lon_scaled = None
+        table = NodeTable.from_columns([float(lat)], [float(lon)], [rwn_ref], [rcn_ref])
+        self._table = table
+        self._index = 0
+
+    @property
+    def lat(self):
+        return self._table.lat[self._index]
+
+    @property
+    def lon(self):
+        return self._table.lon[self._index]
+
+    @property
+    def lon_in_m(self):
+        return self._table.x_m[self._index]
+
+    @property
+    def lat_in_m(self):
+        return self._table.y_m[self._index]
+
+    @property
+    def rwn_ref(self):
+        return self._table.ref_string(self._table.rwn_ref, self._index)
+
+    @property
+    def rcn_ref(self):
+        return self._table.ref_string(self._table.rcn_ref, self._index)
+
+    # If the node is renamed, this has the old name (that is in OSM)
+    @property
+    def renamed_from(self):
+        return self._table.ref_string(self._table.renamed_from, self._index)
+
+    @renamed_from.setter
+    def renamed_from(self, ref):
+        self._table.renamed_from[self._index] = self._table.refs.intern(ref)
+
+    # When matched, this gives the change type
+    @property
+    def change_type(self):
+        value = self._table.change_type[self._index]
+        if value == 0:
+            return None
+
+        return ChangeType(value)
+
+    @change_type.setter
+    def change_type(self, change_type):
+        self._table.change_type[self._index] = change_type.value if change_type else 0
+
+    # Node that has been matched to this node by the analysis program
+    @property
+    def matched_node(self):
+        return self._get_other(self._table.matched)
+
+    @matched_node.setter
+    def matched_node(self, node):
+        self._set_other(self._table.matched, node)
+
+    # Closest node that has been matched to this node by the analysis program
+    @property
+    def closest_match_node(self):
+        return self._get_other(self._table.match)
+
+    @closest_match_node.setter
+    def closest_match_node(self, node):
+        self._set_other(self._table.match, node)
+
+    # Distance to closest_match_node
+    @property
+    def closest_match_dist(self):
+        return self._get_dist(self._table.match_dist)
+
+    @closest_match_dist.setter
+    def closest_match_dist(self, dist):
+        self._table.match_dist[self._index] = np.nan if dist is None else dist
+
+    # Closest node to this node
+    @property
+    def closest_node(self):
+        return self._get_other(self._table.closest)
+
+    @closest_node.setter
+    def closest_node(self, node):
+        self._set_other(self._table.closest, node)
+
+    # The k closest nodes as (node, distance) pairs, closest first
+    @property
+    def closest_nodes(self):
+        table = self._table
+        return [(Node.view(table.other, index), float(dist))
+                for index, dist in zip(table.closest_k[self._index], table.closest_k_dist[self._index]) if index >= 0]
+
+    # Distance to closest_node
+    @property
+    def closest_dist(self):
+        return self._get_dist(self._table.closest_dist)
+
+    @closest_dist.setter
+    def closest_dist(self, dist):
+        self._table.closest_dist[self._index] = np.nan if dist is None else dist
 
     @property
     def __geo_interface__(self):
@@ -16,3 +16,10 @@ def is_small_rename(a, b):
                 return False
 
     return True
+
+# Strip leading zeros from a knooppunt number, so "04" and "4" compare equal
+def normalize_number(number):
+    if number:
+        return number.lstrip("0")
+
+    return number
@@ -1,8 +1,22 @@
+import os
+import csv
+import json
+import random
+import tempfile
+import filecmp
 import unittest
-from analyze import do_analysis_internal
-from compare import find_matching_point, find_closest_node
-from unittest.mock import Mock
-from node import Node
+import analyze
+from analyze import do_analysis, do_analysis_internal, find_closest_pairs, add_nodes_to_edges, read_datasets
+from batch import do_analysis_batch
+from incremental import match_edges_incremental
+from history import node_history, do_analysis_history
+from import_osm import read_osm
+from compare import find_matching_point, find_closest_node, dist_complicated
+from unittest.mock import Mock, patch
+from node import Node, NodeTable
+from edge import Edge, create_edges
+from tests.fixtures import random_edges, point_feature, write_geojson
+import numpy as np
 
 class TestAnalysis(unittest.TestCase):
 
@@ -22,7 +36,7 @@ class TestAnalysis(unittest.TestCase):
                 ]
 
     def test_run(self):
-        results = do_analysis_internal(self.osm_nodes, self.ext_nodes, [], Mock())
+        results = do_analysis_internal(self.osm_nodes, self.ext_nodes, [], [], Mock())
         counts = [x.n_nodes for x in results]
         names = [x.filename for x in results]
         d = dict(zip(names, counts))
@@ -33,6 +47,22 @@ class TestAnalysis(unittest.TestCase):
         self.assertEqual(d["Minor rename_ext.geojson"], 1)
         self.assertEqual(d["Removed_osm.geojson"], 1)
 
+    def test_rename_next_closest(self):
+        # The closest OSM node of the "9" has a match, the next closest one not
+        osm_nodes = [
+                Node(lat=52, lon=5.0, rwn_ref="5", rcn_ref=None),
+                Node(lat=52, lon=5.0003, rwn_ref="7", rcn_ref=None),
+                ]
+        ext_nodes = [
+                Node(lat=52, lon=5.0, rwn_ref="5", rcn_ref=None), # nothing changed
+                Node(lat=52, lon=5.0001, rwn_ref="9", rcn_ref=None), # renamed
+                ]
+        results = do_analysis_internal(osm_nodes, ext_nodes, [], [], Mock())
+        d = dict((x.filename, x.n_nodes) for x in results)
+        self.assertEqual(d["No change_ext.geojson"], 1)
+        self.assertEqual(d["Renamed_ext.geojson"], 1)
+        self.assertEqual(d["Removed_osm.geojson"], 0)
+
     def test_compare_matching(self):
         self.assertEqual(find_matching_point(self.ext_nodes[0], self.osm_nodes), self.osm_nodes[0])
         self.assertEqual(find_matching_point(self.ext_nodes[1], self.osm_nodes), None)
@@ -42,3 +72,292 @@ class TestAnalysis(unittest.TestCase):
         self.assertEqual(find_closest_node(self.ext_nodes[0], self.osm_nodes), self.osm_nodes[0])
         self.assertEqual(find_closest_node(self.ext_nodes[1], self.osm_nodes), self.osm_nodes[1])
         self.assertEqual(find_closest_node(self.ext_nodes[2], self.osm_nodes), self.osm_nodes[1])
+
+    def test_read_datasets_workers(self):
+        # With one worker the PBF file is decoded without a process pool
+        with patch("import_pbf.ProcessPoolExecutor", side_effect=AssertionError("process pool started")):
+            datasets = read_datasets("tests/data/test.osm.pbf", "tests/data/test.json", None, None, workers=1)
+        self.assertEqual(len(datasets["osm"][0]), 3)
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                # The OSM nodes have no province, each province is compared to
+                # the ones near its own import nodes. Node 8 is removed in West.
+                def lon(i):
+                    return (6 if i < 3 else 5) + i * 0.01
+
+                write_geojson("osm.geojson", [point_feature(lon(i), 52, {"rwn_ref": str(i + 1)}) for i in range(6)]
+                              + [point_feature(5.07, 52, {"rwn_ref": "8"})])
+                write_geojson("ext.json", [point_feature(lon(i), 52 + 0.0001 * (i % 2), {"knooppuntnummer": str(i + 1), "provincie": "Oost" if i < 3 else "West"}) for i in range(6)]
+                              + [point_feature(6.2, 52, {"knooppuntnummer": "9", "provincie": "Oost"})])
+
+                do_analysis_batch("osm.geojson", "ext.json", None, None, "province", None, None, None, "batch")
+
+                for province in ("Oost", "West"):
+                    do_analysis("osm.geojson", "ext.json", None, None, None, province, None)
+                    comparison = filecmp.dircmp("results", os.path.join("batch", province))
+                    self.assertEqual(len(comparison.left_only + comparison.right_only), 0)
+                    self.assertEqual(filecmp.cmpfiles("results", os.path.join("batch", province), comparison.common_files, shallow=False)[1:], ([], []))
+
+                with open(os.path.join("batch", "summary.csv"), newline='') as f:
+                    summary = list(csv.DictReader(f))
+                self.assertEqual([row["province"] for row in summary], ["Oost", "West"])
+                self.assertEqual([row["Added_ext.geojson"] for row in summary], ["1", "0"])
+                self.assertEqual([row["Removed_osm.geojson"] for row in summary], ["0", "1"])
+            finally:
+                os.chdir(cwd)
+
+    def test_incremental(self):
+        with open("tests/data/test.json") as f:
+            centers = [feature["geometry"]["coordinates"] for feature in json.load(f)["features"]]
+        nodes, _ = read_osm("tests/data/test.osm")
+        centers += [[node.lon, node.lat] for node in nodes]
+
+        def random_node(rng):
+            lon, lat = rng.choice(centers)
+            return Node(lat=lat + rng.uniform(-0.2, 0.2), lon=lon + rng.uniform(-0.3, 0.3), rwn_ref=str(rng.randint(1, 30)), rcn_ref=None)
+
+        def near_node(rng, nodes):
+            # A node near one of nodes, with the same ref
+            node = rng.choice(nodes)
+            d = rng.choice([0.0001, 0.003])
+            return Node(lat=node.lat + rng.uniform(-d, d), lon=node.lon + rng.uniform(-d, d), rwn_ref=node.rwn_ref, rcn_ref=None)
+
+        def edit(rng, nodes, other_nodes):
+            # Random moves, renames, deletions and additions
+            nodes = [Node(lat=node.lat, lon=node.lon, rwn_ref=node.rwn_ref, rcn_ref=None) for node in nodes]
+            for i in rng.sample(range(len(nodes)), 5):
+                node = nodes[i]
+                change = rng.choice(["move", "jump", "rename"])
+                if change == "move":
+                    nodes[i] = Node(lat=node.lat + rng.uniform(-0.0005, 0.0005), lon=node.lon, rwn_ref=node.rwn_ref, rcn_ref=None)
+                elif change == "jump":
+                    nodes[i] = random_node(rng)
+                else:
+                    nodes[i] = Node(lat=node.lat, lon=node.lon, rwn_ref=str(rng.randint(1, 30)), rcn_ref=None)
+            for i in sorted(rng.sample(range(len(nodes)), 3), reverse=True):
+                del nodes[i]
+            for _ in range(3):
+                nodes.insert(rng.randint(0, len(nodes)), random_node(rng))
+                nodes.insert(rng.randint(0, len(nodes)), near_node(rng, other_nodes))
+            # Nodes in another order, and exactly the same place as another
+            for _ in range(3):
+                nodes.insert(rng.randint(0, len(nodes)), nodes.pop(rng.randrange(len(nodes))))
+            node = rng.choice(nodes)
+            nodes.insert(rng.randint(0, len(nodes)), Node(lat=node.lat, lon=node.lon, rwn_ref=str(rng.randint(1, 30)), rcn_ref=None))
+            return nodes
+
+        def results(directory):
+            return sorted(name for name in os.listdir(directory) if name.endswith(".geojson"))
+
+        with tempfile.TemporaryDirectory() as directory:
+            incremental_dir = os.path.join(directory, "incremental")
+            full_dir = os.path.join(directory, "full")
+            for seed in range(4):
+                rng = random.Random(seed)
+                osm_nodes = [random_node(rng) for _ in range(150)]
+                # Most ext nodes are (nearly) the same as an OSM node
+                ext_nodes = [Node(lat=node.lat + rng.uniform(0, 0.0002), lon=node.lon, rwn_ref=node.rwn_ref, rcn_ref=None) for node in osm_nodes[:120]]
+                ext_nodes += [random_node(rng) for _ in range(30)]
+
+                do_analysis_internal(osm_nodes, ext_nodes, [], [], Mock(), resultsdir=incremental_dir, incremental=True)
+                for _ in range(3):
+                    osm_nodes, ext_nodes = edit(rng, osm_nodes, ext_nodes), edit(rng, ext_nodes, osm_nodes)
+
+                    do_analysis_internal(osm_nodes, ext_nodes, [], [], Mock(), resultsdir=incremental_dir, incremental=True)
+                    # A full run, that also stores its state
+                    if os.path.exists(os.path.join(full_dir, "state_nodes.npz")):
+                        os.remove(os.path.join(full_dir, "state_nodes.npz"))
+                    do_analysis_internal(osm_nodes, ext_nodes, [], [], Mock(), resultsdir=full_dir, incremental=True)
+
+                    names = results(full_dir)
+                    self.assertEqual(results(incremental_dir), names)
+                    self.assertEqual(filecmp.cmpfiles(incremental_dir, full_dir, names, shallow=False)[1:], ([], []))
+                    with np.load(os.path.join(incremental_dir, "state_nodes.npz")) as state, np.load(os.path.join(full_dir, "state_nodes.npz")) as expected:
+                        for name in expected.files:
+                            self.assertTrue(np.array_equal(state[name], expected[name], equal_nan=name.endswith("dist")), name)
+
+                # Edges between the nodes, of which some are moved
+                def edges(nodes):
+                    return [Edge([[a.lon, a.lat], [b.lon, b.lat]], a.rwn_ref, b.rwn_ref) for a, b in zip(nodes, nodes[1:])]
+
+                edges_osm = edges(osm_nodes)
+                match_edges_incremental(edges(ext_nodes), edges_osm, "sampled", 1000, incremental_dir)
+                edges_ext = edges(edit(rng, ext_nodes, osm_nodes))
+                pairs, dists = match_edges_incremental(edges_ext, edges_osm, "sampled", 1000, incremental_dir)
+                expected_pairs, expected_dists = analyze.match_edges(edges_ext, edges_osm, "sampled", 1000)
+                self.assertTrue(np.array_equal(pairs, expected_pairs))
+                self.assertTrue(np.array_equal(dists, expected_dists))
+
+    def test_incremental_order(self):
+        # Two OSM nodes at the same place are both the closest node of the
+        # renamed ext node, the first one is used
+        def node(lat, lon, ref):
+            return Node(lat=lat, lon=lon, rwn_ref=ref, rcn_ref=None)
+
+        first, second = node(52, 5, "1"), node(52, 5, "2")
+        far_nodes = [node(52.5, 5.5 + i * 0.01, str(10 + i)) for i in range(5)]
+        ext_nodes = [node(52.0001, 5, "3")] + [node(n.lat, n.lon, n.rwn_ref) for n in far_nodes]
+
+        with tempfile.TemporaryDirectory() as directory:
+            incremental_dir = os.path.join(directory, "incremental")
+            full_dir = os.path.join(directory, "full")
+            do_analysis_internal([first, second] + far_nodes, ext_nodes, [], [], Mock(), resultsdir=incremental_dir, incremental=True)
+
+            # The two nodes swapped, and a change elsewhere
+            osm_nodes = [second, first] + far_nodes[:-1]
+            do_analysis_internal(osm_nodes, ext_nodes, [], [], Mock(), resultsdir=incremental_dir, incremental=True)
+            do_analysis_internal(osm_nodes, ext_nodes, [], [], Mock(), resultsdir=full_dir)
+
+            names = sorted(name for name in os.listdir(full_dir) if name.endswith(".geojson"))
+            self.assertIn("Renamed_ext.geojson", names)
+            self.assertEqual(filecmp.cmpfiles(incremental_dir, full_dir, names, shallow=False)[1:], ([], []))
+
+    def test_history(self):
+        def table(nodes):
+            return NodeTable.from_nodes([Node(lat=lat, lon=lon, rwn_ref=ref, rcn_ref=None) for lat, lon, ref in nodes])
+
+        snapshots = [
+                ("2023", table([(52, 5.0, "1"), (52, 5.1, "2"), (52, 5.2, "3")])),
+                ("2024", table([(52, 5.0, "1"), (52, 5.1005, "2"), (52, 5.3, "4")])), # 2 moved, 3 removed, 4 added
+                ("2025", table([(52, 5.0, "7"), (52, 5.1005, "2"), (52, 5.3, "4")])), # 1 renamed to 7
+                ]
+        points = node_history(snapshots)
+        history = [(p["id"], p["snapshot"], p["change"], p["rwn_ref"]) for _, _, p in points]
+        self.assertEqual(history, [
+                (0, "2023", None, "1"), (0, "2024", "No change", "1"), (0, "2025", "Renamed", "7"),
+                (1, "2023", None, "2"), (1, "2024", "Moved medium distance", "2"), (1, "2025", "No change", "2"),
+                (2, "2023", None, "3"), (2, "2024", "Removed", "3"),
+                (3, "2024", "Added", "4"), (3, "2025", "No change", "4"),
+                ])
+        self.assertEqual(points[2][2]["old_name"], "1")
+        self.assertAlmostEqual(points[4][2]["distance"], dist_complicated(52, 5.1, 52, 5.1005))
+
+    def test_history_files(self):
+        snapshots = [
+                ("2023", [(5.0, "1"), (5.1, "2"), (5.2, "3")]),
+                ("2024", [(5.0, "1"), (5.1005, "2"), (5.3, "4")]),
+                ]
+
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                for label, nodes in snapshots:
+                    write_geojson(label + ".json", [point_feature(lon, 52, {"knooppuntnummer": ref}) for lon, ref in nodes])
+
+                do_analysis_history([(label, label + ".json") for label, _ in snapshots], None, None, [("2023", "2024")], None, "history")
+                with open(os.path.join("history", "history.geojson")) as f:
+                    points = json.load(f)
+                self.assertEqual([(p["properties"]["id"], p["properties"]["snapshot"]) for p in points],
+                                 [(0, "2023"), (0, "2024"), (1, "2023"), (1, "2024"), (2, "2023"), (2, "2024"), (3, "2024")])
+
+                # The pair has the same results as comparing the two files
+                do_analysis("2023.json", "2024.json", None, None, None, None, None)
+                pair_dir = os.path.join("history", "2023_vs_2024")
+                comparison = filecmp.dircmp("results", pair_dir)
+                self.assertIn("Moved medium distance_ext.geojson", comparison.common_files)
+                self.assertEqual(len(comparison.left_only + comparison.right_only), 0)
+                self.assertEqual(filecmp.cmpfiles("results", pair_dir, comparison.common_files, shallow=False)[1:], ([], []))
+            finally:
+                os.chdir(cwd)
+
+    def test_find_closest_pairs(self):
+        rows = np.array([0, 0, 0, 2, 2])
+        columns = np.array([3, 1, 2, 0, 1])
+        dists = np.array([5.0, 7.0, 5.0, 1.0, 0.5])
+
+        closest, closest_dist = find_closest_pairs(rows, columns, dists, 4)
+        self.assertEqual(closest.tolist(), [2, -1, 1, -1])
+        self.assertEqual(closest_dist[0], 5.0)
+        self.assertTrue(np.isnan(closest_dist[1]))
+
+        # The same table gives the closest row of every column
+        closest, closest_dist = find_closest_pairs(columns, rows, dists, 4)
+        self.assertEqual(closest.tolist(), [2, 2, 0, 0])
+
+        closest, closest_dist = find_closest_pairs(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), 2)
+        self.assertEqual(closest.tolist(), [-1, -1])
+
+    def test_add_nodes_to_edges(self):
+        # Nodes 5 m and 10 m from the start of the first edge, the first also
+        # has a rcn_ref
+        nodes = NodeTable.from_columns([52.0, 52.00009, 52.01], [5.00007, 5.0, 5.01], ["1", "2", "3"], ["4", None, None])
+        edges = create_edges([[(5.0, 52.0), (5.01, 52.01)], [(5.0, 52.0), (5.02, 52.02)], [(5.01, 52.01), (5.0, 52.0)]],
+                             [None, "7", "8"], [None, None, "9"])
+
+        valid, invalid, n_ambiguous = add_nodes_to_edges(nodes, edges)
+        self.assertEqual(valid.tolist(), [0, 2])
+        self.assertEqual(invalid.tolist(), [1])
+        self.assertEqual(n_ambiguous, 1)
+        self.assertEqual((edges[0].ref_start, edges[0].ref_end), ("4", "3"))
+        self.assertEqual((edges[1].ref_start, edges[1].ref_end), ("7", None))
+        self.assertEqual((edges[2].ref_start, edges[2].ref_end), ("8", "9"))
+
+    def test_match_edges_parallel(self):
+        rng = np.random.default_rng(6)
+        edges_ext = random_edges(rng, 150, 0.1, 0.05, length=0.005, n_refs=4)
+        edges_osm = random_edges(rng, 150, 0.1, 0.05, length=0.005, n_refs=4)
+
+        pairs, dists = analyze.match_edges(edges_ext, edges_osm, "sampled", 1000)
+
+        # Tiles of 2 km, so most pairs are found in the halo of a tile
+        tile_size = analyze.tile_size
+        analyze.tile_size = 2000
+        try:
+            self.assertGreater(len(list(analyze.edge_tiles(edges_ext, edges_osm, 1000))), 4)
+            parallel_pairs, parallel_dists = analyze.match_edges_parallel(edges_ext, edges_osm, "sampled", 1000, 2)
+        finally:
+            analyze.tile_size = tile_size
+
+        self.assertGreater(len(pairs), 0)
+        self.assertEqual(parallel_pairs.tolist(), pairs.tolist())
+        self.assertEqual(parallel_dists.tolist(), dists.tolist())
+
+    def test_analyze_nodes_parallel(self):
+        rng = np.random.default_rng(7)
+        n = 300
+        lat = 52 + rng.uniform(0, 0.1, n)
+        lon = 5 + rng.uniform(0, 0.2, n)
+        refs = rng.integers(1, 40, n).astype(str)
+        nodes_osm = NodeTable.from_columns(lat, lon, refs, [None] * n)
+
+        # Moved, renamed, duplicated (same place, so at the same distance)
+        # and added nodes
+        moved = rng.normal(0, rng.choice([0.00001, 0.0003, 0.003], n))
+        ext_lat = np.concatenate((lat + moved, lat[:20], 52 + rng.uniform(0, 0.1, 30)))
+        ext_lon = np.concatenate((lon + moved, lon[:20], 5 + rng.uniform(0, 0.2, 30)))
+        ext_refs = np.concatenate((np.where(rng.uniform(size=n) < 0.1, rng.integers(1, 40, n).astype(str), refs), refs[:20], rng.integers(1, 40, 30).astype(str)))
+        nodes_ext = NodeTable.from_columns(ext_lat, ext_lon, ext_refs, [None] * len(ext_lat))
+
+        def analyze_nodes(parallel):
+            osm = nodes_osm.take(np.arange(len(nodes_osm)))
+            ext = nodes_ext.take(np.arange(len(nodes_ext)))
+            osm.link(ext)
+            ext.link(osm)
+            if parallel:
+                changes = analyze.analyze_nodes_parallel(osm, ext, 2)
+            else:
+                changes = analyze.analyze_nodes(osm, ext)
+            return [(change_type, matched_node.index if matched_node else -1) for change_type, matched_node in changes], osm, ext
+
+        changes, osm, ext = analyze_nodes(False)
+
+        # Tiles of 3 km, so the halo is used everywhere
+        tile_size = analyze.tile_size
+        analyze.tile_size = 3000
+        try:
+            self.assertGreater(len(list(analyze.node_tiles(nodes_osm, nodes_ext))), 10)
+            parallel_changes, parallel_osm, parallel_ext = analyze_nodes(True)
+        finally:
+            analyze.tile_size = tile_size
+
+        self.assertGreater(len(set(change_type for change_type, matched in changes)), 4)
+        self.assertEqual(parallel_changes, changes)
+        for column in ("match", "match_dist", "closest_k", "closest_k_dist", "renamed_from"):
+            np.testing.assert_array_equal(getattr(parallel_ext, column), getattr(ext, column))
+        for column in ("match", "match_dist"):
+            np.testing.assert_array_equal(getattr(parallel_osm, column), getattr(osm, column))
@@ -0,0 +1,198 @@
+import math
+import unittest
+import numpy as np
+from compare import convert_to_m, convert_to_m_array, convert_rd_to_wgs, convert_rd_to_wgs_array, dist_complicated, dist_complicated_array, dist_simple_sq, dist_simple_sq_array, RefIndex, EndpointIndex, EdgeRefIndex, EdgeDistance, ExactEdgeDistance, densify, segment_distances
+from edge import create_edges
+from node import NodeTableBuilder, NodeTable
+from tests.fixtures import random_edges
+
+class TestCompare(unittest.TestCase):
+
+    def setUp(self):
+        self.lonlat = [(5.1, 52.1), (6.57, 53.23), (3.5, 51.4)]
+
+    def test_convert_to_m(self):
+        coords_in_m = convert_to_m_array(self.lonlat)
+        self.assertEqual(coords_in_m.shape, (3, 2))
+        for (lon, lat), (x, y) in zip(self.lonlat, coords_in_m):
+            self.assertEqual(x, 1000 * 6371 * math.cos(math.radians(lat)) * math.radians(lon))
+            self.assertEqual(y, 1000 * 6371 * math.radians(lat))
+
+        self.assertEqual(convert_to_m(self.lonlat), [tuple(xy) for xy in coords_in_m.tolist()])
+        self.assertEqual(convert_to_m_array([]).shape, (0, 2))
+
+    def test_distance_kernels(self):
+        rng = np.random.default_rng(0)
+        lat1, lat2 = rng.uniform(50, 54, (2, 100))
+        lon1, lon2 = rng.uniform(3, 7, (2, 100))
+
+        pairwise = dist_complicated_array(lat1, lon1, lat2, lon2)
+        one_to_many = dist_complicated_array(lat1[0], lon1[0], lat2, lon2)
+        pairwise_sq = dist_simple_sq_array(lat1, lon1, lat2, lon2)
+        for i in range(100):
+            self.assertAlmostEqual(pairwise[i], dist_complicated(lat1[i], lon1[i], lat2[i], lon2[i]), delta=1e-6)
+            self.assertAlmostEqual(one_to_many[i], dist_complicated(lat1[0], lon1[0], lat2[i], lon2[i]), delta=1e-6)
+            self.assertAlmostEqual(pairwise_sq[i], dist_simple_sq(lat1[i], lon1[i], lat2[i], lon2[i]))
+
+    def test_create_edges(self):
+        edges = create_edges([self.lonlat[:2], self.lonlat], ["01", None], ["2", "3"])
+        self.assertEqual(len(edges), 2)
+        self.assertEqual(edges[0].ref_start, "1")
+        self.assertEqual(edges[1].coords_in_m.shape, (3, 2))
+        self.assertTrue(np.array_equal(edges[1].coords_in_m, convert_to_m_array(self.lonlat)))
+
+    def test_edge_table(self):
+        edges = create_edges([self.lonlat[:2], self.lonlat], ["1", "2"], ["2", None])
+        other_edges = create_edges([self.lonlat], ["2"], ["1"])
+        table = edges[0].table
+
+        # Views share the vertex buffer of the table
+        self.assertTrue(np.shares_memory(edges[1].coords_in_m, table.vertices_in_m))
+        self.assertEqual(edges[1].coords, np.asarray(self.lonlat).tolist())
+        self.assertTrue(np.array_equal(table.start_xy(), table.vertices_in_m[[0, 2]]))
+        self.assertTrue(np.array_equal(table.end_xy(), table.vertices_in_m[[1, 4]]))
+
+        edges[1].ref_end = "3"
+        self.assertEqual(table[1].ref_end, "3")
+        self.assertEqual(table[1], edges[1])
+        self.assertNotEqual(table[0], edges[1])
+
+        edges[0].closest_match_edge = other_edges[0]
+        edges[0].closest_match_dist = 5.0
+        self.assertEqual(edges[0].closest_match_edge, other_edges[0])
+        self.assertEqual(edges[1].closest_match_edge, None)
+        self.assertEqual(edges[0].closest_match_dist, 5.0)
+        with self.assertRaises(ValueError):
+            edges[1].matched_edge = edges[0]
+
+    def test_convert_rd_to_wgs(self):
+        rd_coords = [(155000, 463000), (233883.0, 582065.0), (13000.5, 370000.25), (190000, 310000)]
+        lonlat = convert_rd_to_wgs_array(rd_coords)
+        for (lon, lat), (lon_ref, lat_ref) in zip(lonlat, convert_rd_to_wgs(rd_coords)):
+            self.assertLess(dist_complicated(lat, lon, lat_ref, lon_ref), 0.001)
+
+        nodes = NodeTableBuilder()
+        nodes.append(lat=52.0, lon=5.0, rwn_ref="1", rcn_ref=None)
+        nodes.append(lat=463000, lon=155000, rwn_ref="2", rcn_ref=None, rd=True)
+        nodes = nodes.build()
+        self.assertEqual(nodes[0].lon, 5.0)
+        self.assertAlmostEqual(nodes[1].lat, 52.15517440)
+        self.assertAlmostEqual(nodes[1].lon, 5.38720621)
+
+        edges = create_edges([[(155000, 463000), (155100, 463000)]], ["1"], ["2"], [True])
+        self.assertAlmostEqual(edges[0].coords[0][1], 52.15517440)
+        self.assertAlmostEqual(edges[0].coords_in_m[1][0] - edges[0].coords_in_m[0][0], 100, delta=1)
+
+    def test_ref_index(self):
+        rng = np.random.default_rng(0)
+        refs = [str(r) for r in rng.integers(0, 20, 300)]
+        nodes = NodeTable.from_columns(rng.uniform(52, 52.1, 300), rng.uniform(5, 5.1, 300), refs, [None] * 300)
+        refs = [str(r) for r in rng.integers(0, 20, 200)]
+        query_nodes = NodeTable.from_columns(rng.uniform(52, 52.1, 200), rng.uniform(5, 5.1, 200), refs[:100] + [None] * 100, [None] * 100 + refs[100:])
+
+        dist, index = RefIndex(nodes).find_closest_match(query_nodes)
+
+        for i in range(len(query_nodes)):
+            d = np.hypot(*(nodes.xy - query_nodes.xy[i]).T)
+            same_ref = (nodes.rwn_ref == query_nodes.rwn_ref[i]) & (query_nodes.rwn_ref[i] >= 0) & (nodes.rwn_ref != nodes.refs.ids[""])
+            d[~same_ref] = np.inf
+            if np.isinf(d.min()):
+                self.assertEqual(index[i], -1)
+            else:
+                self.assertEqual(index[i], np.argmin(d))
+                self.assertAlmostEqual(dist[i], d.min())
+
+    def test_edge_distance(self):
+        from analyze import calculate_edge_to_edge_distance
+
+        rng = np.random.default_rng(1)
+        coords_list = []
+        for i in range(12):
+            n = rng.integers(2, 8)
+            coords_list.append(np.column_stack((rng.uniform(5, 5.01, n), rng.uniform(52, 52.01, n))).tolist())
+        edges = create_edges(coords_list, ["1"] * 12, ["2"] * 12)
+
+        edge_distance = EdgeDistance()
+        pairs = [(edges[i], edges[j]) for i in range(6) for j in range(6, 12)]
+        dists = edge_distance.distances(pairs)
+        for (edge_a, edge_b), dist in zip(pairs, dists):
+            self.assertEqual(dist, calculate_edge_to_edge_distance(edge_a, edge_b))
+
+        # Every edge is densified once
+        self.assertEqual(len(edge_distance.trees), 12)
+        self.assertEqual(edge_distance.distance(edges[6], edges[0]), dists[0])
+        self.assertEqual(len(edge_distance.distances([])), 0)
+
+    def test_exact_edge_distance(self):
+        rng = np.random.default_rng(2)
+        coords_list = []
+        for i in range(16):
+            n = rng.integers(1, 8)
+            coords_list.append(np.column_stack((rng.uniform(5, 5.003, n), rng.uniform(52, 52.002, n))).tolist())
+        edges = create_edges(coords_list, ["1"] * 16, ["2"] * 16)
+
+        def directed(edge_a, edge_b):
+            # Largest distance of points every 2 cm along b to the segments of a
+            points = densify(edge_b.coords_in_m, 0.02)
+            a = np.asarray(edge_a.coords_in_m)
+            a_start, a_end = (a[:-1], a[1:]) if len(a) > 1 else (a, a)
+            dist = [segment_distances(points, np.repeat(a_start[[j]], len(points), 0), np.repeat(a_end[[j]], len(points), 0)) for j in range(len(a_start))]
+            return np.min(dist, axis=0).max()
+
+        pairs = [(edges[i], edges[j]) for i in range(8) for j in range(8, 16)]
+        dists = ExactEdgeDistance(tolerance=0.001).distances(pairs)
+        split_dists = ExactEdgeDistance(tolerance=0.001, segment_length=5).distances(pairs)
+        for (edge_a, edge_b), dist, split_dist in zip(pairs, dists, split_dists):
+            reference = max(directed(edge_a, edge_b), directed(edge_b, edge_a))
+            self.assertLessEqual(dist, reference + 0.0201)
+            self.assertGreaterEqual(dist, reference - 0.0011)
+            self.assertAlmostEqual(dist, split_dist, delta=0.0011)
+
+    def test_endpoint_index(self):
+        # Dense cluster of edges with endpoints close to each other, more
+        # than any fixed number of neighbours
+        rng = np.random.default_rng(4)
+        edges = random_edges(rng, 60)
+        other_edges = random_edges(rng, 80)
+
+        pairs = EndpointIndex(other_edges).find_pairs(edges, 500)
+
+        expected = []
+        for i, edge in enumerate(edges):
+            start, end = edge.coords_in_m[0], edge.coords_in_m[-1]
+            for j, other in enumerate(other_edges):
+                other_start, other_end = other.coords_in_m[0], other.coords_in_m[-1]
+                same = np.hypot(*(start - other_start)) <= 500 and np.hypot(*(end - other_end)) <= 500
+                reversed = np.hypot(*(start - other_end)) <= 500 and np.hypot(*(end - other_start)) <= 500
+                if same or reversed:
+                    expected.append((i, j))
+
+        self.assertEqual(pairs.tolist(), [list(pair) for pair in expected])
+        self.assertGreater(np.bincount(pairs[:, 0]).max(), 10)
+
+    def test_edge_ref_index(self):
+        rng = np.random.default_rng(5)
+        edges = random_edges(rng, 60, n_refs=5)
+        other_edges = random_edges(rng, 80, n_refs=5)
+
+        # Same endpoints and the same refs, in either direction
+        expected = [(i, j) for i, j in EndpointIndex(other_edges).find_pairs(edges, 500)
+                    if sorted((edges[i].ref_start, edges[i].ref_end)) == sorted((other_edges[j].ref_start, other_edges[j].ref_end))]
+
+        index = EdgeRefIndex(other_edges)
+        self.assertEqual(index.find_pairs(edges, 500).tolist(), [list(pair) for pair in expected])
+
+        # Large groups are searched with an EndpointIndex
+        index.max_combinations = 10
+        self.assertEqual(index.find_pairs(edges, 500).tolist(), [list(pair) for pair in expected])
+        self.assertEqual(len(index.find_pairs([], 500)), 0)
+
+    def test_query_in_order(self):
+        from scipy.spatial import KDTree
+        from compare import query_in_order
+
+        # Points 1 and 3 are at the same distance, as are the copies 0 and 2
+        tree = KDTree([[1.0, 0.0], [0.0, 2.0], [1.0, 0.0], [-2.0, 0.0], [5.0, 5.0]])
+        dd, ii = query_in_order(tree, np.array([[0.0, 0.0], [1.0, 0.0]]), 3)
+        self.assertEqual(ii.tolist(), [[0, 2, 1], [0, 2, 1]])
+        self.assertEqual(dd.tolist(), [[1.0, 1.0, 2.0], [0.0, 0.0, math.sqrt(5)]])
@@ -0,0 +1,33 @@
+import json
+import numpy as np
+from edge import create_edges
+
+# Test data that is used by more than one test module
+
+def random_edges(rng, n, width=0.02, height=0.01, length=None, n_refs=None):
+    # n edges with random endpoints in an area of width by height degrees at
+    # (5, 52), with a vertex near the middle. With length, the end is within
+    # length degrees of the start. The refs are random numbers from 1 to
+    # n_refs - 1, or 1 and 2 for all edges.
+    coords_list = []
+    for i in range(n):
+        start = np.array((5 + rng.uniform(0, width), 52 + rng.uniform(0, height)))
+        if length:
+            end = start + rng.uniform(-length, length, 2)
+        else:
+            end = np.array((5 + rng.uniform(0, width), 52 + rng.uniform(0, height)))
+        coords_list.append([start, (start + end) / 2 + rng.uniform(-0.001, 0.001, 2), end])
+
+    if n_refs:
+        refs = rng.integers(1, n_refs, (n, 2)).astype(str)
+    else:
+        refs = np.array([["1", "2"]] * n)
+    return create_edges(coords_list, refs[:, 0].tolist(), refs[:, 1].tolist())
+
+def point_feature(lon, lat, properties):
+    # GeoJSON feature of a point
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]}, "properties": properties}
+
+def write_geojson(filename, features):
+    with open(filename, "w", encoding="utf8") as file:
+        json.dump({"type": "FeatureCollection", "features": features}, file)
@@ -0,0 +1,74 @@
+import unittest
+from node import Node, NodeTable
+from change_type import ChangeType
+
+class TestNodeTable(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = NodeTable.from_columns([52.1, 52.2, 52.3], [5.1, 5.2, 5.3], ["04", None, "0"], [None, "12", "7"])
+        self.other = NodeTable.from_columns([52.1], [5.1], ["4"], [None])
+
+    def test_columns(self):
+        self.assertEqual(len(self.nodes), 3)
+        self.assertEqual(self.nodes.xy.shape, (3, 2))
+        self.assertEqual(self.nodes[0].rwn_ref, "4")
+        self.assertEqual(self.nodes[1].rwn_ref, None)
+        self.assertEqual(self.nodes[2].rwn_ref, "")
+        self.assertEqual(self.nodes[1].rcn_ref, "12")
+        self.assertEqual(self.nodes[-1].lat, 52.3)
+        # Interned ref numbers are shared between tables
+        self.assertEqual(self.nodes.rwn_ref[0], self.other.rwn_ref[0])
+
+    def test_view(self):
+        node = Node(lat=52.1, lon=5.1, rwn_ref="04", rcn_ref=None)
+        self.assertEqual(node.rwn_ref, "4")
+        self.assertEqual(node.lon_in_m, self.nodes[0].lon_in_m)
+        self.assertEqual(self.nodes[0], self.nodes[0])
+        self.assertNotEqual(self.nodes[0], self.nodes[1])
+        self.assertNotEqual(node, self.nodes[0])
+
+    def test_results(self):
+        self.nodes.link(self.other)
+        node = self.nodes[1]
+        self.assertEqual(node.closest_match_node, None)
+        self.assertEqual(node.closest_match_dist, None)
+        self.assertEqual(node.change_type, None)
+
+        node.closest_match_node = self.other[0]
+        node.closest_match_dist = 12.5
+        node.change_type = ChangeType.MOVED_SHORT
+        node.renamed_from = "3"
+        self.assertEqual(self.nodes.match[1], 0)
+        self.assertEqual(node.closest_match_node, self.other[0])
+        self.assertEqual(node.closest_match_dist, 12.5)
+        self.assertEqual(node.change_type, ChangeType.MOVED_SHORT)
+        self.assertEqual(node.renamed_from, "3")
+
+        with self.assertRaises(ValueError):
+            node.matched_node = Node(lat=52.1, lon=5.1, rwn_ref="4", rcn_ref=None)
+
+    def test_lazy_columns(self):
+        # Views have no __dict__, the projection and the result columns are
+        # created when first used
+        node = Node(lat=52.1, lon=5.1, rwn_ref="4", rcn_ref=None)
+        with self.assertRaises(AttributeError):
+            node.extra = 1
+
+        table = node.table
+        self.assertNotIn("match", vars(table))
+        self.assertIsNone(table._x_m)
+        self.assertEqual(node.closest_node, None)
+        self.assertEqual(table.closest_k.shape, (1, 1))
+        self.assertGreater(node.lon_in_m, 0)
+        self.assertIsNotNone(table._x_m)
+
+        with self.assertRaises(AttributeError):
+            table.unknown
+
+        self.nodes.link(self.other)
+        self.nodes[0].closest_node = self.other[0]
+        self.nodes[0].closest_dist = 3.0
+        self.assertEqual(self.nodes.closest_k[0, 0], 0)
+        self.assertEqual(self.nodes.closest_k_dist[0, 0], 3.0)
+        self.nodes.link(self.other)
+        self.assertEqual(self.nodes[0].closest_node, None)
@@ -1,6 +1,18 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import cache
 import unittest
-from import_osm import import_osm
-from import_geojson import import_geojson
+import numpy as np
+import geojson_stream
+import import_osm as import_osm_module
+from geojson_stream import iter_features
+from import_osm import import_osm, read_osm
+from import_geojson import import_geojson, read_geojson
+from import_pbf import read_pbf, read_blob_index, read_node_coordinates, set_wanted_ids
+from tests.pbf_fixture import encode_fixture
 
 class TestImport(unittest.TestCase):
 
@@ -14,6 +26,112 @@ class TestImport(unittest.TestCase):
         self.assertEqual(nodes[2].rcn_ref, '9')
         self.assertEqual(nodes[2].lon, 6.53)
 
+    def test_osm_filter(self):
+        text = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="52.1" lon="5.1"/>
+  <node id="2" lat="52.2" lon="5.2">
+    <tag k="highway" v="crossing"/>
+  </node>
+  <node id="3" lon="5.3" lat="52.3">
+    <tag k="rcn_ref" v="07"/>
+  </node>
+  <node id='4' lat='52.4' lon='5.4'>
+    <tag k='rwn_ref' v='?' />
+  </node>
+  <way id="5">
+    <nd ref="1"/>
+    <tag k="rwn_ref" v="12"/>
+  </way>
+</osm>
+"""
+        # Small chunks, so nodes are split over reads
+        chunk_size = import_osm_module.chunk_size
+        import_osm_module.chunk_size = 11
+        try:
+            nodes, invalid_nodes = read_osm(io.StringIO(text))
+        finally:
+            import_osm_module.chunk_size = chunk_size
+
+        self.assertEqual(len(nodes), 1)
+        self.assertEqual(nodes[0].lat, 52.3)
+        self.assertEqual(nodes[0].rwn_ref, None)
+        self.assertEqual(nodes[0].rcn_ref, '7')
+        self.assertEqual(len(invalid_nodes), 1)
+        self.assertEqual(invalid_nodes[0].lon, 5.4)
+
+    def test_osm_entities(self):
+        # Entities in the values and tags with v before k
+        text = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="52.1" lon="5.1">
+    <tag k="name" v="Kerk &amp; molen"/>
+    <tag v="1&#39;2" k="rwn_ref"/>
+  </node>
+  <node id="2" lat="52.2" lon="5.2">
+    <tag v='45' k='rcn_ref' />
+    <tag v="&quot;a&quot;" k="rwn_ref"/>
+  </node>
+  <node id="3" lat="52.3" lon="5.3">
+    <tag k="note" v="rwn_ref"/>
+    <tag v="&#x37;" k="rcn_ref"/>
+  </node>
+</osm>
+"""
+        nodes, invalid_nodes = read_osm(io.StringIO(text))
+        self.assertEqual([(node.lat, node.rwn_ref, node.rcn_ref) for node in nodes],
+                         [(52.1, "1'2", None), (52.2, '"a"', '45'), (52.3, None, '7')])
+        self.assertEqual(len(invalid_nodes), 0)
+
+    def test_pbf(self):
+        # Decoding in this process and in a process pool gives the same result
+        for workers in (1, 2):
+            nodes, invalid_nodes, edges, invalid_edges = read_pbf("tests/data/test.osm.pbf", workers=workers)
+            self.assertEqual([(node.rwn_ref, node.rcn_ref) for node in nodes], [('12', None), (None, '7'), ('13', '14')])
+            self.assertAlmostEqual(nodes[0].lat, 52.1)
+            self.assertAlmostEqual(nodes[0].lon, 5.1)
+            self.assertAlmostEqual(nodes[2].lat, 52.7)
+            self.assertEqual(len(invalid_nodes), 1)
+
+            # Route 12-07 consists of the ways 1-3-6 and 2-4-6, the second one
+            # is turned around
+            self.assertEqual(len(edges), 1)
+            self.assertEqual((edges[0].ref_start, edges[0].ref_end), ('12', '7'))
+            self.assertEqual([round(lon, 6) for lon, lat in edges[0].coords], [5.1, 5.3, 5.6, 5.4, 5.2])
+            self.assertEqual([(edge.ref_start, edge.ref_end) for edge in invalid_edges], [('13', '?')])
+
+        nodes, invalid_nodes, edges, invalid_edges = read_pbf("tests/data/test.osm.pbf", read_edges=False, workers=1)
+        self.assertEqual((len(nodes), edges), (3, None))
+
+    def test_pbf_node_coordinates(self):
+        # Wanted nodes are found among the dense nodes and the plain node 7
+        filename = "tests/data/test.osm.pbf"
+        set_wanted_ids(np.array([3, 7, 9], dtype=np.int64))
+        try:
+            results = [read_node_coordinates(filename, offset, size) for offset, size in read_blob_index(filename)]
+        finally:
+            set_wanted_ids(None)
+
+        ids, lat, lon = (np.concatenate(column) for column in zip(*[result for result in results if result]))
+        self.assertEqual(ids.tolist(), [3, 7])
+        self.assertEqual([round(value, 6) for value in lat.tolist()], [52.3, 52.7])
+        self.assertEqual([round(value, 6) for value in lon.tolist()], [5.3, 5.7])
+
+    def test_pbf_offset(self):
+        # lat_offset and lon_offset are int64, not zigzag encoded
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "offset.osm.pbf")
+            with open(filename, "wb") as f:
+                f.write(encode_fixture(lat_offset=-1234567800, lon_offset=987654300))
+
+            nodes, invalid_nodes, edges, invalid_edges = read_pbf(filename, workers=1)
+            self.assertEqual([(node.rwn_ref, node.rcn_ref) for node in nodes], [('12', None), (None, '7'), ('13', '14')])
+            self.assertAlmostEqual(nodes[0].lat, 52.1)
+            self.assertAlmostEqual(nodes[0].lon, 5.1)
+            self.assertAlmostEqual(nodes[2].lat, 52.7)
+            self.assertAlmostEqual(nodes[2].lon, 5.7)
+            self.assertEqual([round(lon, 6) for lon, lat in edges[0].coords], [5.1, 5.3, 5.6, 5.4, 5.2])
+
     def test_geojson(self):
         nodes, invalid_nodes = import_geojson("tests/data/test.json", rwn_name="knooppuntnummer")
         self.assertEqual(len(nodes), 4)
@@ -26,3 +144,110 @@ class TestImport(unittest.TestCase):
     def test_geojson_filter_province(self):
         nodes, invalid_nodes = import_geojson("tests/data/test.json", rwn_name="knooppuntnummer", filter_province="Zuid-Holland")
         self.assertEqual(len(nodes), 2)
+
+    def test_geojson_combined(self):
+        features = [
+            {"type": "Feature", "id": "node/1", "properties": {"rwn_ref": "012", "provincie": "Gelderland"}, "geometry": {"type": "Point", "coordinates": [5.7, 52.1]}},
+            {"type": "Feature", "id": "node/2", "properties": {"name": "no ref"}, "geometry": {"type": "Point", "coordinates": [5.8, 52.1]}},
+            {"type": "Feature", "id": "node/3", "properties": {"rwn_ref": "?"}, "geometry": {"type": "Point", "coordinates": [5.9, 52.1]}},
+            {"type": "Feature", "id": "way/1", "properties": {"ref": "12-07"}, "geometry": {"type": "LineString", "coordinates": [[5.7, 52.1], [5.8, 52.2]]}},
+            {"type": "Feature", "id": "way/2", "properties": {"ref": "12-07", "provincie": "Utrecht"}, "geometry": {"type": "LineString", "coordinates": [[5.7, 52.1], [5.8, 52.2]]}},
+            {"type": "Feature", "id": "way/3", "properties": {"ref": "12-?"}, "geometry": {"type": "LineString", "coordinates": [[5.7, 52.1], [5.8, 52.2]]}},
+        ]
+        fd, filename = tempfile.mkstemp(suffix=".geojson")
+        with os.fdopen(fd, "w", encoding="utf8") as file:
+            json.dump({"type": "FeatureCollection", "features": features}, file)
+
+        try:
+            nodes, invalid_nodes, edges, invalid_edges = read_geojson(filename, filter_province="Gelderland")
+            self.assertEqual(len(nodes), 1)
+            self.assertEqual(nodes[0].rwn_ref, "12")
+            self.assertEqual(len(invalid_nodes), 1)
+            self.assertEqual([(edge.ref_start, edge.ref_end) for edge in edges], [("12", "7")])
+            self.assertEqual(len(invalid_edges), 1)
+
+            # Features of the type that is not read are skipped
+            nodes, invalid_nodes, edges, invalid_edges = read_geojson(filename, read_edges=False)
+            self.assertEqual((len(nodes), len(invalid_nodes), edges), (1, 1, None))
+            nodes, invalid_nodes, edges, invalid_edges = read_geojson(filename, read_nodes=False)
+            self.assertEqual((len(nodes), len(invalid_nodes), len(edges)), (0, 0, 2))
+
+            # A nodes file keeps the nodes without a ref as invalid nodes
+            nodes, invalid_nodes, edges, invalid_edges = read_geojson(filename, read_edges=False, skip_unnumbered=False)
+            self.assertEqual(len(invalid_nodes), 2)
+
+            # Edges loaded from the cache use the memory mapped vertex buffer
+            cache_dir, mmap_size = cache.cache_dir, cache.mmap_size
+            cache.cache_dir, cache.mmap_size = tempfile.mkdtemp(), 0
+            try:
+                parsed = read_geojson(filename, filter_province="Gelderland")[2]
+                cached = read_geojson(filename, filter_province="Gelderland")[2]
+                self.assertIsInstance(cached[0].table.vertices, np.memmap)
+                self.assertEqual([edge.coords for edge in parsed], [edge.coords for edge in cached])
+            finally:
+                shutil.rmtree(cache.cache_dir)
+                cache.cache_dir, cache.mmap_size = cache_dir, mmap_size
+        finally:
+            os.remove(filename)
+
+    def test_geojson_cache(self):
+        with open("tests/data/test.json", encoding="utf8") as file:
+            collection = json.load(file)
+
+        cache_dir = cache.cache_dir
+        cache.cache_dir = tempfile.mkdtemp()
+        filename = os.path.join(cache.cache_dir, "test.json")
+        try:
+            with open(filename, "w", encoding="utf8") as file:
+                json.dump(collection, file)
+
+            parsed = import_geojson(filename, rwn_name="knooppuntnummer", filter_regio="Lunteren")
+            self.assertEqual(len(os.listdir(cache.cache_dir)), 2)
+
+            # The filters are applied to the cached arrays
+            cached = import_geojson(filename, rwn_name="knooppuntnummer", filter_regio="Lunteren")
+            for nodes, cached_nodes in zip(parsed, cached):
+                self.assertEqual([(node.lat, node.lon, node.rwn_ref) for node in nodes],
+                                 [(node.lat, node.lon, node.rwn_ref) for node in cached_nodes])
+            nodes, invalid_nodes = import_geojson(filename, rwn_name="knooppuntnummer")
+            self.assertEqual((len(nodes), len(invalid_nodes)), (4, 1))
+
+            # A changed file is parsed again
+            del collection["features"][0]
+            with open(filename, "w", encoding="utf8") as file:
+                json.dump(collection, file)
+            os.utime(filename, ns=(0, 0))
+            nodes, invalid_nodes = import_geojson(filename, rwn_name="knooppuntnummer")
+            self.assertEqual(len(nodes) + len(invalid_nodes), 4)
+
+            # Other .npz files in the cache are ignored
+            for name in os.listdir(cache.cache_dir):
+                if name.endswith(".npz"):
+                    np.savez(os.path.join(cache.cache_dir, name), other=np.zeros(3))
+            nodes, invalid_nodes = import_geojson(filename, rwn_name="knooppuntnummer")
+            self.assertEqual(len(nodes) + len(invalid_nodes), 4)
+        finally:
+            shutil.rmtree(cache.cache_dir)
+            cache.cache_dir = cache_dir
+
+    def test_geojson_stream(self):
+        with open("tests/data/test.json", encoding="utf8") as file:
+            features = json.load(file)["features"]
+
+        # Small chunks, so values are split over reads
+        chunk_size = geojson_stream.chunk_size
+        geojson_stream.chunk_size = 7
+        try:
+            with open("tests/data/test.json", encoding="utf8") as file:
+                self.assertEqual(list(iter_features(file)), features)
+
+            text = '{"type": "FeatureCollection", "totalFeatures": 12345, "crs": {"type": "name"},\n "features": [' + \
+                ", ".join(json.dumps(f) for f in features) + '], "numberReturned": 5}'
+            self.assertEqual(list(iter_features(io.StringIO(text))), features)
+            self.assertEqual(list(iter_features(io.StringIO(json.dumps(features)))), features)
+            self.assertEqual(list(iter_features(io.StringIO('{"type": "FeatureCollection", "features": [ ]}'))), [])
+        finally:
+            geojson_stream.chunk_size = chunk_size
+
+        with self.assertRaises(ValueError):
+            list(iter_features(io.StringIO('{"features": [{"type": "Feature"}')))
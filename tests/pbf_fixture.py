@@ -0,0 +1,143 @@
+import struct
+import sys
+import zlib
+
+# Writes tests/data/test.osm.pbf, run from the root of the repository:
+#
+#     python -m tests.pbf_fixture
+#
+# A minimal protobuf encoder, only for the messages in the fixture.
+
+def varint(value):
+    # int64 values are encoded as their 64 bit two's complement
+    value &= (1 << 64) - 1
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def key(field, wire_type):
+    return varint((field << 3) | wire_type)
+
+def varint_field(field, value):
+    return key(field, 0) + varint(value)
+
+def bytes_field(field, data):
+    return key(field, 2) + varint(len(data)) + data
+
+def packed_field(field, values):
+    return bytes_field(field, b"".join(varint(value) for value in values))
+
+def delta(values):
+    # Delta coded sint64 values, as in DenseNodes and way refs
+    out = []
+    previous = 0
+    for value in values:
+        out.append(zigzag(value - previous))
+        previous = value
+    return out
+
+class StringTable():
+    def __init__(self):
+        self.strings = [b""]
+        self.ids = {b"": 0}
+
+    def __call__(self, string):
+        string = string.encode("utf8")
+        if string not in self.ids:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.ids[string]
+
+    def encode(self):
+        return b"".join(bytes_field(1, string) for string in self.strings)
+
+def primitive_block(strings, groups, granularity=None, lat_offset=0, lon_offset=0):
+    data = bytes_field(1, strings.encode()) + b"".join(bytes_field(2, group) for group in groups)
+    if granularity:
+        data += varint_field(17, granularity)
+    if lat_offset:
+        data += varint_field(19, lat_offset)
+    if lon_offset:
+        data += varint_field(20, lon_offset)
+    return data
+
+def blob(blob_type, data, compress):
+    if compress:
+        body = varint_field(2, len(data)) + bytes_field(3, zlib.compress(data))
+    else:
+        body = bytes_field(1, data)
+    header = bytes_field(1, blob_type) + varint_field(3, len(body))
+    return struct.pack(">i", len(header)) + header + body
+
+def encode_fixture(lat_offset=0, lon_offset=0):
+    # The fixture: six dense nodes and one plain node, two ways of walking
+    # route 12-07, a bus route, an incomplete walking route and a cycling
+    # route.
+    # The offsets (in nanodegrees, multiples of 100) do not change the
+    # coordinates of the nodes.
+    def coordinate(degrees, offset):
+        return (round(degrees * 1e9) - offset) // 100
+
+    out = bytearray()
+    header = bytes_field(4, b"OsmSchema-V0.6") + bytes_field(4, b"DenseNodes") + bytes_field(16, b"test")
+    out += blob(b"OSMHeader", header, True)
+
+    # Block 1: nodes
+    strings = StringTable()
+    dense_nodes = [
+        (1, 52.1, 5.1, [("rwn_ref", "012"), ("network:type", "node_network")]),
+        (2, 52.2, 5.2, [("rcn_ref", "7")]),
+        (3, 52.3, 5.3, []),
+        (4, 52.4, 5.4, [("highway", "crossing")]),
+        (5, 52.5, 5.5, [("rwn_ref", "?")]),
+        (6, 52.6, 5.6, []),
+    ]
+    keys_vals = []
+    for _, _, _, tags in dense_nodes:
+        for k, v in tags:
+            keys_vals += [strings(k), strings(v)]
+        keys_vals.append(0)
+    dense = (packed_field(1, delta([node_id for node_id, _, _, _ in dense_nodes]))
+             + packed_field(8, delta([coordinate(lat, lat_offset) for _, lat, _, _ in dense_nodes]))
+             + packed_field(9, delta([coordinate(lon, lon_offset) for _, _, lon, _ in dense_nodes]))
+             + packed_field(10, keys_vals))
+    node = (varint_field(1, zigzag(7)) + packed_field(2, [strings("rwn_ref"), strings("rcn_ref")]) + packed_field(3, [strings("13"), strings("14")])
+            + varint_field(8, zigzag(coordinate(52.7, lat_offset))) + varint_field(9, zigzag(coordinate(5.7, lon_offset))))
+    group = bytes_field(2, dense) + bytes_field(1, node)
+    out += blob(b"OSMData", primitive_block(strings, [group], lat_offset=lat_offset, lon_offset=lon_offset), True)
+
+    # Block 2: ways and relations, not compressed
+    strings = StringTable()
+
+    def way(way_id, refs, tags=()):
+        return (varint_field(1, way_id) + packed_field(2, [strings(k) for k, v in tags]) + packed_field(3, [strings(v) for k, v in tags])
+                + packed_field(8, delta(refs)))
+
+    def relation(relation_id, tags, members):
+        # members as (type, id), type 0 is a node and 1 a way
+        return (varint_field(1, relation_id) + packed_field(2, [strings(k) for k, v in tags]) + packed_field(3, [strings(v) for k, v in tags])
+                + packed_field(8, [strings("") for _ in members]) + packed_field(9, delta([member_id for _, member_id in members]))
+                + packed_field(10, [member_type for member_type, _ in members]))
+
+    ways = bytes_field(3, way(10, [1, 3, 6])) + bytes_field(3, way(11, [2, 4, 6], [("highway", "path")])) + bytes_field(3, way(12, [3, 4]))
+    relations = (bytes_field(4, relation(20, [("type", "route"), ("network", "rwn"), ("network:type", "node_network"), ("ref", "12-07")], [(1, 10), (1, 11), (0, 1)]))
+                 + bytes_field(4, relation(21, [("type", "route"), ("route", "bus"), ("ref", "5")], [(1, 12)]))
+                 + bytes_field(4, relation(22, [("type", "route"), ("network", "rwn"), ("network:type", "node_network"), ("note", "13-?")], [(1, 12)]))
+                 + bytes_field(4, relation(23, [("type", "route"), ("network", "rcn"), ("network:type", "node_network"), ("ref", "7-14")], [(1, 11)])))
+    out += blob(b"OSMData", primitive_block(strings, [ways, relations], granularity=100), False)
+
+    return bytes(out)
+
+if __name__ == "__main__":
+    filename = sys.argv[1] if len(sys.argv) > 1 else "tests/data/test.osm.pbf"
+    with open(filename, "wb") as f:
+        f.write(encode_fixture())
@@ -2,6 +2,8 @@ import unittest
 import tests.analyze
 import tests.parser
 import tests.helper
+import tests.node
+import tests.compare
 
 # initialize the test suite
 loader = unittest.TestLoader()
@@ -11,6 +13,8 @@ suite  = unittest.TestSuite()
 suite.addTests(loader.loadTestsFromModule(tests.analyze))
 suite.addTests(loader.loadTestsFromModule(tests.parser))
 suite.addTests(loader.loadTestsFromModule(tests.helper))
+suite.addTests(loader.loadTestsFromModule(tests.node))
+suite.addTests(loader.loadTestsFromModule(tests.compare))
 
 # initialize a runner, pass it your suite and run it
 runner = unittest.TextTestRunner(verbosity=3)